@@ -0,0 +1,134 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+
+from werkzeug.security import generate_password_hash
+
+import db
+import logic
+
+# Linhas gravadas por transação; a memória usada não depende do tamanho do ficheiro.
+LOTE = 500
+HASH_WORKERS = os.cpu_count() or 2
+
+@contextmanager
+def _abrir(caminho, modo):
+    # '-' lê da entrada padrão ou escreve para a saída padrão.
+    if caminho == '-':
+        yield sys.stdin if 'r' in modo else sys.stdout
+    else:
+        with open(caminho, modo, encoding='utf-8', newline='' if caminho.endswith('.csv') else None) as f:
+            yield f
+
+def _lotes(iteravel, tamanho):
+    iterador = iter(iteravel)
+    while lote := list(islice(iterador, tamanho)):
+        yield lote
+
+def _sim(valor):
+    return 1 if str(valor or '').strip().lower() in ('1', 's', 'sim', 'true', 'y', 'yes') else 0
+
+def importar_usuarios(args):
+    """CSV com cabeçalho username,password[,is_admin] (ou password_hash, vindo de exportar-usuarios)."""
+    criados, ignorados = 0, 0
+    with _abrir(args.ficheiro, 'r') as f, ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for numero, lote in enumerate(_lotes(csv.DictReader(f), LOTE)):
+            validas = [linha for linha in lote if (linha.get('username') or '').strip() and (linha.get('password') or linha.get('password_hash'))]
+            ignorados += len(lote) - len(validas)
+            # O hash de senhas é propositadamente lento; divide-se pelos processos disponíveis.
+            por_hashear = [linha['password'] for linha in validas if not linha.get('password_hash')]
+            hashes = iter(executor.map(generate_password_hash, por_hashear, chunksize=max(len(por_hashear) // (args.workers * 4), 1)))
+            usuarios = [(linha['username'].strip(), linha.get('password_hash') or next(hashes), _sim(linha.get('is_admin'))) for linha in validas]
+            novos = db.importar_usuarios(usuarios)
+            criados += novos
+            ignorados += len(usuarios) - novos
+            print(f"Lote {numero + 1}: {novos} utilizadores criados.", file=sys.stderr)
+    return {'criados': criados, 'ignorados': ignorados}
+
+def exportar_usuarios(args):
+    with _abrir(args.ficheiro, 'w') as f:
+        escritor = csv.writer(f)
+        escritor.writerow(['username', 'password_hash', 'is_admin'])
+        usuarios = db.exportar_usuarios()
+        escritor.writerows(usuarios)
+    return {'exportados': len(usuarios)}
+
+def exportar_analises(args):
+    analises, respostas = 0, 0
+    with _abrir(args.ficheiro, 'w') as f:
+        for analise in db.exportar_analises(args.usuario, args.tipo, LOTE):
+            f.write(json.dumps(analise, ensure_ascii=False, default=str))
+            f.write('\n')
+            analises += 1
+            respostas += len(analise['respostas'])
+    return {'analises': analises, 'respostas': respostas}
+
+def _ler_analises(f, tipos, invalidas):
+    for numero, linha in enumerate(f, 1):
+        if not linha.strip():
+            continue
+        try:
+            analise = json.loads(linha)
+            if not (analise.get('username') and analise.get('site_url') and analise.get('tipo_analise') in tipos):
+                raise ValueError("faltam username/site_url ou o tipo de análise é desconhecido")
+        except ValueError as e:
+            print(f"Linha {numero} ignorada: {e}", file=sys.stderr)
+            invalidas.append(numero)
+            continue
+        yield analise
+
+def importar_analises(args):
+    totais = {'criadas': 0, 'atualizadas': 0, 'ignoradas': 0}
+    invalidas = []
+    with _abrir(args.ficheiro, 'r') as f:
+        for lote in _lotes(_ler_analises(f, logic.carregar_criterios(), invalidas), LOTE):
+            for chave, valor in db.importar_analises(lote, args.substituir).items():
+                totais[chave] += valor
+    totais['invalidas'] = len(invalidas)
+    return totais
+
+def main():
+    parser = argparse.ArgumentParser(description="Importação e exportação em massa de utilizadores e análises.")
+    parser.add_argument('--db', default=db.DB_NAME)
+    comandos = parser.add_subparsers(dest='comando', required=True)
+
+    p = comandos.add_parser('importar-usuarios', help="Cria utilizadores a partir de um CSV (username,password[,is_admin]).")
+    p.add_argument('ficheiro')
+    p.add_argument('--workers', type=int, default=HASH_WORKERS, help="Processos a calcular hashes de senhas.")
+    p.set_defaults(funcao=importar_usuarios)
+
+    p = comandos.add_parser('exportar-usuarios', help="Exporta utilizadores (com o hash da senha) para CSV.")
+    p.add_argument('ficheiro')
+    p.set_defaults(funcao=exportar_usuarios)
+
+    p = comandos.add_parser('exportar-analises', help="Exporta análises, respostas e metadados dos relatórios para JSONL.")
+    p.add_argument('ficheiro')
+    p.add_argument('--usuario')
+    p.add_argument('--tipo', help="Prefeitura ou Câmara.")
+    p.set_defaults(funcao=exportar_analises)
+
+    p = comandos.add_parser('importar-analises', help="Importa análises de um JSONL gerado por exportar-analises.")
+    p.add_argument('ficheiro')
+    p.add_argument('--substituir', action='store_true', help="Substitui as análises que já existem em vez de as ignorar.")
+    p.set_defaults(funcao=importar_analises)
+
+    args = parser.parse_args()
+    db.DB_NAME = os.path.abspath(args.db)
+    if args.ficheiro != '-':
+        args.ficheiro = os.path.abspath(args.ficheiro)
+    # Os critérios são lidos com caminhos relativos à raiz do projeto.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    db.init_db()
+    inicio = time.perf_counter()
+    resultado = args.funcao(args)
+    resultado['duracao_s'] = round(time.perf_counter() - inicio, 2)
+    print(json.dumps(resultado, ensure_ascii=False), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,80 @@
-import io
+import hashlib
 import os
-from datetime import datetime
-from pathlib import Path
+from datetime import datetime, timezone
 from flask import (Flask, render_template, request, redirect, url_for, 
-                   session, flash, jsonify, send_file, abort)
+                   session, flash, jsonify, send_file, abort, Response, stream_with_context, make_response)
+from markupsafe import Markup
 from functools import wraps
 from werkzeug.security import check_password_hash, generate_password_hash
-from werkzeug.utils import secure_filename
 
 import logic
 import db
+import fila_relatorios
+import relatorios_lote
+import imagens
+import metricas
+import aquecimento
+import pre_verificacao
 
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+DASHBOARD_PAGE_SIZE = 50
+ADMIN_PAGE_SIZE = 50
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'uma-chave-para-desenvolvimento-local')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 db.init_db()
+metricas.instrumentar(app)
+
+@app.before_request
+def iniciar_fila_relatorios():
+    # Normalmente já feito no post_fork do gunicorn; aqui cobre o servidor de desenvolvimento.
+    aquecimento.aquecer_worker()
+
+@app.before_request
+def recarregar_criterios():
+    # Se o ficheiro de critérios mudou, regista a nova versão; as análises afetadas são pontuadas fora do pedido.
+    if db.sincronizar_catalogo():
+        aquecimento.repontuar_em_segundo_plano()
+
+# (tipo de análise, versão dos critérios) -> HTML da matriz de perguntas, igual para todas as análises desse tipo.
+_fragmentos_matriz = {}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def matriz_html(tipo_analise):
+    chave = (tipo_analise, logic.versao_tipo(tipo_analise))
+    html = _fragmentos_matriz.get(chave)
+    if html is None:
+        html = Markup(render_template('_matriz_analise.html', matriz=logic.carregar_criterios().get(tipo_analise)))
+        # Mantém só a versão atual de cada tipo.
+        for antiga in [k for k in _fragmentos_matriz if k[0] == tipo_analise]:
+            _fragmentos_matriz.pop(antiga, None)
+        _fragmentos_matriz[chave] = html
+    return html
+
+def etag_pagina(*partes):
+    # A página depende também de quem a vê (menu de administração) e da versão dos critérios.
+    partes = (session.get('username'), session.get('is_admin'), logic.versao_criterios(), request.full_path) + partes
+    return hashlib.sha256(repr(partes).encode('utf-8')).hexdigest()[:32]
+
+def nao_modificada(etag):
+    """Resposta 304 se o navegador já tem esta versão da página; None se for preciso renderizá-la."""
+    # Mensagens flash pendentes têm de ser mostradas, por isso a página é sempre renderizada.
+    if '_flashes' in session or not request.if_none_match.contains(etag):
+        return None
+    return com_etag(app.response_class(status=304), etag)
+
+def com_etag(resposta, etag):
+    resposta = make_response(resposta)
+    resposta.set_etag(etag)
+    # O navegador pode guardar a página, mas tem de confirmar com o servidor antes de a reutilizar.
+    resposta.cache_control.private = True
+    resposta.cache_control.no_cache = True
+    return resposta
+
 # As definições dos decoradores devem vir aqui, antes de serem usadas.
 def login_required(f):
     @wraps(f)
@@ -81,42 +134,34 @@ def logout():
 @app.route('/')
 @login_required
 def dashboard():
-    analises = db.listar_analises_por_usuario(session['username'])
-    matriz_completa = logic.carregar_criterios()
+    etag = etag_pagina(db.estado_analises_usuario(session['username']))
+    resposta = nao_modificada(etag)
+    if resposta:
+        return resposta
+    antes = None
+    if request.args.get('antes') and request.args.get('antes_id', type=int):
+        antes = (request.args['antes'], request.args.get('antes_id', type=int))
+    analises = db.listar_analises_por_usuario(session['username'], limite=DASHBOARD_PAGE_SIZE + 1, antes=antes)
+    proxima_pagina = None
+    if len(analises) > DASHBOARD_PAGE_SIZE:
+        analises = analises[:DASHBOARD_PAGE_SIZE]
+        proxima_pagina = {'antes': analises[-1]['last_modified'], 'antes_id': analises[-1]['id']}
     for analise in analises:
-        criterios_para_analise = matriz_completa.get(analise['tipo_analise'])
-        score = 0
-        selo = "Não iniciado"
-        if criterios_para_analise and analise.get('respostas'):
-            resultados = logic.calcular_indice_e_selo(analise['respostas'], criterios_para_analise)
-            score = resultados['indice']
-            selo = resultados['selo']
-        analise['score'] = score
-        analise['selo'] = selo
+        analise['score'] = analise['indice'] if analise['indice'] is not None else 0
+        analise['selo'] = analise['selo'] or "Não iniciado"
         if analise.get('last_modified'):
             dt_obj = datetime.strptime(analise['last_modified'].split('.')[0], '%Y-%m-%d %H:%M:%S')
             analise['last_modified_fmt'] = dt_obj.strftime('%d/%m/%Y às %H:%M')
         else:
             analise['last_modified_fmt'] = "N/A"
-        analise['latest_report'] = db.get_latest_report(analise['id'])
-    
-    dados_grafico_selos = {
-        "labels": [a['selo'] for a in analises if a['selo'] != "Não iniciado"],
-        "data": [1 for a in analises if a['selo'] != "Não iniciado"]
-    }
-    selos_contagem = {}
-    [selos_contagem.update({s: selos_contagem.get(s, 0) + 1}) for s in dados_grafico_selos['labels']]
-    dados_grafico_selos = {"labels": list(selos_contagem.keys()), "data": list(selos_contagem.values())}
-
-    scores_por_tipo = {
-        "Prefeitura": [a['score'] for a in analises if a['tipo_analise'] == 'Prefeitura'],
-        "Câmara": [a['score'] for a in analises if a['tipo_analise'] == 'Câmara']
-    }
-    media_prefeitura = sum(scores_por_tipo["Prefeitura"]) / len(scores_por_tipo["Prefeitura"]) if scores_por_tipo["Prefeitura"] else 0
-    media_camara = sum(scores_por_tipo["Câmara"]) / len(scores_por_tipo["Câmara"]) if scores_por_tipo["Câmara"] else 0
-    dados_grafico_medias = {"labels": ["Prefeitura", "Câmara"], "data": [media_prefeitura, media_camara]}
+
+    # Os gráficos refletem todas as análises do utilizador, não apenas a página atual.
+    selos, medias = db.resumo_analises_por_usuario(session['username'])
+    dados_grafico_selos = {"labels": [selo for selo, _ in selos], "data": [total for _, total in selos]}
+    dados_grafico_medias = {"labels": ["Prefeitura", "Câmara"], "data": [medias.get("Prefeitura", 0), medias.get("Câmara", 0)]}
     
-    return render_template('dashboard.html', analises=analises, dados_grafico_selos=dados_grafico_selos, dados_grafico_medias=dados_grafico_medias)
+    return com_etag(render_template('dashboard.html', analises=analises, dados_grafico_selos=dados_grafico_selos, dados_grafico_medias=dados_grafico_medias,
+                                    proxima_pagina=proxima_pagina, paginado=antes is not None), etag)
 
 @app.route('/admin/users')
 @admin_required
@@ -131,11 +176,70 @@ def delete_user(user_id):
     flash('Utilizador apagado com sucesso.', 'success')
     return redirect(url_for('admin_users'))
 
+
+def _filtros_analytics():
+    filtros = {'tipo_analise': request.args.get('tipo_analise') or None}
+    for campo in ('inicio', 'fim'):
+        valor = request.args.get(campo) or None
+        if valor:
+            # Levanta ValueError para datas fora do formato AAAA-MM-DD.
+            valor = datetime.strptime(valor, '%Y-%m-%d').strftime('%Y-%m-%d')
+        filtros[campo] = valor
+    return filtros
+
+@app.route('/admin/analytics')
+@admin_required
+def admin_analytics():
+    try:
+        filtros = _filtros_analytics()
+    except ValueError:
+        flash('Datas inválidas; use o formato AAAA-MM-DD.', 'danger')
+        filtros = {'tipo_analise': request.args.get('tipo_analise') or None, 'inicio': None, 'fim': None}
+    return render_template('admin_analytics.html', analytics=db.obter_analytics(**filtros), filtros=filtros)
+
+@app.route('/api/admin/analytics')
+@admin_required
+def api_admin_analytics():
+    try:
+        filtros = _filtros_analytics()
+    except ValueError:
+        return jsonify({'status': 'erro', 'mensagem': 'Datas inválidas; use o formato AAAA-MM-DD.'}), 400
+    return jsonify(db.obter_analytics(**filtros))
+
+def _listagem_admin(listar, coluna_data):
+    """Uma página de uma listagem de administração, com pesquisa, filtros e paginação por chave."""
+    try:
+        filtros = _filtros_analytics()
+    except ValueError:
+        flash('Datas inválidas; use o formato AAAA-MM-DD.', 'danger')
+        filtros = {'tipo_analise': request.args.get('tipo_analise') or None, 'inicio': None, 'fim': None}
+    filtros['busca'] = (request.args.get('q') or '').strip() or None
+    antes = None
+    if request.args.get('antes') and request.args.get('antes_id', type=int):
+        antes = (request.args['antes'], request.args.get('antes_id', type=int))
+    linhas = listar(limite=ADMIN_PAGE_SIZE + 1, antes=antes, **filtros)
+    proxima_pagina = None
+    if len(linhas) > ADMIN_PAGE_SIZE:
+        linhas = linhas[:ADMIN_PAGE_SIZE]
+        proxima_pagina = {'antes': linhas[-1][coluna_data], 'antes_id': linhas[-1]['id']}
+    # Os links de paginação mantêm a pesquisa e os filtros.
+    parametros = {'q': filtros['busca'], 'tipo_analise': filtros['tipo_analise'], 'inicio': filtros['inicio'], 'fim': filtros['fim']}
+    parametros = {chave: valor for chave, valor in parametros.items() if valor}
+    if proxima_pagina:
+        proxima_pagina.update(parametros)
+    return linhas, filtros, {'proxima_pagina': proxima_pagina, 'paginado': antes is not None, 'parametros': parametros}
+
 @app.route('/admin/reports')
 @admin_required
 def admin_reports():
-    reports = db.list_all_reports()
-    return render_template('admin_reports.html', reports=reports)
+    reports, filtros, paginacao = _listagem_admin(db.listar_relatorios_admin, 'data_geracao')
+    return render_template('admin_reports.html', reports=reports, filtros=filtros, cache_pdf=db.estatisticas_cache_pdf(), **paginacao)
+
+@app.route('/admin/analises')
+@admin_required
+def admin_analises():
+    analises, filtros, paginacao = _listagem_admin(db.listar_analises_admin, 'last_modified')
+    return render_template('admin_analises.html', analises=analises, filtros=filtros, **paginacao)
 
 @app.route('/analise/nova', methods=['POST'])
 @login_required
@@ -147,11 +251,21 @@ def nova_analise():
         flash('Todos os campos são obrigatórios.', 'danger')
         return redirect(url_for('dashboard'))
     analise_id, _ = db.carregar_ou_criar_analise(session['username'], site_url, site_nome, tipo_analise)
+    # Corre em segundo plano; as sugestões aparecem na página da análise quando ficarem prontas.
+    pre_verificacao.agendar(analise_id, site_url, tipo_analise)
     return redirect(url_for('pagina_analise', analise_id=analise_id))
 
 @app.route('/analise/<int:analise_id>', methods=['GET', 'POST'])
 @login_required
 def pagina_analise(analise_id):
+    etag = None
+    if request.method == 'GET':
+        # Verificado com uma consulta leve, antes de carregar as respostas.
+        estado = db.estado_analise(analise_id, session['username'])
+        etag = etag_pagina(estado) if estado else None
+        resposta = nao_modificada(etag) if etag else None
+        if resposta:
+            return resposta
     analise = db.obter_analise_por_id(analise_id, session['username'])
     if not analise:
         flash('Análise não encontrada.', 'danger')
@@ -161,21 +275,38 @@ def pagina_analise(analise_id):
         if 'imagem_justificativa' in request.files:
             file = request.files['imagem_justificativa']
             secao = request.form.get('secao')
-            if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                unique_filename = f"analise_{analise_id}_{secao.lower()}_{datetime.now().strftime('%Y%m%d%H%M%S')}{os.path.splitext(filename)[1]}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                file.save(filepath)
-                db.update_image_path(analise_id, secao, unique_filename)
-                flash('Imagem enviada com sucesso!', 'success')
+            if file and file.filename and allowed_file(file.filename) and secao in ('RECEITA', 'DESPESA'):
+                try:
+                    # O tipo real é validado pelo conteúdo; redimensionamento e miniatura são feitos em segundo plano.
+                    imagens.guardar_imagem_analise(app.config['UPLOAD_FOLDER'], analise_id, secao, file.read())
+                except imagens.ImagemInvalida as e:
+                    flash(f'Imagem rejeitada: {e}', 'warning')
+                else:
+                    flash('Imagem enviada com sucesso!', 'success')
                 return redirect(url_for('pagina_analise', analise_id=analise_id))
             else:
                 flash('Nenhum ficheiro selecionado ou tipo de ficheiro inválido (permitidos: png, jpg, jpeg, gif).', 'warning')
                 return redirect(url_for('pagina_analise', analise_id=analise_id))
 
-    matriz_completa = logic.carregar_criterios()
-    criterios_para_analise = matriz_completa.get(analise['tipo_analise'])
-    return render_template('analise.html', analise=analise, matriz=criterios_para_analise)
+    imagens_analise = {secao: url_for('miniatura_imagem', analise_id=analise_id, secao=secao)
+                       for secao in ('RECEITA', 'DESPESA') if analise.get(f'{secao.lower()}_img_path')}
+    resposta = render_template('analise.html', analise=analise, matriz_html=matriz_html(analise['tipo_analise']), imagens=imagens_analise)
+    return com_etag(resposta, etag) if etag else resposta
+
+@app.route('/analise/<int:analise_id>/imagem/<secao>/miniatura')
+@login_required
+def miniatura_imagem(analise_id, secao):
+    analise = db.obter_analise_por_id(analise_id, session['username'])
+    if not analise or secao not in ('RECEITA', 'DESPESA') or not analise.get(f'{secao.lower()}_img_path'):
+        return abort(404)
+    nome = analise[f'{secao.lower()}_img_path']
+    caminho = imagens.caminho_derivado(app.config['UPLOAD_FOLDER'], nome, 'miniatura')
+    if not os.path.exists(caminho):
+        # Ainda a ser gerada (ou imagem anterior ao pipeline): serve o original.
+        caminho = os.path.join(app.config['UPLOAD_FOLDER'], nome)
+    if not os.path.exists(caminho):
+        return abort(404)
+    return send_file(os.path.abspath(caminho), conditional=True, max_age=0)
 
 @app.route('/analise/<int:analise_id>/gerar_relatorio', methods=['POST'])
 @login_required
@@ -186,63 +317,101 @@ def gerar_relatorio_pdf(analise_id):
         return redirect(url_for('dashboard'))
 
     tipo_relatorio = request.form.get('tipo_relatorio', 'Relatório Completo')
-    matriz_completa = logic.carregar_criterios()
-    criterios_para_analise = matriz_completa.get(analise['tipo_analise'])
-    
-    matriz_a_usar = criterios_para_analise
-    if tipo_relatorio == "Apenas Pontos a Melhorar":
-        perguntas_filtradas = {}
-        for secao, perguntas in criterios_para_analise.items():
-            itens_nao_conformes = [item for item in perguntas if any(analise['respostas'].get(f"{secao}_{item['criterio']}_{sub}") == "Não Atende" for sub in item["subcriterios"])]
-            if itens_nao_conformes:
-                perguntas_filtradas[secao] = itens_nao_conformes
-        matriz_a_usar = perguntas_filtradas
-
-    resultados = logic.calcular_indice_e_selo(analise['respostas'], criterios_para_analise)
-    scores_secao = {secao: logic.calcular_pontuacao_secao(analise['respostas'], perguntas, secao) for secao, perguntas in criterios_para_analise.items()}
-    
-    image_paths = {}
-    if analise.get('receita_img_path'):
-        path = Path(app.config['UPLOAD_FOLDER'], analise['receita_img_path']).resolve()
-        image_paths['RECEITA'] = path.as_uri() if path.exists() else None
-    else:
-        image_paths['RECEITA'] = None
-    
-    if analise.get('despesa_img_path'):
-        path = Path(app.config['UPLOAD_FOLDER'], analise['despesa_img_path']).resolve()
-        image_paths['DESPESA'] = path.as_uri() if path.exists() else None
-    else:
-        image_paths['DESPESA'] = None
-
-    html_string = render_template('relatorio_template.html', 
-        site_nome=analise.get('site_nome', analise['site_url']),
-        site_url=analise['site_url'],
-        respostas=analise['respostas'],
-        resultados=resultados,
-        nome_usuario=session['username'],
-        data_geracao=datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
-        matriz_a_usar=matriz_a_usar,
-        scores_secao=scores_secao,
-        image_paths=image_paths
-    )
-    
-    nome_arquivo, dados_pdf = logic.gerar_relatorio_com_weasyprint(html_string, analise['site_url'], base_url=request.url_root)
-    
-    if nome_arquivo and dados_pdf:
-        db.salvar_relatorio_db(analise_id, nome_arquivo, dados_pdf)
+    html_sem_data, caminhos_imagens = relatorios_lote.montar_relatorio(analise, tipo_relatorio, app.config['UPLOAD_FOLDER'])
+
+    # Se um PDF com exatamente o mesmo conteúdo já foi gerado, reutiliza-o em vez de o renderizar de novo.
+    digest = logic.digest_relatorio(html_sem_data, caminhos_imagens, tipo_relatorio, request.url_root)
+    em_cache = db.obter_pdf_em_cache(digest)
+    if em_cache:
+        relatorio_id = db.salvar_relatorio_db(analise_id, logic.nome_arquivo_relatorio(analise['site_url']), sha256=em_cache['sha256'], tamanho=em_cache['tamanho'])
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'estado': 'concluido', 'download_url': url_for('download_relatorio', relatorio_id=relatorio_id)})
         flash('Relatório gerado com sucesso!', 'success')
         return redirect(url_for('dashboard'))
-    else:
-        flash('Ocorreu um erro ao gerar o relatório.', 'danger')
-        return redirect(url_for('pagina_analise', analise_id=analise_id))
+
+    html_string = html_sem_data.replace(logic.MARCADOR_DATA_GERACAO, datetime.now().strftime('%d/%m/%Y %H:%M:%S'))
+    
+    # A renderização do PDF é feita em segundo plano; o cliente acompanha o job pelo endpoint de estado.
+    job_id = fila_relatorios.enfileirar(analise_id, session['username'], tipo_relatorio, analise['site_url'], request.url_root, html_string, digest)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'job_id': job_id, 'estado': 'pendente', 'status_url': url_for('estado_job_relatorio', job_id=job_id)}), 202
+    flash('O relatório está a ser gerado. Ficará disponível no painel dentro de momentos.', 'info')
+    return redirect(url_for('dashboard'))
+
+@app.route('/api/relatorio/job/<int:job_id>')
+@login_required
+def estado_job_relatorio(job_id):
+    job = db.obter_job_relatorio(job_id, session['username'])
+    if not job:
+        return jsonify({'status': 'erro', 'mensagem': 'Job não encontrado.'}), 404
+    resposta = {'job_id': job['id'], 'estado': job['estado']}
+    if job['estado'] == 'concluido':
+        resposta['download_url'] = url_for('download_relatorio', relatorio_id=job['relatorio_id'])
+    elif job['estado'] == 'erro':
+        resposta['mensagem'] = 'Ocorreu um erro ao gerar o relatório.'
+    return jsonify(resposta)
+
+@app.route('/api/relatorio/job/<int:job_id>/cancelar', methods=['POST'])
+@login_required
+def cancelar_job_relatorio(job_id):
+    if db.cancelar_job_relatorio(job_id, session['username']):
+        return jsonify({'job_id': job_id, 'estado': 'cancelado'})
+    return jsonify({'status': 'erro', 'mensagem': 'O job já terminou ou não existe.'}), 409
 
 @app.route('/relatorio/<int:relatorio_id>/download')
 @login_required
 def download_relatorio(relatorio_id):
     report_data = db.get_report_data_by_id(relatorio_id)
-    if not report_data:
+    if not report_data or not report_data['sha256']:
         return abort(404)
-    return send_file(io.BytesIO(report_data['dados_pdf']), mimetype='application/pdf', as_attachment=True, download_name=report_data['nome_arquivo'])
+    caminho = os.path.abspath(db.caminho_pdf(report_data['sha256']))
+    if not os.path.exists(caminho):
+        return abort(404)
+    # Servido a partir do ficheiro: o servidor usa sendfile e o werkzeug trata de ETag, If-None-Match e Range.
+    data_geracao = datetime.strptime(report_data['data_geracao'].split('.')[0], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    return send_file(caminho, mimetype='application/pdf', as_attachment=True, download_name=report_data['nome_arquivo'],
+                     conditional=True, etag=report_data['sha256'], last_modified=data_geracao)
+
+@app.route('/api/relatorios/lote', methods=['POST'])
+@login_required
+def gerar_relatorios_lote():
+    dados = request.get_json(silent=True) or request.form
+    tipo_relatorio = dados.get('tipo_relatorio', 'Relatório Completo')
+    # Só administradores podem exportar análises de outros utilizadores.
+    username = dados.get('username') if session.get('is_admin') else session['username']
+    try:
+        ids = dados.get('ids')
+        if isinstance(ids, str):
+            ids = ids.replace(',', ' ').split()
+        if ids:
+            ids = [int(i) for i in ids]
+        else:
+            filtros = {campo: dados.get(campo) or None for campo in ('tipo_analise', 'inicio', 'fim')}
+            for campo in ('inicio', 'fim'):
+                if filtros[campo]:
+                    datetime.strptime(filtros[campo], '%Y-%m-%d')
+            ids = db.listar_ids_analises(username=username, **filtros)
+    except (TypeError, ValueError):
+        return jsonify({'status': 'erro', 'mensagem': 'Pedido inválido.'}), 400
+    if not ids:
+        return jsonify({'status': 'erro', 'mensagem': 'Nenhuma análise corresponde ao pedido.'}), 404
+
+    if not relatorios_lote.reservar_lote():
+        return jsonify({'status': 'erro', 'mensagem': 'Já está a ser gerado um lote de relatórios. Tente de novo dentro de alguns minutos.'}), 429
+    # O ZIP é enviado à medida que cada PDF fica pronto; o estado de cada análise vai no manifesto.json.
+    # Os PDFs são renderizados no pool da fila de relatórios, que já limita os processos deste worker.
+    try:
+        gerador = relatorios_lote.gerar_zip(ids, tipo_relatorio, request.url_root, app.config['UPLOAD_FOLDER'], username,
+                                            workers=fila_relatorios.PDF_WORKERS, executor=fila_relatorios.executor())
+        nome_zip = f"Relatorios_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        resposta = Response(stream_with_context(gerador), mimetype='application/zip',
+                            headers={'Content-Disposition': f'attachment; filename="{nome_zip}"'})
+    except Exception:
+        relatorios_lote.libertar_lote()
+        raise
+    # Chamado pelo servidor quando a resposta termina, também se o cliente desistir antes do primeiro bloco.
+    resposta.call_on_close(relatorios_lote.libertar_lote)
+    return resposta
 
 @app.route('/analise/<int:analise_id>/apagar', methods=['POST'])
 @login_required
@@ -259,11 +428,58 @@ def delete_analise(analise_id):
 def salvar_progresso(analise_id):
     respostas = request.json
     try:
-        db.salvar_progresso(analise_id, respostas)
-        return jsonify({'status': 'sucesso', 'mensagem': 'Progresso salvo!'})
+        revisao = db.salvar_progresso(analise_id, respostas)
+        if revisao is None:
+            return jsonify({'status': 'erro', 'mensagem': 'Análise não encontrada.'}), 404
+        return jsonify({'status': 'sucesso', 'mensagem': 'Progresso salvo!', 'revisao': revisao})
     except Exception as e:
         return jsonify({'status': 'erro', 'mensagem': 'Falha ao salvar.'}), 500
 
+@app.route('/api/analise/<int:analise_id>/delta', methods=['POST'])
+@login_required
+def salvar_delta(analise_id):
+    dados = request.get_json(silent=True) or {}
+    revisao, alteracoes = dados.get('revisao'), dados.get('alteracoes')
+    if not isinstance(revisao, int) or not isinstance(alteracoes, dict):
+        return jsonify({'status': 'erro', 'mensagem': 'Pedido inválido.'}), 400
+    try:
+        resultado = db.aplicar_delta(analise_id, session['username'], revisao, alteracoes)
+    except Exception as e:
+        return jsonify({'status': 'erro', 'mensagem': 'Falha ao salvar.'}), 500
+    if resultado is None:
+        return jsonify({'status': 'erro', 'mensagem': 'Análise não encontrada.'}), 404
+    aplicado, revisao_atual = resultado
+    if not aplicado:
+        return jsonify({'status': 'conflito', 'mensagem': 'A análise foi alterada noutro separador.', 'revisao': revisao_atual}), 409
+    return jsonify({'status': 'sucesso', 'mensagem': 'Progresso salvo!', 'revisao': revisao_atual})
+
+@app.route('/api/analise/<int:analise_id>/sugestoes', methods=['GET', 'POST'])
+@login_required
+def sugestoes_analise(analise_id):
+    if request.method == 'POST':
+        analise = db.obter_analise_por_id(analise_id, session['username'])
+        if not analise:
+            return jsonify({'status': 'erro', 'mensagem': 'Análise não encontrada.'}), 404
+        if not pre_verificacao.agendar(analise_id, analise['site_url'], analise['tipo_analise'], repetir=True):
+            return jsonify({'status': 'erro', 'mensagem': 'A verificação já está a decorrer ou está desligada.'}), 409
+    verificacao = db.obter_verificacao_site(analise_id, session['username'])
+    if verificacao is None:
+        return jsonify({'status': 'erro', 'mensagem': 'Análise não encontrada.'}), 404
+    return jsonify(verificacao)
+
+@app.route('/health/live')
+def health_live():
+    return jsonify({'status': 'ok'})
+
+@app.route('/health/ready')
+def health_ready():
+    # O balanceador só deve enviar pedidos a workers com critérios, templates e WeasyPrint já aquecidos.
+    estado = aquecimento.estado()
+    return jsonify(estado), (200 if estado['pronto'] else 503)
+
+# Com gunicorn --preload isto corre uma vez no mestre e os workers herdam o resultado.
+aquecimento.aquecer_aplicacao(app, matriz_html)
+
 if __name__ == '__main__':
     # Cria a pasta de uploads se ela não existir
     if not os.path.exists(UPLOAD_FOLDER):
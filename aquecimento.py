@@ -0,0 +1,84 @@
+import logging
+import os
+import threading
+import time
+
+import db
+import fila_relatorios
+import logic
+
+logger = logging.getLogger(__name__)
+
+# 'aplicacao' é herdado pelos workers quando o aquecimento corre no mestre (gunicorn --preload);
+# o resto é por processo.
+_estado = {'aplicacao': None, 'pid': None, 'pdf': None, 'erro': False, 'repontuacao': None}
+_lock = threading.Lock()
+_repontuar = threading.Event()
+# Enquanto o WeasyPrint falhar, o worker não fica pronto e o aquecimento é repetido a este intervalo.
+INTERVALO_NOVA_TENTATIVA = 30
+# Entre lotes da repontuação, para que as gravações dos utilizadores não fiquem à espera dela.
+PAUSA_REPONTUACAO = 0.1
+
+def aquecer_aplicacao(app, renderizar_matriz):
+    """Trabalho partilhado por todos os workers: critérios compilados, templates e fragmentos da matriz.
+
+    Chamar depois de db.init_db(); com gunicorn --preload corre uma única vez, no processo mestre.
+    """
+    inicio = time.perf_counter()
+    catalogo = logic.catalogo()
+    for nome in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(nome)
+    with app.app_context():
+        for tipo_analise in catalogo.criterios:
+            renderizar_matriz(tipo_analise)
+    # Cada processo abre a sua ligação; a do mestre não deve ser herdada pelos workers.
+    db.close_connection()
+    _estado['aplicacao'] = time.perf_counter() - inicio
+
+def _aquecer_pdf():
+    inicio = time.perf_counter()
+    while True:
+        try:
+            fila_relatorios.aquecer()
+            break
+        except Exception:
+            if not _estado['erro']:
+                logger.exception("Falha ao aquecer a renderização de PDFs; nova tentativa a cada %s s.", INTERVALO_NOVA_TENTATIVA)
+            _estado['erro'] = True
+        time.sleep(INTERVALO_NOVA_TENTATIVA)
+    _estado['erro'] = False
+    _estado['pdf'] = time.perf_counter() - inicio
+
+def aquecer_worker():
+    """Arranca (uma vez por processo) a fila de relatórios e aquece os processos de renderização em segundo plano."""
+    with _lock:
+        if _estado['pid'] == os.getpid():
+            return
+        _estado['pid'] = os.getpid()
+        _estado['pdf'] = None
+        _estado['erro'] = False
+    threading.Thread(target=_aquecer_pdf, name='aquecimento-pdf', daemon=True).start()
+
+def _repontuar_criterios():
+    while True:
+        _repontuar.wait()
+        _repontuar.clear()
+        try:
+            db.repontuar_desatualizadas(pausa=PAUSA_REPONTUACAO)
+        except Exception:
+            logger.exception("Falha ao voltar a pontuar as análises depois de uma mudança nos critérios.")
+
+def repontuar_em_segundo_plano():
+    """Volta a pontuar, numa thread deste processo, as análises afetadas por uma mudança nos critérios."""
+    _repontuar.set()
+    with _lock:
+        if _estado['repontuacao'] == os.getpid():
+            return
+        _estado['repontuacao'] = os.getpid()
+    threading.Thread(target=_repontuar_criterios, name='repontuacao', daemon=True).start()
+
+def estado():
+    """Só o que o balanceador precisa: o pedido de prontidão não tem autenticação; os detalhes de uma falha vão para o log."""
+    pronto = (_estado['aplicacao'] is not None and _estado['pid'] == os.getpid()
+              and _estado['pdf'] is not None and not _estado['erro'])
+    return {'pronto': pronto, 'erro': _estado['erro']}
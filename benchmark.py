@@ -0,0 +1,218 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import db
+import gerar_dados
+import logic
+
+# Variação relativa tolerada antes de uma métrica contar como regressão.
+LIMITE_REGRESSAO = 0.10
+
+def _percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(int(len(ordenados) * p), len(ordenados) - 1)]
+
+def _latencias(cliente, url, repeticoes):
+    cliente.get(url)  # aquece templates e caches antes de medir
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        resposta = cliente.get(url)
+        tempos.append((time.perf_counter() - inicio) * 1000)
+        if resposta.status_code != 200:
+            raise RuntimeError(f"{url} devolveu {resposta.status_code}")
+    return tempos
+
+def _metrica(valor, unidade, melhor):
+    return {'valor': round(valor, 4), 'unidade': unidade, 'melhor': melhor}
+
+def _entrar(app, username):
+    cliente = app.test_client()
+    resposta = cliente.post('/login', data={'username': username, 'password': gerar_dados.SENHA_PADRAO})
+    if resposta.status_code != 302:
+        raise RuntimeError(f"Login de {username} falhou.")
+    return cliente
+
+def medir_pontuacao(criadas, repeticoes):
+    matriz = logic.carregar_criterios()
+    amostra = [(db.obter_analise_por_id(analise_id)['respostas'], tipo) for _, analise_id, tipo in criadas[:200]]
+    inicio = time.perf_counter()
+    for i in range(repeticoes):
+        respostas, tipo = amostra[i % len(amostra)]
+        logic.calcular_indice_e_selo(respostas, matriz[tipo])
+    por_segundo = repeticoes / (time.perf_counter() - inicio)
+
+    por_tipo = {}
+    for respostas, tipo in amostra:
+        por_tipo.setdefault(tipo, []).append(respostas)
+    inicio = time.perf_counter()
+    total = 0
+    while total < repeticoes:
+        for tipo, lista in por_tipo.items():
+            logic.pontuar_analises(lista, tipo)
+            total += len(lista)
+    lote_por_segundo = total / (time.perf_counter() - inicio)
+    return {
+        'pontuacao.calcular_indice_e_selo_por_s': _metrica(por_segundo, 'análises/s', 'maior'),
+        'pontuacao.pontuar_analises_por_s': _metrica(lote_por_segundo, 'análises/s', 'maior'),
+    }
+
+def medir_paginas(app, criadas, repeticoes):
+    username, analise_id, _ = criadas[0]
+    cliente = _entrar(app, username)
+    metricas = {}
+    for nome, url in (('dashboard', '/'), ('pagina_analise', f'/analise/{analise_id}')):
+        tempos = _latencias(cliente, url, repeticoes)
+        metricas[f'{nome}.p50_ms'] = _metrica(_percentil(tempos, 0.5), 'ms', 'menor')
+        metricas[f'{nome}.p95_ms'] = _metrica(_percentil(tempos, 0.95), 'ms', 'menor')
+    return metricas
+
+def medir_autosave(app, criadas, escritores, duracao):
+    matriz = logic.carregar_criterios()
+    por_usuario = {}
+    for username, analise_id, tipo in criadas:
+        por_usuario.setdefault(username, []).append((analise_id, tipo))
+    usuarios = list(por_usuario)[:escritores]
+    contagens = {'gravacoes': 0, 'conflitos': 0, 'erros': 0}
+    lock = threading.Lock()
+    fim = time.perf_counter() + duracao
+
+    def escritor(indice, username):
+        rng = random.Random(indice)
+        cliente = _entrar(app, username)
+        revisoes = {}
+        while time.perf_counter() < fim:
+            analise_id, tipo = rng.choice(por_usuario[username])
+            if analise_id not in revisoes:
+                revisoes[analise_id] = db.obter_analise_por_id(analise_id)['revisao']
+            secao = rng.choice(list(matriz[tipo]))
+            item = rng.choice(matriz[tipo][secao])
+            chave = f"{secao}_{item['criterio']}_{rng.choice(item['subcriterios'])}"
+            resposta = cliente.post(f'/api/analise/{analise_id}/delta',
+                                    json={'revisao': revisoes[analise_id], 'alteracoes': {chave: rng.choice(["Atende", logic.NAO_ATENDE])}})
+            dados = resposta.get_json() or {}
+            revisoes[analise_id] = dados.get('revisao', revisoes[analise_id])
+            resultado = {200: 'gravacoes', 409: 'conflitos'}.get(resposta.status_code, 'erros')
+            with lock:
+                contagens[resultado] += 1
+
+    threads = [threading.Thread(target=escritor, args=(i, u)) for i, u in enumerate(usuarios)]
+    inicio = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    decorrido = time.perf_counter() - inicio
+    return {
+        'autosave.gravacoes_por_s': _metrica(contagens['gravacoes'] / decorrido, 'gravações/s', 'maior'),
+        'autosave.erros': _metrica(contagens['erros'], 'pedidos', 'menor'),
+    }
+
+def medir_weasyprint(app, criadas, repeticoes):
+    import relatorios_lote
+    try:
+        from weasyprint import HTML
+    except (ImportError, OSError) as e:
+        print(f"WeasyPrint indisponível, medição ignorada: {e}")
+        return {}
+    _, analise_id, _ = criadas[0]
+    with app.app_context():
+        html_sem_data, _ = relatorios_lote.montar_relatorio(db.obter_analise_por_id(analise_id), 'Relatório Completo', app.config['UPLOAD_FOLDER'])
+    html_string = html_sem_data.replace(logic.MARCADOR_DATA_GERACAO, datetime.now().strftime('%d/%m/%Y %H:%M:%S'))
+    tempos, tamanho = [], 0
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        tamanho = len(HTML(string=html_string, base_url=os.getcwd()).write_pdf())
+        tempos.append((time.perf_counter() - inicio) * 1000)
+    return {
+        'weasyprint.render_ms': _metrica(_percentil(tempos, 0.5), 'ms', 'menor'),
+        'weasyprint.tamanho_kb': _metrica(tamanho / 1024, 'KB', 'menor'),
+    }
+
+def comparar(atual, referencia, limite):
+    """Devolve as métricas que pioraram mais do que `limite` em relação à referência."""
+    regressoes = []
+    for nome, metrica in atual['metricas'].items():
+        base = referencia['metricas'].get(nome)
+        if not base or not base['valor']:
+            continue
+        variacao = (metrica['valor'] - base['valor']) / base['valor']
+        piorou = variacao > limite if metrica['melhor'] == 'menor' else variacao < -limite
+        print(f"{'REGRESSÃO' if piorou else 'ok':>9}  {nome:<45} {base['valor']:>12.2f} -> {metrica['valor']:>12.2f} {metrica['unidade']} ({variacao:+.1%})")
+        if piorou:
+            regressoes.append(nome)
+    return regressoes
+
+def _commit_atual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Mede o desempenho das partes críticas da aplicação numa base de dados sintética.")
+    parser.add_argument('--usuarios', type=int, default=10)
+    parser.add_argument('--analises-por-usuario', type=int, default=20)
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--repeticoes', type=int, default=50, help="Pedidos por página medida e renderizações de PDF (÷10).")
+    parser.add_argument('--escritores', type=int, default=4, help="Threads a gravar em simultâneo no teste de autosave.")
+    parser.add_argument('--duracao-autosave', type=float, default=5.0, help="Segundos do teste de autosave.")
+    parser.add_argument('--saida', default='benchmark.json', help="Ficheiro JSON com os resultados.")
+    parser.add_argument('--referencia', help="JSON de uma execução anterior para comparação.")
+    parser.add_argument('--limite', type=float, default=LIMITE_REGRESSAO, help="Piora relativa tolerada (0.10 = 10%%).")
+    parser.add_argument('--sem-pdf', action='store_true', help="Não mede a renderização com WeasyPrint.")
+    args = parser.parse_args()
+
+    saida = os.path.abspath(args.saida)
+    referencia = os.path.abspath(args.referencia) if args.referencia else None
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    with tempfile.TemporaryDirectory() as pasta:
+        # A aplicação é importada só depois de apontar para a base temporária (app.py inicializa a BD ao importar).
+        db.DB_NAME = os.path.join(pasta, 'bench.db')
+        inicio = time.perf_counter()
+        criadas = gerar_dados.popular(args.usuarios, args.analises_por_usuario, semente=args.semente)
+        geracao = time.perf_counter() - inicio
+        from app import app
+
+        metricas = {'geracao.analises_por_s': _metrica(len(criadas) / geracao, 'análises/s', 'maior')}
+        metricas.update(medir_pontuacao(criadas, args.repeticoes * 20))
+        metricas.update(medir_paginas(app, criadas, args.repeticoes))
+        metricas.update(medir_autosave(app, criadas, args.escritores, args.duracao_autosave))
+        if not args.sem_pdf:
+            metricas.update(medir_weasyprint(app, criadas, max(args.repeticoes // 10, 1)))
+        db.close_connection()
+
+    resultado = {
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'commit': _commit_atual(),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'parametros': {k: v for k, v in vars(args).items() if k not in ('saida', 'referencia')},
+        'metricas': metricas,
+    }
+    with open(saida, 'w', encoding='utf-8') as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    print(f"Resultados gravados em '{saida}'.")
+
+    if referencia:
+        with open(referencia, encoding='utf-8') as f:
+            regressoes = comparar(resultado, json.load(f), args.limite)
+        if regressoes:
+            print(f"{len(regressoes)} métrica(s) pioraram mais de {args.limite:.0%}.")
+            sys.exit(1)
+    else:
+        for nome, metrica in metricas.items():
+            print(f"{nome:<45} {metrica['valor']:>12.2f} {metrica['unidade']}")
+
+if __name__ == '__main__':
+    main()
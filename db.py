@@ -1,13 +1,108 @@
+import hashlib
+import os
+import re
 import sqlite3
+import tempfile
 import json
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
+import logic
+import metricas
+
 DB_NAME = "analises.db"
+# Os PDFs ficam fora da base de dados, guardados pelo SHA-256 do conteúdo.
+RELATORIOS_DIR = os.environ.get('RELATORIOS_DIR', 'relatorios')
+# Tamanho máximo ocupado pelos PDFs em cache antes de se descartarem os menos usados.
+CACHE_PDF_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_BYTES', 256 * 1024 * 1024))
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME, timeout=15)
+# Cada thread (e cada processo, depois de um fork do gunicorn) mantém a sua
+# própria ligação, aberta uma única vez e reutilizada por todas as funções.
+_local = threading.local()
+
+def _configurar_conexao(conn):
+    # Só tem efeito numa base nova ou no próximo VACUUM (ver manutencao.py --vacuum-completo).
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute("PRAGMA busy_timeout = 15000;")
+
+def get_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid() or _local.db_name != DB_NAME:
+        conn = sqlite3.connect(DB_NAME, timeout=15, cached_statements=256)
+        _configurar_conexao(conn)
+        metricas.contar_conexao()
+        _local.conn = conn
+        _local.pid = os.getpid()
+        _local.db_name = DB_NAME
+    return conn
+
+def close_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+    _local.conn = None
+
+@contextmanager
+def transacao(row_factory=None, imediata=False):
+    conn = get_connection()
+    metricas.contar_transacao()
     cursor = conn.cursor()
-    cursor.execute("PRAGMA foreign_keys = ON;")
+    if row_factory:
+        cursor.row_factory = row_factory
+    try:
+        if imediata:
+            # O lock de escrita é pedido já: o que for lido antes da primeira escrita (p. ex. a contribuição
+            # da análise para os rollups) não pode ser alterado por outra ligação até ao commit.
+            cursor.execute("BEGIN IMMEDIATE")
+        yield cursor
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+def init_db():
+    with transacao() as cursor:
+        _criar_esquema(cursor)
+    sincronizar_catalogo()
+    repontuar_desatualizadas()
+    if _migrar_pdfs_para_ficheiros():
+        # Devolve ao sistema de ficheiros o espaço que os BLOBs ocupavam.
+        get_connection().execute("VACUUM")
+
+# Mantêm os índices FTS5 (content=) iguais às tabelas de origem.
+_TRIGGERS_BUSCA = [
+    """CREATE TRIGGER IF NOT EXISTS busca_analises_ai AFTER INSERT ON analises BEGIN
+        INSERT INTO busca_analises (rowid, site_nome, site_url, username) VALUES (new.id, new.site_nome, new.site_url, new.username);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS busca_analises_ad AFTER DELETE ON analises BEGIN
+        INSERT INTO busca_analises (busca_analises, rowid, site_nome, site_url, username) VALUES ('delete', old.id, old.site_nome, old.site_url, old.username);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS busca_analises_au AFTER UPDATE OF site_nome, site_url, username ON analises
+    WHEN old.site_nome IS NOT new.site_nome OR old.site_url IS NOT new.site_url OR old.username IS NOT new.username BEGIN
+        INSERT INTO busca_analises (busca_analises, rowid, site_nome, site_url, username) VALUES ('delete', old.id, old.site_nome, old.site_url, old.username);
+        INSERT INTO busca_analises (rowid, site_nome, site_url, username) VALUES (new.id, new.site_nome, new.site_url, new.username);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS busca_relatorios_ai AFTER INSERT ON relatorios BEGIN
+        INSERT INTO busca_relatorios (rowid, nome_arquivo) VALUES (new.id, new.nome_arquivo);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS busca_relatorios_ad AFTER DELETE ON relatorios BEGIN
+        INSERT INTO busca_relatorios (busca_relatorios, rowid, nome_arquivo) VALUES ('delete', old.id, old.nome_arquivo);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS busca_relatorios_au AFTER UPDATE OF nome_arquivo ON relatorios
+    WHEN old.nome_arquivo IS NOT new.nome_arquivo BEGIN
+        INSERT INTO busca_relatorios (busca_relatorios, rowid, nome_arquivo) VALUES ('delete', old.id, old.nome_arquivo);
+        INSERT INTO busca_relatorios (rowid, nome_arquivo) VALUES (new.id, new.nome_arquivo);
+    END""",
+]
+
+def _criar_esquema(cursor):
     cursor.execute('''CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL, password_hash TEXT NOT NULL, is_admin INTEGER NOT NULL DEFAULT 0)''')
     cursor.execute('''CREATE TABLE IF NOT EXISTS analises (
         id INTEGER PRIMARY KEY AUTOINCREMENT, 
@@ -18,8 +113,18 @@ def init_db():
         respostas TEXT, 
         last_modified TIMESTAMP, 
         receita_img_path TEXT, 
-        despesa_img_path TEXT
+        despesa_img_path TEXT,
+        indice REAL,
+        selo TEXT,
+        percentual_essenciais REAL,
+        scores_secao TEXT,
+        revisao INTEGER NOT NULL DEFAULT 0,
+        versao_criterios TEXT
     )''')
+    for coluna, definicao in [('receita_img_path', 'TEXT'), ('despesa_img_path', 'TEXT'), ('indice', 'REAL'),
+                              ('selo', 'TEXT'), ('percentual_essenciais', 'REAL'), ('scores_secao', 'TEXT'),
+                              ('revisao', 'INTEGER NOT NULL DEFAULT 0'), ('versao_criterios', 'TEXT')]:
+        _adicionar_coluna(cursor, 'analises', coluna, definicao)
     try:
         cursor.execute('CREATE UNIQUE INDEX idx_user_url_tipo ON analises (username, site_url, tipo_analise)')
     except sqlite3.OperationalError:
@@ -32,8 +137,394 @@ def init_db():
         data_geracao TIMESTAMP DEFAULT CURRENT_TIMESTAMP, 
         FOREIGN KEY(analise_id) REFERENCES analises(id) ON DELETE CASCADE
     )''')
-    conn.commit()
-    conn.close()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS jobs_relatorio (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        analise_id INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        tipo_relatorio TEXT,
+        site_url TEXT,
+        base_url TEXT,
+        html TEXT,
+        estado TEXT NOT NULL DEFAULT 'pendente',
+        relatorio_id INTEGER,
+        erro TEXT,
+        criado_em TIMESTAMP,
+        atualizado_em TIMESTAMP,
+        FOREIGN KEY(analise_id) REFERENCES analises(id) ON DELETE CASCADE
+    )''')
+    _adicionar_coluna(cursor, 'jobs_relatorio', 'digest', 'TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_relatorio_estado ON jobs_relatorio (estado, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_relatorio_analise ON jobs_relatorio (analise_id, estado)')
+    _adicionar_coluna(cursor, 'relatorios', 'sha256', 'TEXT')
+    _adicionar_coluna(cursor, 'relatorios', 'tamanho', 'INTEGER')
+    _adicionar_coluna(cursor, 'relatorios', 'versao_criterios', 'TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_relatorios_sha256 ON relatorios (sha256)')
+    if 'dados_pdf' in [linha[1] for linha in cursor.execute("PRAGMA table_info(cache_pdf)")]:
+        # A cache guardava os PDFs inteiros; agora só aponta para o ficheiro. É seguro descartá-la.
+        cursor.execute("DROP TABLE cache_pdf")
+    cursor.execute('''CREATE TABLE IF NOT EXISTS cache_pdf (
+        digest TEXT PRIMARY KEY,
+        sha256 TEXT NOT NULL,
+        tamanho INTEGER NOT NULL,
+        tempo_render REAL NOT NULL DEFAULT 0,
+        criado_em TIMESTAMP,
+        ultimo_acesso TIMESTAMP
+    )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cache_pdf_acesso ON cache_pdf (ultimo_acesso)')
+    cursor.execute('CREATE TABLE IF NOT EXISTS cache_pdf_estatisticas (chave TEXT PRIMARY KEY, valor REAL NOT NULL DEFAULT 0)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_relatorios_analise_data ON relatorios (analise_id, data_geracao)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_relatorios_data ON relatorios (data_geracao)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_analises_user_modified ON analises (username, last_modified, id)')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS criterios (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        secao TEXT NOT NULL,
+        criterio TEXT NOT NULL,
+        UNIQUE (secao, criterio)
+    )''')
+    # Uma linha por subcritério respondido; status 0 = Atende, 1 = Não Atende (ver logic.STATUS_CODIGOS).
+    cursor.execute('''CREATE TABLE IF NOT EXISTS respostas (
+        analise_id INTEGER NOT NULL,
+        criterio_id INTEGER NOT NULL,
+        subcriterio TEXT NOT NULL,
+        status INTEGER,
+        observacao TEXT,
+        link TEXT,
+        PRIMARY KEY (analise_id, criterio_id, subcriterio),
+        FOREIGN KEY(analise_id) REFERENCES analises(id) ON DELETE CASCADE,
+        FOREIGN KEY(criterio_id) REFERENCES criterios(id)
+    ) WITHOUT ROWID''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_respostas_criterio ON respostas (criterio_id, subcriterio, status)')
+    _sincronizar_criterios(cursor)
+    # Agregados para /admin/analytics, mantidos incrementalmente a cada gravação (ver _atualizar_rollups).
+    cursor.execute('''CREATE TABLE IF NOT EXISTS rollup_analises (
+        tipo_analise TEXT NOT NULL, dia TEXT NOT NULL, selo TEXT NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0, soma_indice REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (tipo_analise, dia, selo)
+    ) WITHOUT ROWID''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS rollup_secoes (
+        tipo_analise TEXT NOT NULL, dia TEXT NOT NULL, secao TEXT NOT NULL, faixa INTEGER NOT NULL,
+        total INTEGER NOT NULL DEFAULT 0, soma_score REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (tipo_analise, dia, secao, faixa)
+    ) WITHOUT ROWID''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS rollup_criterios (
+        tipo_analise TEXT NOT NULL, dia TEXT NOT NULL, criterio_id INTEGER NOT NULL,
+        falhas INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (tipo_analise, dia, criterio_id)
+    ) WITHOUT ROWID''')
+    versao = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if versao < 1:
+        _normalizar_respostas(cursor)
+    if versao < 2:
+        _reconstruir_rollups(cursor)
+        cursor.execute("PRAGMA user_version = 2")
+    # Cada versão dos critérios de cada tipo fica registada; as análises guardam a versão com que foram pontuadas.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS criterios_versoes (
+        tipo_analise TEXT NOT NULL, versao TEXT NOT NULL, conteudo TEXT NOT NULL, registada_em TIMESTAMP NOT NULL,
+        PRIMARY KEY (tipo_analise, versao)
+    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_analises_tipo_versao ON analises (tipo_analise, versao_criterios)")
+    # Pré-verificação automática do site (pre_verificacao.py): respostas sugeridas que o analista confirma.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS verificacoes_site (
+        analise_id INTEGER PRIMARY KEY,
+        estado TEXT NOT NULL,
+        erro TEXT,
+        paginas TEXT,
+        atualizada_em TIMESTAMP,
+        FOREIGN KEY(analise_id) REFERENCES analises(id) ON DELETE CASCADE
+    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sugestoes (
+        analise_id INTEGER NOT NULL,
+        chave TEXT NOT NULL,
+        valor TEXT NOT NULL,
+        evidencia TEXT,
+        link TEXT,
+        PRIMARY KEY (analise_id, chave),
+        FOREIGN KEY(analise_id) REFERENCES analises(id) ON DELETE CASCADE
+    ) WITHOUT ROWID''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_analises_modified ON analises (last_modified, id)')
+    # Pesquisa das páginas de administração: índices FTS5 sobre as próprias tabelas, mantidos por triggers.
+    cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS busca_analises USING fts5 (
+        site_nome, site_url, username, content='analises', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )''')
+    cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS busca_relatorios USING fts5 (
+        nome_arquivo, content='relatorios', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )''')
+    for trigger in _TRIGGERS_BUSCA:
+        cursor.execute(trigger)
+    if versao < 3:
+        # Bases anteriores aos índices de pesquisa: indexa-se o que já existe.
+        cursor.execute("INSERT INTO busca_analises (busca_analises) VALUES ('rebuild')")
+        cursor.execute("INSERT INTO busca_relatorios (busca_relatorios) VALUES ('rebuild')")
+        cursor.execute("PRAGMA user_version = 3")
+    if versao < 4:
+        _corrigir_nao_iniciadas(cursor)
+        cursor.execute("PRAGMA user_version = 4")
+    if versao < 5:
+        _aplicar_autosaves_pendentes(cursor)
+        cursor.execute("PRAGMA user_version = 5")
+
+def _adicionar_coluna(cursor, tabela, coluna, definicao):
+    colunas = [linha[1] for linha in cursor.execute(f"PRAGMA table_info({tabela})")]
+    if coluna not in colunas:
+        cursor.execute(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {definicao}")
+
+def _colunas_pontuacao(resultado, tipo_analise):
+    versao = logic.versao_tipo(tipo_analise)
+    if not resultado:
+        return None, None, None, None, versao
+    return resultado['indice'], resultado['selo'], resultado['percentual_essenciais'], json.dumps(resultado['scores_secao']), versao
+
+# (secção, critério) -> id na tabela `criterios`, por base de dados. Os ids nunca mudam depois de atribuídos.
+_ids_criterios = {}
+
+def _sincronizar_criterios(cursor):
+    pares = sorted({(secao, criterio) for secao, criterio, _, _ in logic.mapa_chaves_respostas().values()})
+    cursor.executemany("INSERT OR IGNORE INTO criterios (secao, criterio) VALUES (?, ?)", pares)
+    _ids_criterios.pop(DB_NAME, None)
+
+def _id_criterio(cursor, secao, criterio):
+    ids = _ids_criterios.get(DB_NAME)
+    if ids is None or (secao, criterio) not in ids:
+        # Outro processo pode ter acrescentado critérios depois de este ter lido a tabela.
+        ids = {(s, c): criterio_id for criterio_id, s, c in cursor.execute("SELECT id, secao, criterio FROM criterios")}
+        _ids_criterios[DB_NAME] = ids
+    return ids.get((secao, criterio))
+
+def _separar_respostas(cursor, respostas):
+    """Divide um mapa de respostas em linhas da tabela `respostas` e chaves fora do catálogo."""
+    mapa = logic.mapa_chaves_respostas()
+    linhas, extras = {}, {}
+    for chave, valor in respostas.items():
+        destino = mapa.get(chave)
+        criterio_id = _id_criterio(cursor, destino[0], destino[1]) if destino else None
+        if destino and destino[3] == 'status' and valor is not None:
+            valor = logic.STATUS_CODIGOS.get(valor)
+            if valor is None:
+                criterio_id = None
+        if criterio_id is None:
+            extras[chave] = respostas[chave]
+            continue
+        linha = linhas.setdefault((criterio_id, destino[2]), {'status': None, 'observacao': None, 'link': None})
+        linha[destino[3]] = valor
+    return linhas, extras
+
+def _inserir_linhas_respostas(cursor, analise_id, linhas):
+    cursor.executemany("INSERT OR REPLACE INTO respostas (analise_id, criterio_id, subcriterio, status, observacao, link) VALUES (?, ?, ?, ?, ?, ?)",
+                       [(analise_id, criterio_id, sub, linha['status'], linha['observacao'], linha['link']) for (criterio_id, sub), linha in linhas.items()])
+
+def _respostas_da_analise(cursor, analise_id, extras_json):
+    with metricas.fase('respostas'):
+        respostas = json.loads(extras_json) if extras_json else {}
+        cursor.execute("""SELECT c.secao || '_' || c.criterio || '_' || r.subcriterio, r.status, r.observacao, r.link
+                          FROM respostas r JOIN criterios c ON c.id = r.criterio_id WHERE r.analise_id = ?""", (analise_id,))
+        for chave, status, observacao, link in cursor.fetchall():
+            _acrescentar_resposta(respostas, chave, status, observacao, link)
+        return respostas
+
+def _acrescentar_resposta(respostas, chave, status, observacao, link):
+    if status is not None:
+        respostas[chave] = logic.STATUS_NOMES[status]
+    if observacao is not None:
+        respostas[f"{chave}_obs"] = observacao
+    if link is not None:
+        respostas[f"{chave}_link"] = link
+
+def _falhas_por_analise(cursor, analise_ids):
+    falhas = {analise_id: [] for analise_id in analise_ids}
+    for inicio in range(0, len(analise_ids), 500):
+        lote = analise_ids[inicio:inicio + 500]
+        cursor.execute(f"""SELECT r.analise_id, c.secao || '_' || c.criterio || '_' || r.subcriterio
+                           FROM respostas r JOIN criterios c ON c.id = r.criterio_id
+                           WHERE r.status = 1 AND r.analise_id IN ({','.join('?' * len(lote))})""", lote)
+        for analise_id, chave in cursor.fetchall():
+            falhas[analise_id].append(chave)
+    return falhas
+
+def _pontuacao_analise(cursor, analise_id, tipo_analise, extras):
+    falhas = _falhas_por_analise(cursor, [analise_id])[analise_id]
+    cursor.execute("SELECT EXISTS(SELECT 1 FROM respostas WHERE analise_id = ?)", (analise_id,))
+    # Uma análise sem nenhuma resposta gravada continua "Não iniciada".
+    if not (cursor.fetchone()[0] or extras):
+        return _colunas_pontuacao(None, tipo_analise)
+    return _colunas_pontuacao(logic.pontuar_falhas([falhas], tipo_analise)[0], tipo_analise)
+
+def _normalizar_respostas(cursor):
+    # Migração: passa as respostas do JSON em analises.respostas para a tabela `respostas`.
+    # Só as chaves que não correspondem a nenhum critério do catálogo ficam no JSON.
+    cursor.execute("SELECT id FROM analises WHERE respostas IS NOT NULL AND respostas NOT IN ('', '{}')")
+    ids = [row[0] for row in cursor.fetchall()]
+    migradas = {}
+    for inicio in range(0, len(ids), 500):
+        lote = ids[inicio:inicio + 500]
+        cursor.execute(f"SELECT id, tipo_analise, respostas FROM analises WHERE id IN ({','.join('?' * len(lote))})", lote)
+        for analise_id, tipo_analise, respostas_json in cursor.fetchall():
+            linhas, extras = _separar_respostas(cursor, json.loads(respostas_json))
+            _inserir_linhas_respostas(cursor, analise_id, linhas)
+            cursor.execute("UPDATE analises SET respostas = ? WHERE id = ?", (json.dumps(extras) if extras else None, analise_id))
+            migradas.setdefault(tipo_analise, []).append(analise_id)
+    for tipo_analise, analise_ids in migradas.items():
+        falhas = _falhas_por_analise(cursor, analise_ids)
+        resultados = logic.pontuar_falhas([falhas[analise_id] for analise_id in analise_ids], tipo_analise)
+        cursor.executemany("UPDATE analises SET indice = ?, selo = ?, percentual_essenciais = ?, scores_secao = ?, versao_criterios = ? WHERE id = ?",
+                           [(*_colunas_pontuacao(resultado, tipo_analise), analise_id) for analise_id, resultado in zip(analise_ids, resultados)])
+
+# Versão do catálogo já sincronizada com cada base de dados, neste processo.
+_catalogo_sincronizado = {}
+
+def _corrigir_nao_iniciadas(cursor):
+    # Bases antigas guardam '{}' nas análises nunca iniciadas, que chegaram a ser pontuadas como completas.
+    cursor.execute("UPDATE analises SET respostas = NULL WHERE respostas IN ('', '{}')")
+    cursor.execute("""SELECT id, tipo_analise FROM analises a WHERE respostas IS NULL AND indice IS NOT NULL
+                      AND NOT EXISTS(SELECT 1 FROM respostas r WHERE r.analise_id = a.id)""")
+    cursor.executemany("UPDATE analises SET indice = ?, selo = ?, percentual_essenciais = ?, scores_secao = ?, versao_criterios = ? WHERE id = ?",
+                       [(*_colunas_pontuacao(None, tipo_analise), analise_id) for analise_id, tipo_analise in cursor.fetchall()])
+    _reconstruir_rollups(cursor)
+
+def _registar_catalogo(cursor, catalogo):
+    agora = datetime.now()
+    cursor.executemany("INSERT OR IGNORE INTO criterios_versoes (tipo_analise, versao, conteudo, registada_em) VALUES (?, ?, ?, ?)",
+                       [(tipo, versao, json.dumps(catalogo.criterios[tipo], ensure_ascii=False), agora) for tipo, versao in catalogo.versoes_tipo.items()])
+    _sincronizar_criterios(cursor)
+
+def _repontuar_lote(cursor, tipo_analise, lote):
+    antes = {analise_id: _contribuicao(cursor, analise_id) for analise_id in lote}
+    cursor.execute(f"""SELECT id FROM analises WHERE id IN ({','.join('?' * len(lote))})
+                       AND (respostas NOT IN ('', '{{}}') OR EXISTS(SELECT 1 FROM respostas r WHERE r.analise_id = analises.id))""", lote)
+    iniciadas = {row[0] for row in cursor.fetchall()}
+    falhas = _falhas_por_analise(cursor, lote)
+    resultados = logic.pontuar_falhas([falhas[analise_id] for analise_id in lote], tipo_analise)
+    cursor.executemany("UPDATE analises SET indice = ?, selo = ?, percentual_essenciais = ?, scores_secao = ?, versao_criterios = ? WHERE id = ?",
+                       [(*_colunas_pontuacao(resultado if analise_id in iniciadas else None, tipo_analise), analise_id)
+                        for analise_id, resultado in zip(lote, resultados)])
+    for analise_id in lote:
+        _atualizar_rollups(cursor, antes[analise_id], _contribuicao(cursor, analise_id))
+
+def repontuar_desatualizadas(lote=200, pausa=0):
+    """Volta a pontuar as análises pontuadas com outra versão dos critérios do seu tipo. Devolve quantas.
+
+    Cada lote é uma transação curta, seguida de `pausa` segundos sem o lock, para que as gravações
+    à espera passem à frente; vários processos podem correr isto ao mesmo tempo sem pontuar a mesma
+    análise duas vezes.
+    """
+    catalogo = logic.catalogo()
+    total = 0
+    for tipo_analise, versao in catalogo.versoes_tipo.items():
+        while logic.versao_criterios() == catalogo.versao:
+            with transacao(imediata=True) as cursor:
+                cursor.execute("SELECT id FROM analises WHERE tipo_analise = ? AND versao_criterios IS NOT ? LIMIT ?", (tipo_analise, versao, lote))
+                ids = [row[0] for row in cursor.fetchall()]
+                if ids:
+                    _repontuar_lote(cursor, tipo_analise, ids)
+            if not ids:
+                break
+            total += len(ids)
+            time.sleep(pausa)
+    return total
+
+def sincronizar_catalogo():
+    """Regista a versão atual dos critérios; True se ela mudou desde a última chamada (ver repontuar_desatualizadas)."""
+    versao = logic.versao_criterios()
+    if _catalogo_sincronizado.get(DB_NAME) == versao:
+        return False
+    with transacao() as cursor:
+        _registar_catalogo(cursor, logic.catalogo())
+    _catalogo_sincronizado[DB_NAME] = versao
+    return True
+
+def _faixa_score(score):
+    # Faixas de 10 pontos (0 = [0, 10), ..., 9 = [90, 100]).
+    return min(int(score // 10), 9)
+
+def _contribuicao(cursor, analise_id):
+    """O que a análise, no estado atual, soma a cada linha das tabelas de rollup."""
+    cursor.execute("SELECT tipo_analise, substr(last_modified, 1, 10), selo, indice, scores_secao FROM analises WHERE id = ?", (analise_id,))
+    row = cursor.fetchone()
+    if not row or row[3] is None:
+        return {}
+    tipo_analise, dia, selo, indice, scores_json = row
+    contribuicao = {('analises', tipo_analise, dia, selo): (1, indice)}
+    for secao, score in json.loads(scores_json).items():
+        contribuicao[('secoes', tipo_analise, dia, secao, _faixa_score(score))] = (1, score)
+    cursor.execute("SELECT DISTINCT criterio_id FROM respostas WHERE analise_id = ? AND status = 1", (analise_id,))
+    for (criterio_id,) in cursor.fetchall():
+        contribuicao[('criterios', tipo_analise, dia, criterio_id)] = (1, 0)
+    return contribuicao
+
+def _atualizar_rollups(cursor, antes, depois):
+    # Aplica apenas a diferença entre o estado anterior e o novo de uma análise.
+    deltas = {'analises': [], 'secoes': [], 'criterios': []}
+    for chave in antes.keys() | depois.keys():
+        total_antes, soma_antes = antes.get(chave, (0, 0))
+        total_depois, soma_depois = depois.get(chave, (0, 0))
+        if total_antes != total_depois or soma_antes != soma_depois:
+            deltas[chave[0]].append((*chave[1:], total_depois - total_antes, soma_depois - soma_antes))
+    if deltas['analises']:
+        cursor.executemany("""INSERT INTO rollup_analises (tipo_analise, dia, selo, total, soma_indice) VALUES (?, ?, ?, ?, ?)
+                              ON CONFLICT DO UPDATE SET total = total + excluded.total, soma_indice = soma_indice + excluded.soma_indice""", deltas['analises'])
+    if deltas['secoes']:
+        cursor.executemany("""INSERT INTO rollup_secoes (tipo_analise, dia, secao, faixa, total, soma_score) VALUES (?, ?, ?, ?, ?, ?)
+                              ON CONFLICT DO UPDATE SET total = total + excluded.total, soma_score = soma_score + excluded.soma_score""", deltas['secoes'])
+    if deltas['criterios']:
+        cursor.executemany("""INSERT INTO rollup_criterios (tipo_analise, dia, criterio_id, falhas) VALUES (?, ?, ?, ?)
+                              ON CONFLICT DO UPDATE SET falhas = falhas + excluded.falhas""", [linha[:-1] for linha in deltas['criterios']])
+
+def _somar_contribuicoes(contribuicoes):
+    soma = {}
+    for contribuicao in contribuicoes:
+        for chave, (total, valor) in contribuicao.items():
+            total_atual, valor_atual = soma.get(chave, (0, 0))
+            soma[chave] = (total_atual + total, valor_atual + valor)
+    return soma
+
+def _reconstruir_rollups(cursor):
+    for tabela in ('rollup_analises', 'rollup_secoes', 'rollup_criterios'):
+        cursor.execute(f"DELETE FROM {tabela}")
+    cursor.execute("""INSERT INTO rollup_analises (tipo_analise, dia, selo, total, soma_indice)
+                      SELECT tipo_analise, substr(last_modified, 1, 10), selo, COUNT(*), SUM(indice)
+                      FROM analises WHERE indice IS NOT NULL GROUP BY 1, 2, 3""")
+    cursor.execute("""INSERT INTO rollup_secoes (tipo_analise, dia, secao, faixa, total, soma_score)
+                      SELECT a.tipo_analise, substr(a.last_modified, 1, 10), s.key, MIN(CAST(s.value / 10 AS INTEGER), 9), COUNT(*), SUM(s.value)
+                      FROM analises a, json_each(a.scores_secao) s WHERE a.indice IS NOT NULL GROUP BY 1, 2, 3, 4""")
+    cursor.execute("""INSERT INTO rollup_criterios (tipo_analise, dia, criterio_id, falhas)
+                      SELECT a.tipo_analise, substr(a.last_modified, 1, 10), f.criterio_id, COUNT(*)
+                      FROM analises a JOIN (SELECT DISTINCT analise_id, criterio_id FROM respostas WHERE status = 1) f ON f.analise_id = a.id
+                      WHERE a.indice IS NOT NULL GROUP BY 1, 2, 3""")
+
+def reconstruir_rollups():
+    with transacao() as cursor:
+        _reconstruir_rollups(cursor)
+
+def caminho_pdf(sha256):
+    return os.path.join(RELATORIOS_DIR, sha256[:2], f"{sha256}.pdf")
+
+def guardar_ficheiro_pdf(dados_pdf):
+    sha256 = hashlib.sha256(dados_pdf).hexdigest()
+    caminho = caminho_pdf(sha256)
+    if os.path.exists(caminho):
+        # Renova a data do ficheiro para a limpeza de órfãos não o apagar antes de o relatório ser registado.
+        os.utime(caminho)
+    else:
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        # Escreve num ficheiro temporário e renomeia, para nunca expor um PDF incompleto.
+        fd, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(dados_pdf)
+        os.replace(temporario, caminho)
+    return sha256, len(dados_pdf)
+
+def _migrar_pdfs_para_ficheiros():
+    with transacao() as cursor:
+        cursor.execute("SELECT id FROM relatorios WHERE dados_pdf IS NOT NULL")
+        ids = [row[0] for row in cursor.fetchall()]
+    for relatorio_id in ids:
+        # Um relatório de cada vez, para não carregar todos os BLOBs em memória.
+        with transacao() as cursor:
+            cursor.execute("SELECT dados_pdf FROM relatorios WHERE id = ? AND dados_pdf IS NOT NULL", (relatorio_id,))
+            row = cursor.fetchone()
+            if row:
+                sha256, tamanho = guardar_ficheiro_pdf(row[0])
+                cursor.execute("UPDATE relatorios SET sha256 = ?, tamanho = ?, dados_pdf = NULL WHERE id = ?", (sha256, tamanho, relatorio_id))
+    return len(ids)
 
 def dict_factory(cursor, row):
     d = {}
@@ -42,141 +533,733 @@ def dict_factory(cursor, row):
     return d
 
 def get_user_by_username(username):
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    conn.row_factory = dict_factory
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+    with transacao(dict_factory) as cursor:
+        cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
+        return cursor.fetchone()
 
-def add_new_user(username, password_hash):
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    cursor = conn.cursor()
+def add_new_user(username, password_hash, is_admin=0):
     try:
-        cursor.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash))
-        conn.commit()
+        with transacao() as cursor:
+            cursor.execute("INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)", (username, password_hash, is_admin))
     except sqlite3.IntegrityError:
-        conn.close()
         return False
-    conn.close()
     return True
 
 def list_all_users():
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    conn.row_factory = dict_factory
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, username, is_admin FROM users ORDER BY username")
-    users = cursor.fetchall()
-    conn.close()
-    return users
+    with transacao(dict_factory) as cursor:
+        cursor.execute("SELECT id, username, is_admin FROM users ORDER BY username")
+        return cursor.fetchall()
 
 def delete_user_by_id(user_id):
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    cursor = conn.cursor()
-    cursor.execute("PRAGMA foreign_keys = ON;")
-    cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with transacao() as cursor:
+        cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
 
-def list_all_reports():
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    conn.row_factory = dict_factory
-    cursor = conn.cursor()
-    cursor.execute("SELECT r.id, r.nome_arquivo, r.data_geracao, a.site_nome, a.tipo_analise, u.username FROM relatorios r JOIN analises a ON r.analise_id = a.id JOIN users u ON a.username = u.username ORDER BY r.data_geracao DESC")
-    reports = cursor.fetchall()
-    conn.close()
-    return reports
+def importar_usuarios(usuarios):
+    """Insere (username, password_hash, is_admin) numa só transação. Os que já existem ficam como estão; devolve quantos foram criados."""
+    with transacao() as cursor:
+        antes = cursor.connection.total_changes
+        cursor.executemany("INSERT OR IGNORE INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)", usuarios)
+        return cursor.connection.total_changes - antes
+
+def exportar_usuarios():
+    with transacao() as cursor:
+        cursor.execute("SELECT username, password_hash, is_admin FROM users ORDER BY username")
+        return cursor.fetchall()
+
+def _consulta_fts(busca):
+    # Cada palavra vira um prefixo entre aspas: a pesquisa nunca é interpretada como sintaxe FTS5.
+    termos = re.findall(r'\w+', busca or '')[:10]
+    return ' '.join(f'"{termo}"*' for termo in termos)
+
+def _filtro_admin(tipo_analise, inicio, fim, coluna_data, antes, chave):
+    condicoes, params = [], []
+    if tipo_analise:
+        # O "+" impede o uso do índice por tipo: a ordem da página vem do índice por data, sem ordenar tudo.
+        condicoes.append("+a.tipo_analise = ?")
+        params.append(tipo_analise)
+    if inicio:
+        condicoes.append(f"{coluna_data} >= ?")
+        params.append(inicio)
+    if fim:
+        condicoes.append(f"{coluna_data} < date(?, '+1 day')")
+        params.append(fim)
+    if antes:
+        condicoes.append(f"({coluna_data}, {chave}) < (?, ?)")
+        params.extend(antes)
+    return condicoes, params
+
+def listar_relatorios_admin(busca=None, tipo_analise=None, inicio=None, fim=None, limite=50, antes=None):
+    """Relatórios de todos os utilizadores, do mais recente para o mais antigo.
+
+    `busca` procura no nome do relatório e no nome, URL e utilizador da análise; `antes` é o par
+    (data_geracao, id) da última linha da página anterior.
+    """
+    condicoes, params = _filtro_admin(tipo_analise, inicio, fim, 'r.data_geracao', antes, 'r.id')
+    consulta = _consulta_fts(busca)
+    if consulta:
+        condicoes.append("""(r.id IN (SELECT rowid FROM busca_relatorios WHERE busca_relatorios MATCH ?)
+                             OR r.analise_id IN (SELECT rowid FROM busca_analises WHERE busca_analises MATCH ?))""")
+        params.extend([consulta, consulta])
+    filtro = (" WHERE " + " AND ".join(condicoes)) if condicoes else ""
+    with transacao(dict_factory) as cursor:
+        cursor.execute(f"""SELECT r.id, r.nome_arquivo, r.data_geracao, a.site_nome, a.site_url, a.tipo_analise, u.username
+                           FROM relatorios r JOIN analises a ON r.analise_id = a.id JOIN users u ON a.username = u.username{filtro}
+                           ORDER BY r.data_geracao DESC, r.id DESC LIMIT ?""", params + [limite])
+        return cursor.fetchall()
+
+def listar_analises_admin(busca=None, tipo_analise=None, inicio=None, fim=None, limite=50, antes=None):
+    """Análises de todos os utilizadores, pela última alteração; `antes` é o par (last_modified, id)."""
+    condicoes, params = _filtro_admin(tipo_analise, inicio, fim, 'a.last_modified', antes, 'a.id')
+    consulta = _consulta_fts(busca)
+    if consulta:
+        condicoes.append("a.id IN (SELECT rowid FROM busca_analises WHERE busca_analises MATCH ?)")
+        params.append(consulta)
+    filtro = (" WHERE " + " AND ".join(condicoes)) if condicoes else ""
+    with transacao(dict_factory) as cursor:
+        cursor.execute(f"""SELECT a.id, a.username, a.site_nome, a.site_url, a.tipo_analise, a.last_modified, a.indice, a.selo,
+                                  (SELECT id FROM relatorios WHERE analise_id = a.id ORDER BY data_geracao DESC, id DESC LIMIT 1) AS relatorio_id
+                           FROM analises a{filtro}
+                           ORDER BY a.last_modified DESC, a.id DESC LIMIT ?""", params + [limite])
+        return cursor.fetchall()
 
 def carregar_ou_criar_analise(username, site_url, site_nome, tipo_analise):
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, respostas FROM analises WHERE username = ? AND site_url = ? AND tipo_analise = ?", (username, site_url, tipo_analise))
-    row = cursor.fetchone()
-    if row:
-        analise_id, respostas_json = row
-        respostas = json.loads(respostas_json) if respostas_json else {}
-        cursor.execute("UPDATE analises SET site_nome = ?, last_modified = ? WHERE id = ?", (site_nome, datetime.now(), analise_id))
-        conn.commit()
-    else:
-        cursor.execute("INSERT INTO analises (username, site_url, site_nome, tipo_analise, respostas, last_modified) VALUES (?, ?, ?, ?, ?, ?)", (username, site_url, site_nome, tipo_analise, json.dumps({}), datetime.now()))
-        conn.commit()
-        analise_id = cursor.lastrowid
-        respostas = {}
-    conn.close()
+    with transacao(imediata=True) as cursor:
+        cursor.execute("SELECT id, respostas FROM analises WHERE username = ? AND site_url = ? AND tipo_analise = ?", (username, site_url, tipo_analise))
+        row = cursor.fetchone()
+        if row:
+            analise_id, extras_json = row
+            respostas = _respostas_da_analise(cursor, analise_id, extras_json)
+            antes = _contribuicao(cursor, analise_id)
+            cursor.execute("UPDATE analises SET site_nome = ?, last_modified = ? WHERE id = ?", (site_nome, datetime.now(), analise_id))
+            _atualizar_rollups(cursor, antes, _contribuicao(cursor, analise_id))
+        else:
+            cursor.execute("INSERT INTO analises (username, site_url, site_nome, tipo_analise, last_modified, versao_criterios) VALUES (?, ?, ?, ?, ?, ?)",
+                           (username, site_url, site_nome, tipo_analise, datetime.now(), logic.versao_tipo(tipo_analise)))
+            analise_id = cursor.lastrowid
+            respostas = {}
     return analise_id, respostas
 
+def _substituir_respostas(cursor, analise_id, respostas):
+    """Substitui todas as respostas da análise; devolve as chaves fora do catálogo."""
+    linhas, extras = _separar_respostas(cursor, respostas)
+    cursor.execute("DELETE FROM respostas WHERE analise_id = ?", (analise_id,))
+    _inserir_linhas_respostas(cursor, analise_id, linhas)
+    return extras
+
+def _aplicar_alteracoes(cursor, analise_id, extras, alteracoes):
+    """Grava só as chaves de `alteracoes` (None remove a chave); devolve as chaves fora do catálogo atualizadas."""
+    mapa = logic.mapa_chaves_respostas()
+    por_coluna = {'status': [], 'observacao': [], 'link': []}
+    for chave, valor in alteracoes.items():
+        destino = mapa.get(chave)
+        criterio_id = _id_criterio(cursor, destino[0], destino[1]) if destino else None
+        if destino and destino[3] == 'status' and valor is not None:
+            valor = logic.STATUS_CODIGOS.get(valor)
+            if valor is None:
+                criterio_id = None
+        if criterio_id is None:
+            if alteracoes[chave] is None:
+                extras.pop(chave, None)
+            else:
+                extras[chave] = alteracoes[chave]
+            continue
+        por_coluna[destino[3]].append((analise_id, criterio_id, destino[2], valor))
+    for coluna, linhas in por_coluna.items():
+        if linhas:
+            cursor.executemany(f"""INSERT INTO respostas (analise_id, criterio_id, subcriterio, {coluna}) VALUES (?, ?, ?, ?)
+                                   ON CONFLICT(analise_id, criterio_id, subcriterio) DO UPDATE SET {coluna} = excluded.{coluna}""", linhas)
+    cursor.execute("DELETE FROM respostas WHERE analise_id = ? AND status IS NULL AND observacao IS NULL AND link IS NULL", (analise_id,))
+    return extras
+
 def salvar_progresso(analise_id, respostas):
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE analises SET respostas = ?, last_modified = ? WHERE id = ?", (json.dumps(respostas), datetime.now(), analise_id))
-    conn.commit()
-    conn.close()
+    with transacao(imediata=True) as cursor:
+        cursor.execute("SELECT tipo_analise FROM analises WHERE id = ?", (analise_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        antes = _contribuicao(cursor, analise_id)
+        extras = _substituir_respostas(cursor, analise_id, respostas)
+        pontuacao = _pontuacao_analise(cursor, analise_id, row[0], extras)
+        cursor.execute("UPDATE analises SET respostas = ?, last_modified = ?, indice = ?, selo = ?, percentual_essenciais = ?, scores_secao = ?, versao_criterios = ?, revisao = revisao + 1 WHERE id = ?",
+                       (json.dumps(extras) if extras else None, datetime.now(), *pontuacao, analise_id))
+        _atualizar_rollups(cursor, antes, _contribuicao(cursor, analise_id))
+        cursor.execute("SELECT revisao FROM analises WHERE id = ?", (analise_id,))
+        return cursor.fetchone()[0]
 
-def listar_analises_por_usuario(username):
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    conn.row_factory = dict_factory
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, site_url, site_nome, tipo_analise, last_modified, respostas FROM analises WHERE username = ? ORDER BY last_modified DESC", (username,))
-    analises = cursor.fetchall()
+def aplicar_delta(analise_id, username, revisao, alteracoes):
+    """Aplica só as chaves alteradas se `revisao` ainda for a revisão atual.
+
+    Devolve (True, nova_revisao) ou, se outro separador gravou entretanto, (False, revisao_atual).
+    Um valor None remove a chave. Devolve None se a análise não existir.
+    """
+    with transacao(imediata=True) as cursor:
+        cursor.execute("SELECT tipo_analise, respostas, revisao FROM analises WHERE id = ? AND username = ?", (analise_id, username))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        tipo_analise, extras_json, revisao_atual = row
+        if revisao != revisao_atual:
+            return False, revisao_atual
+        antes = _contribuicao(cursor, analise_id)
+        # A condição sobre a revisão protege contra outro processo que tenha gravado depois do SELECT.
+        cursor.execute("UPDATE analises SET revisao = ?, last_modified = ? WHERE id = ? AND revisao = ?", (revisao_atual + 1, datetime.now(), analise_id, revisao_atual))
+        if cursor.rowcount == 0:
+            cursor.execute("SELECT revisao FROM analises WHERE id = ?", (analise_id,))
+            return False, cursor.fetchone()[0]
+
+        extras = _aplicar_alteracoes(cursor, analise_id, json.loads(extras_json) if extras_json else {}, alteracoes)
+        pontuacao = _pontuacao_analise(cursor, analise_id, tipo_analise, extras)
+        cursor.execute("UPDATE analises SET respostas = ?, indice = ?, selo = ?, percentual_essenciais = ?, scores_secao = ?, versao_criterios = ? WHERE id = ?",
+                       (json.dumps(extras) if extras else None, *pontuacao, analise_id))
+        _atualizar_rollups(cursor, antes, _contribuicao(cursor, analise_id))
+        return True, revisao_atual + 1
+
+def _aplicar_autosave(cursor, analise_id, respostas_json, alteracoes_json):
+    cursor.execute("SELECT tipo_analise, respostas FROM analises WHERE id = ?", (analise_id,))
+    row = cursor.fetchone()
+    if not row:
+        return
+    antes = _contribuicao(cursor, analise_id)
+    if respostas_json is not None:
+        extras = _substituir_respostas(cursor, analise_id, json.loads(respostas_json))
+    else:
+        extras = json.loads(row[1]) if row[1] else {}
+    alteracoes = json.loads(alteracoes_json)
+    if alteracoes:
+        extras = _aplicar_alteracoes(cursor, analise_id, extras, alteracoes)
+    pontuacao = _pontuacao_analise(cursor, analise_id, row[0], extras)
+    cursor.execute("UPDATE analises SET respostas = ?, indice = ?, selo = ?, percentual_essenciais = ?, scores_secao = ?, versao_criterios = ? WHERE id = ?",
+                   (json.dumps(extras) if extras else None, *pontuacao, analise_id))
+    _atualizar_rollups(cursor, antes, _contribuicao(cursor, analise_id))
+
+def _aplicar_autosaves_pendentes(cursor):
+    # Gravações aceites pela antiga gravação diferida e ainda não aplicadas: entram já nas análises.
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'autosaves_pendentes'")
+    if cursor.fetchone() is None:
+        return
+    cursor.execute("SELECT analise_id, respostas, alteracoes FROM autosaves_pendentes")
+    for pendente in cursor.fetchall():
+        _aplicar_autosave(cursor, *pendente)
+    cursor.execute("DROP TABLE autosaves_pendentes")
+
+def listar_analises_por_usuario(username, limite=None, antes=None):
+    # Paginação por chave: `antes` é o par (last_modified, id) da última linha da página anterior.
+    sql = """SELECT a.id, a.site_url, a.site_nome, a.tipo_analise, a.last_modified, a.indice, a.selo, a.percentual_essenciais,
+                    r.id AS relatorio_id, r.nome_arquivo AS relatorio_nome
+             FROM analises a
+             LEFT JOIN relatorios r ON r.id = (SELECT id FROM relatorios WHERE analise_id = a.id ORDER BY data_geracao DESC, id DESC LIMIT 1)
+             WHERE a.username = ?"""
+    params = [username]
+    if antes:
+        sql += " AND (a.last_modified, a.id) < (?, ?)"
+        params.extend(antes)
+    sql += " ORDER BY a.last_modified DESC, a.id DESC"
+    if limite:
+        sql += " LIMIT ?"
+        params.append(limite)
+    with transacao(dict_factory) as cursor:
+        cursor.execute(sql, params)
+        analises = cursor.fetchall()
     for analise in analises:
-        analise['respostas'] = json.loads(analise['respostas']) if analise.get('respostas') else {}
-    conn.close()
+        relatorio_id, relatorio_nome = analise.pop('relatorio_id'), analise.pop('relatorio_nome')
+        analise['latest_report'] = {'id': relatorio_id, 'nome_arquivo': relatorio_nome} if relatorio_id else None
     return analises
 
-def obter_analise_por_id(analise_id, username):
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    conn.row_factory = dict_factory
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM analises WHERE id = ? AND username = ?", (analise_id, username))
-    analise = cursor.fetchone()
-    if analise and analise.get('respostas'):
-        analise['respostas'] = json.loads(analise['respostas'])
-    else:
+def resumo_analises_por_usuario(username):
+    with transacao() as cursor:
+        cursor.execute("SELECT selo, COUNT(*) FROM analises WHERE username = ? AND selo IS NOT NULL GROUP BY selo ORDER BY COUNT(*) DESC", (username,))
+        selos = cursor.fetchall()
+        cursor.execute("SELECT tipo_analise, AVG(COALESCE(indice, 0)) FROM analises WHERE username = ? GROUP BY tipo_analise", (username,))
+        medias = dict(cursor.fetchall())
+    return selos, medias
+
+def estado_analise(analise_id, username):
+    """O que determina o conteúdo da página da análise, para o ETag; None se a análise não existir."""
+    with transacao() as cursor:
+        cursor.execute("""SELECT revisao, last_modified, receita_img_path, despesa_img_path, versao_criterios,
+                                 (SELECT MAX(id) FROM relatorios WHERE analise_id = a.id)
+                          FROM analises a WHERE id = ? AND username = ?""", (analise_id, username))
+        return cursor.fetchone()
+
+def estado_analises_usuario(username):
+    """Resumo barato de tudo o que aparece no painel do utilizador, para o ETag."""
+    with transacao() as cursor:
+        cursor.execute("""SELECT COUNT(*), MAX(id), MAX(last_modified), TOTAL(revisao), TOTAL(indice), GROUP_CONCAT(DISTINCT selo),
+                                 (SELECT COUNT(*) || ':' || IFNULL(MAX(r.id), 0) FROM relatorios r JOIN analises a ON a.id = r.analise_id WHERE a.username = ?)
+                          FROM analises WHERE username = ?""", (username, username))
+        return cursor.fetchone()
+
+def obter_analise_por_id(analise_id, username=None):
+    # Sem username (uso administrativo, p. ex. relatórios em lote) a análise não é filtrada por dono.
+    with transacao(dict_factory) as cursor:
+        if username is None:
+            cursor.execute("SELECT * FROM analises WHERE id = ?", (analise_id,))
+        else:
+            cursor.execute("SELECT * FROM analises WHERE id = ? AND username = ?", (analise_id, username))
+        analise = cursor.fetchone()
         if analise:
-            analise['respostas'] = {}
-    conn.close()
+            cursor.row_factory = None
+            analise['respostas'] = _respostas_da_analise(cursor, analise_id, analise['respostas'])
     return analise
 
-def salvar_relatorio_db(analise_id, nome_arquivo, dados_pdf):
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO relatorios (analise_id, nome_arquivo, dados_pdf) VALUES (?, ?, ?)", (analise_id, nome_arquivo, dados_pdf))
+def exportar_analises(username=None, tipo_analise=None, lote=500):
+    """Gera as análises, com as respostas e os metadados dos relatórios, por ordem de id e `lote` a `lote`."""
+    condicoes, params = [], []
+    if username:
+        condicoes.append("username = ?")
+        params.append(username)
+    if tipo_analise:
+        condicoes.append("tipo_analise = ?")
+        params.append(tipo_analise)
+    filtro = "".join(f" AND {condicao}" for condicao in condicoes)
+    ultimo_id = 0
+    while True:
+        # Uma transação por lote: a leitura não prende a base de dados enquanto o chamador escreve o resultado.
+        with transacao(dict_factory) as cursor:
+            cursor.execute(f"""SELECT id, username, site_url, site_nome, tipo_analise, last_modified, revisao, versao_criterios,
+                                      receita_img_path, despesa_img_path, respostas
+                               FROM analises WHERE id > ?{filtro} ORDER BY id LIMIT ?""", (ultimo_id, *params, lote))
+            analises = cursor.fetchall()
+            if not analises:
+                return
+            ids = [analise['id'] for analise in analises]
+            por_id = {analise['id']: analise for analise in analises}
+            for analise in analises:
+                analise['respostas'] = json.loads(analise['respostas']) if analise['respostas'] else {}
+                analise['relatorios'] = []
+            marcadores = ','.join('?' * len(ids))
+            cursor.row_factory = None
+            cursor.execute(f"""SELECT r.analise_id, c.secao || '_' || c.criterio || '_' || r.subcriterio, r.status, r.observacao, r.link
+                               FROM respostas r JOIN criterios c ON c.id = r.criterio_id WHERE r.analise_id IN ({marcadores})""", ids)
+            for analise_id, chave, status, observacao, link in cursor:
+                _acrescentar_resposta(por_id[analise_id]['respostas'], chave, status, observacao, link)
+            cursor.execute(f"""SELECT analise_id, nome_arquivo, sha256, tamanho, data_geracao, versao_criterios
+                               FROM relatorios WHERE analise_id IN ({marcadores}) ORDER BY data_geracao, id""", ids)
+            for analise_id, nome_arquivo, sha256, tamanho, data_geracao, versao in cursor:
+                por_id[analise_id]['relatorios'].append({'nome_arquivo': nome_arquivo, 'sha256': sha256, 'tamanho': tamanho,
+                                                          'data_geracao': data_geracao, 'versao_criterios': versao})
+        yield from analises
+        ultimo_id = ids[-1]
+
+def importar_analises(analises, substituir=False):
+    """Grava um lote de análises no formato de exportar_analises numa só transação.
+
+    Uma análise que já existe (mesmo utilizador, URL e tipo) é ignorada, ou substituída se `substituir`.
+    A pontuação é recalculada aqui com os critérios atuais. Devolve as contagens de criadas, atualizadas e ignoradas.
+    """
+    contagens = {'criadas': 0, 'atualizadas': 0, 'ignoradas': 0}
+    antes, depois, por_tipo, tocadas = [], [], {}, set()
+    with transacao(imediata=True) as cursor:
+        for analise in analises:
+            chave = (analise['username'], analise['site_url'], analise['tipo_analise'])
+            cursor.execute("SELECT id FROM analises WHERE username = ? AND site_url = ? AND tipo_analise = ?", chave)
+            row = cursor.fetchone()
+            if row and not substituir:
+                contagens['ignoradas'] += 1
+                continue
+            linhas, extras = _separar_respostas(cursor, analise.get('respostas') or {})
+            valores = (analise.get('site_nome'), analise.get('last_modified') or datetime.now(), analise.get('receita_img_path'),
+                       analise.get('despesa_img_path'), json.dumps(extras) if extras else None)
+            if row:
+                analise_id = row[0]
+                # Se a mesma análise aparece duas vezes no lote, só conta o estado anterior ao lote.
+                if analise_id not in tocadas:
+                    antes.append(_contribuicao(cursor, analise_id))
+                cursor.execute("DELETE FROM respostas WHERE analise_id = ?", (analise_id,))
+                cursor.execute("""UPDATE analises SET site_nome = ?, last_modified = ?, receita_img_path = ?, despesa_img_path = ?, respostas = ?,
+                                  revisao = revisao + 1 WHERE id = ?""", (*valores, analise_id))
+                contagens['atualizadas'] += 1
+            else:
+                cursor.execute("""INSERT INTO analises (username, site_url, tipo_analise, site_nome, last_modified, receita_img_path, despesa_img_path, respostas)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", (*chave, *valores))
+                analise_id = cursor.lastrowid
+                contagens['criadas'] += 1
+            _inserir_linhas_respostas(cursor, analise_id, linhas)
+            relatorios = analise.get('relatorios') or []
+            if relatorios:
+                cursor.executemany("""INSERT INTO relatorios (analise_id, nome_arquivo, sha256, tamanho, data_geracao, versao_criterios)
+                                      SELECT ?, ?, ?, ?, ?, ? WHERE NOT EXISTS
+                                          (SELECT 1 FROM relatorios WHERE analise_id = ? AND sha256 IS ? AND data_geracao = ?)""",
+                                   [(analise_id, r.get('nome_arquivo'), r.get('sha256'), r.get('tamanho'), r.get('data_geracao'), r.get('versao_criterios'),
+                                     analise_id, r.get('sha256'), r.get('data_geracao')) for r in relatorios])
+            tocadas.add(analise_id)
+            por_tipo.setdefault(chave[2], {})[analise_id] = bool(linhas or extras)
+        # Pontuação de todo o lote de uma vez por tipo, como na migração para a tabela `respostas`.
+        for tipo_analise, itens in por_tipo.items():
+            ids = list(itens)
+            falhas = _falhas_por_analise(cursor, ids)
+            resultados = logic.pontuar_falhas([falhas[analise_id] for analise_id in ids], tipo_analise)
+            cursor.executemany("UPDATE analises SET indice = ?, selo = ?, percentual_essenciais = ?, scores_secao = ?, versao_criterios = ? WHERE id = ?",
+                               [(*_colunas_pontuacao(resultado if preenchida else None, tipo_analise), analise_id)
+                                for (analise_id, preenchida), resultado in zip(itens.items(), resultados)])
+            depois.extend(_contribuicao(cursor, analise_id) for analise_id in ids)
+        _atualizar_rollups(cursor, _somar_contribuicoes(antes), _somar_contribuicoes(depois))
+    return contagens
+
+# O relatório fica marcado com a versão dos critérios com que a análise foi pontuada.
+_INSERIR_RELATORIO = """INSERT INTO relatorios (analise_id, nome_arquivo, sha256, tamanho, versao_criterios)
+                        VALUES (?, ?, ?, ?, (SELECT versao_criterios FROM analises WHERE id = ?))"""
+
+def salvar_relatorio_db(analise_id, nome_arquivo, dados_pdf=None, sha256=None, tamanho=None):
+    if dados_pdf is not None:
+        sha256, tamanho = guardar_ficheiro_pdf(dados_pdf)
+    with transacao() as cursor:
+        cursor.execute(_INSERIR_RELATORIO, (analise_id, nome_arquivo, sha256, tamanho, analise_id))
+        return cursor.lastrowid
+
+def listar_ids_analises(username=None, tipo_analise=None, inicio=None, fim=None):
+    condicoes, params = [], []
+    if username:
+        condicoes.append("username = ?")
+        params.append(username)
+    if tipo_analise:
+        condicoes.append("tipo_analise = ?")
+        params.append(tipo_analise)
+    if inicio:
+        condicoes.append("substr(last_modified, 1, 10) >= ?")
+        params.append(inicio)
+    if fim:
+        condicoes.append("substr(last_modified, 1, 10) <= ?")
+        params.append(fim)
+    filtro = (" WHERE " + " AND ".join(condicoes)) if condicoes else ""
+    with transacao() as cursor:
+        cursor.execute(f"SELECT id FROM analises{filtro} ORDER BY id", params)
+        return [row[0] for row in cursor.fetchall()]
+
+def relatorios_fora_da_retencao(manter=None, dias=None):
+    """Relatórios que não estão entre os `manter` mais recentes da sua análise nem têm menos de `dias` dias."""
+    condicoes, params = [], []
+    if manter is not None:
+        condicoes.append("r.ordem > ?")
+        params.append(manter)
+    if dias is not None:
+        condicoes.append("r.data_geracao < datetime('now', ?)")
+        params.append(f"-{dias} days")
+    if not condicoes:
+        return []
+    with transacao(dict_factory) as cursor:
+        cursor.execute(f"""SELECT r.id, r.analise_id, r.nome_arquivo, r.sha256, r.tamanho, r.data_geracao, r.versao_criterios,
+                                  a.username, a.site_nome, a.site_url, a.tipo_analise
+                           FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY analise_id ORDER BY data_geracao DESC, id DESC) AS ordem
+                                 FROM relatorios) r
+                           LEFT JOIN analises a ON a.id = r.analise_id
+                           WHERE {" AND ".join(condicoes)} ORDER BY r.id""", params)
+        return cursor.fetchall()
+
+def remover_relatorios(ids, lote=500):
+    # Em lotes e em transações separadas, para as escritas da aplicação não ficarem à espera.
+    removidos = 0
+    for i in range(0, len(ids), lote):
+        parte = ids[i:i + lote]
+        with transacao() as cursor:
+            cursor.execute(f"DELETE FROM relatorios WHERE id IN ({','.join('?' * len(parte))})", parte)
+            removidos += cursor.rowcount
+    return removidos
+
+def pdfs_em_uso():
+    with transacao() as cursor:
+        cursor.execute("SELECT sha256 FROM relatorios WHERE sha256 IS NOT NULL UNION SELECT sha256 FROM cache_pdf")
+        return {row[0] for row in cursor.fetchall()}
+
+def purgar_jobs_relatorio(antes):
+    with transacao() as cursor:
+        cursor.execute("DELETE FROM jobs_relatorio WHERE estado IN ('concluido', 'erro', 'cancelado') AND atualizado_em < ?", (antes,))
+        return cursor.rowcount
+
+def compactar_base_dados(paginas_por_passo=1000, vacuum_completo=False):
+    """Devolve ao sistema de ficheiros as páginas livres e atualiza as estatísticas do planeador."""
+    conn = get_connection()
+    tamanho_pagina = conn.execute("PRAGMA page_size").fetchone()[0]
+    paginas_antes = conn.execute("PRAGMA page_count").fetchone()[0]
+    if vacuum_completo:
+        # Reescreve a base inteira (e passa-a a auto_vacuum incremental); bloqueia as escritas enquanto dura.
+        conn.execute("VACUUM")
+    elif conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        livres = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        while livres:
+            # Cada passo é uma transação curta; entre passos as escritas da aplicação avançam.
+            conn.execute(f"PRAGMA incremental_vacuum({int(paginas_por_passo)})").fetchall()
+            restantes = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if restantes >= livres:
+                break
+            livres = restantes
+    conn.execute("PRAGMA analysis_limit = 1000")
+    conn.execute("ANALYZE")
     conn.commit()
-    conn.close()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    paginas_depois = conn.execute("PRAGMA page_count").fetchone()[0]
+    return {
+        'auto_vacuum': {0: 'nenhum', 1: 'completo', 2: 'incremental'}[conn.execute("PRAGMA auto_vacuum").fetchone()[0]],
+        'bytes_libertados': (paginas_antes - paginas_depois) * tamanho_pagina,
+        'paginas_livres': conn.execute("PRAGMA freelist_count").fetchone()[0],
+        'tamanho': paginas_depois * tamanho_pagina,
+    }
+
+def registar_relatorio_renderizado(analise_id, nome_arquivo, sha256, tamanho, digest=None, tempo_render=0):
+    with transacao() as cursor:
+        if digest:
+            _guardar_pdf_em_cache(cursor, digest, sha256, tamanho, tempo_render)
+        cursor.execute(_INSERIR_RELATORIO, (analise_id, nome_arquivo, sha256, tamanho, analise_id))
+        return cursor.lastrowid
 
 def get_latest_report(analise_id):
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    conn.row_factory = dict_factory
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, nome_arquivo FROM relatorios WHERE analise_id = ? ORDER BY data_geracao DESC LIMIT 1", (analise_id,))
-    report = cursor.fetchone()
-    conn.close()
-    return report
+    with transacao(dict_factory) as cursor:
+        cursor.execute("SELECT id, nome_arquivo FROM relatorios WHERE analise_id = ? ORDER BY data_geracao DESC, id DESC LIMIT 1", (analise_id,))
+        return cursor.fetchone()
 
 def get_report_data_by_id(relatorio_id):
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    conn.row_factory = dict_factory
-    cursor = conn.cursor()
-    cursor.execute("SELECT nome_arquivo, dados_pdf FROM relatorios WHERE id = ?", (relatorio_id,))
-    report_data = cursor.fetchone()
-    conn.close()
-    return report_data
+    with transacao(dict_factory) as cursor:
+        cursor.execute("SELECT nome_arquivo, sha256, tamanho, data_geracao FROM relatorios WHERE id = ?", (relatorio_id,))
+        return cursor.fetchone()
 
 def delete_analise_by_id(analise_id, username):
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    cursor = conn.cursor()
-    cursor.execute("PRAGMA foreign_keys = ON;")
-    cursor.execute("DELETE FROM analises WHERE id = ? AND username = ?", (analise_id, username))
-    conn.commit()
-    changes = conn.total_changes
-    conn.close()
-    return changes > 0
+    with transacao(imediata=True) as cursor:
+        cursor.execute("SELECT 1 FROM analises WHERE id = ? AND username = ?", (analise_id, username))
+        if not cursor.fetchone():
+            return False
+        _atualizar_rollups(cursor, _contribuicao(cursor, analise_id), {})
+        cursor.execute("DELETE FROM analises WHERE id = ? AND username = ?", (analise_id, username))
+        return cursor.rowcount > 0
 
-def update_image_path(analise_id, secao, filename):
-    column_name = f"{secao.lower()}_img_path"
-    conn = sqlite3.connect(DB_NAME, timeout=15)
-    cursor = conn.cursor()
-    cursor.execute(f"UPDATE analises SET {column_name} = ? WHERE id = ?", (filename, analise_id))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+def update_image_path(analise_id, secao, filename, preparar=None):
+    """Grava a imagem da secção e devolve o nome da que estava lá antes (ou None).
+
+    `preparar()` corre já com o lock de escrita, antes da gravação: é aí que o ficheiro é criado, para
+    que remover_imagem_se_orfa, noutro processo, não o apague entre a criação e a nova referência.
+    """
+    column_name = {'RECEITA': 'receita_img_path', 'DESPESA': 'despesa_img_path'}[secao.upper()]
+    with transacao(imediata=True) as cursor:
+        if preparar:
+            preparar()
+        cursor.execute(f"SELECT {column_name} FROM analises WHERE id = ?", (analise_id,))
+        row = cursor.fetchone()
+        cursor.execute(f"UPDATE analises SET {column_name} = ? WHERE id = ?", (filename, analise_id))
+        return row[0] if row else None
+
+def imagens_em_uso():
+    with transacao() as cursor:
+        cursor.execute("SELECT receita_img_path FROM analises WHERE receita_img_path IS NOT NULL UNION SELECT despesa_img_path FROM analises WHERE despesa_img_path IS NOT NULL")
+        return {row[0] for row in cursor.fetchall()}
+
+def imagem_em_uso(filename):
+    with transacao() as cursor:
+        cursor.execute("SELECT 1 FROM analises WHERE receita_img_path = ? OR despesa_img_path = ? LIMIT 1", (filename, filename))
+        return cursor.fetchone() is not None
+
+def remover_imagem_se_orfa(filename, remover):
+    """Chama remover() se nenhuma análise usar a imagem; devolve True se a chamou.
+
+    A verificação e a remoção correm com o lock de escrita, para que nenhuma gravação (de qualquer
+    processo) passe a usar a imagem entretanto.
+    """
+    with transacao(imediata=True) as cursor:
+        cursor.execute("SELECT 1 FROM analises WHERE receita_img_path = ? OR despesa_img_path = ? LIMIT 1", (filename, filename))
+        if cursor.fetchone():
+            return False
+        remover()
+        return True
+
+
+def iniciar_verificacao_site(analise_id, repetir=False, expiradas_antes=None):
+    """Marca a verificação como pendente. Devolve False se já existir (ou, com `repetir`, se ainda estiver a correr)."""
+    with transacao() as cursor:
+        if repetir:
+            cursor.execute("""INSERT INTO verificacoes_site (analise_id, estado, atualizada_em) VALUES (?, 'pendente', ?)
+                              ON CONFLICT(analise_id) DO UPDATE SET estado = 'pendente', erro = NULL, atualizada_em = excluded.atualizada_em
+                              WHERE estado != 'pendente' OR atualizada_em < ?""", (analise_id, datetime.now(), expiradas_antes or datetime.now()))
+        else:
+            cursor.execute("INSERT OR IGNORE INTO verificacoes_site (analise_id, estado, atualizada_em) VALUES (?, 'pendente', ?)", (analise_id, datetime.now()))
+        return cursor.rowcount > 0
+
+def guardar_verificacao_site(analise_id, sugestoes, paginas, erro=None):
+    with transacao() as cursor:
+        cursor.execute("SELECT 1 FROM analises WHERE id = ?", (analise_id,))
+        if not cursor.fetchone():
+            return False
+        cursor.execute("DELETE FROM sugestoes WHERE analise_id = ?", (analise_id,))
+        cursor.executemany("INSERT INTO sugestoes (analise_id, chave, valor, evidencia, link) VALUES (?, ?, ?, ?, ?)",
+                           [(analise_id, chave, s['valor'], s['evidencia'], s['link']) for chave, s in sugestoes.items()])
+        cursor.execute("""INSERT INTO verificacoes_site (analise_id, estado, erro, paginas, atualizada_em) VALUES (?, ?, ?, ?, ?)
+                          ON CONFLICT(analise_id) DO UPDATE SET estado = excluded.estado, erro = excluded.erro,
+                              paginas = excluded.paginas, atualizada_em = excluded.atualizada_em""",
+                       (analise_id, 'erro' if erro and not sugestoes else 'concluida', erro, json.dumps(paginas), datetime.now()))
+        return True
+
+def obter_verificacao_site(analise_id, username):
+    with transacao(dict_factory) as cursor:
+        cursor.execute("""SELECT v.estado, v.erro, v.paginas, v.atualizada_em FROM analises a
+                          LEFT JOIN verificacoes_site v ON v.analise_id = a.id WHERE a.id = ? AND a.username = ?""", (analise_id, username))
+        verificacao = cursor.fetchone()
+        if not verificacao:
+            return None
+        verificacao['paginas'] = json.loads(verificacao['paginas']) if verificacao['paginas'] else []
+        cursor.execute("SELECT chave, valor, evidencia, link FROM sugestoes WHERE analise_id = ?", (analise_id,))
+        verificacao['sugestoes'] = {s.pop('chave'): s for s in cursor.fetchall()}
+    return verificacao
+
+def analises_por_verificar(username=None, todas=False):
+    condicoes, params = [], []
+    if username:
+        condicoes.append("a.username = ?")
+        params.append(username)
+    if not todas:
+        condicoes.append("v.analise_id IS NULL")
+    filtro = (" WHERE " + " AND ".join(condicoes)) if condicoes else ""
+    with transacao() as cursor:
+        cursor.execute(f"SELECT a.id, a.site_url, a.tipo_analise FROM analises a LEFT JOIN verificacoes_site v ON v.analise_id = a.id{filtro} ORDER BY a.id", params)
+        return cursor.fetchall()
+
+def criar_job_relatorio(analise_id, username, tipo_relatorio, site_url, base_url, html, digest=None):
+    agora = datetime.now()
+    with transacao() as cursor:
+        # Um novo pedido para a mesma análise torna obsoletos os que ainda não terminaram.
+        cursor.execute("UPDATE jobs_relatorio SET estado = 'cancelado', html = NULL, atualizado_em = ? WHERE analise_id = ? AND estado IN ('pendente', 'processando')", (agora, analise_id))
+        cursor.execute("INSERT INTO jobs_relatorio (analise_id, username, tipo_relatorio, site_url, base_url, html, digest, estado, criado_em, atualizado_em) VALUES (?, ?, ?, ?, ?, ?, ?, 'pendente', ?, ?)",
+                       (analise_id, username, tipo_relatorio, site_url, base_url, html, digest, agora, agora))
+        return cursor.lastrowid
+
+def reivindicar_job_relatorio():
+    while True:
+        with transacao(dict_factory) as cursor:
+            cursor.execute("SELECT id, analise_id, site_url, base_url, html FROM jobs_relatorio WHERE estado = 'pendente' ORDER BY id LIMIT 1")
+            job = cursor.fetchone()
+            if not job:
+                return None
+            cursor.execute("UPDATE jobs_relatorio SET estado = 'processando', atualizado_em = ? WHERE id = ? AND estado = 'pendente'", (datetime.now(), job['id']))
+            if cursor.rowcount:
+                return job
+        # Outro processo reivindicou o mesmo job entre o SELECT e o UPDATE; tenta o seguinte.
+
+def concluir_job_relatorio(job_id, nome_arquivo, sha256, tamanho, tempo_render=0):
+    with transacao() as cursor:
+        cursor.execute("SELECT analise_id, digest FROM jobs_relatorio WHERE id = ? AND estado = 'processando'", (job_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        if row[1]:
+            _guardar_pdf_em_cache(cursor, row[1], sha256, tamanho, tempo_render)
+        cursor.execute(_INSERIR_RELATORIO, (row[0], nome_arquivo, sha256, tamanho, row[0]))
+        relatorio_id = cursor.lastrowid
+        cursor.execute("UPDATE jobs_relatorio SET estado = 'concluido', relatorio_id = ?, html = NULL, atualizado_em = ? WHERE id = ?", (relatorio_id, datetime.now(), job_id))
+        return relatorio_id
+
+def falhar_job_relatorio(job_id, erro):
+    with transacao() as cursor:
+        cursor.execute("UPDATE jobs_relatorio SET estado = 'erro', erro = ?, html = NULL, atualizado_em = ? WHERE id = ? AND estado = 'processando'", (erro, datetime.now(), job_id))
+
+def cancelar_job_relatorio(job_id, username):
+    with transacao() as cursor:
+        cursor.execute("UPDATE jobs_relatorio SET estado = 'cancelado', html = NULL, atualizado_em = ? WHERE id = ? AND username = ? AND estado IN ('pendente', 'processando')", (datetime.now(), job_id, username))
+        return cursor.rowcount > 0
+
+def obter_job_relatorio(job_id, username):
+    with transacao(dict_factory) as cursor:
+        cursor.execute("SELECT id, analise_id, tipo_relatorio, estado, relatorio_id, erro, criado_em, atualizado_em FROM jobs_relatorio WHERE id = ? AND username = ?", (job_id, username))
+        return cursor.fetchone()
+
+def tocar_job_relatorio(job_id):
+    with transacao() as cursor:
+        cursor.execute("UPDATE jobs_relatorio SET atualizado_em = ? WHERE id = ? AND estado = 'processando'", (datetime.now(), job_id))
+
+def recuperar_jobs_relatorio(expirados_antes):
+    # Jobs que ficaram em 'processando' quando um processo morreu voltam para a fila.
+    with transacao() as cursor:
+        # Quase nunca há jobs abandonados: verifica-se sem pedir o lock de escrita.
+        cursor.execute("SELECT 1 FROM jobs_relatorio WHERE estado = 'processando' AND atualizado_em < ? LIMIT 1", (expirados_antes,))
+        if cursor.fetchone() is None:
+            return 0
+        cursor.execute("UPDATE jobs_relatorio SET estado = 'pendente', atualizado_em = ? WHERE estado = 'processando' AND atualizado_em < ?", (datetime.now(), expirados_antes))
+        return cursor.rowcount
+
+def _incrementar_estatistica(cursor, chave, valor=1):
+    cursor.execute("INSERT INTO cache_pdf_estatisticas (chave, valor) VALUES (?, ?) ON CONFLICT(chave) DO UPDATE SET valor = valor + excluded.valor", (chave, valor))
+
+def _guardar_pdf_em_cache(cursor, digest, sha256, tamanho, tempo_render):
+    agora = datetime.now()
+    cursor.execute("INSERT OR REPLACE INTO cache_pdf (digest, sha256, tamanho, tempo_render, criado_em, ultimo_acesso) VALUES (?, ?, ?, ?, ?, ?)",
+                   (digest, sha256, tamanho, tempo_render, agora, agora))
+    # Despeja as entradas menos usadas recentemente até caber no limite configurado.
+    cursor.execute("""DELETE FROM cache_pdf WHERE digest IN (
+                          SELECT digest FROM (SELECT digest, SUM(tamanho) OVER (ORDER BY ultimo_acesso DESC, digest) AS acumulado FROM cache_pdf)
+                          WHERE acumulado > ?)""", (CACHE_PDF_MAX_BYTES,))
+    if cursor.rowcount > 0:
+        _incrementar_estatistica(cursor, 'despejos', cursor.rowcount)
+
+def obter_pdf_em_cache(digest):
+    with transacao() as cursor:
+        cursor.execute("SELECT sha256, tamanho, tempo_render FROM cache_pdf WHERE digest = ?", (digest,))
+        row = cursor.fetchone()
+        if row and not os.path.exists(caminho_pdf(row[0])):
+            cursor.execute("DELETE FROM cache_pdf WHERE digest = ?", (digest,))
+            row = None
+        if not row:
+            _incrementar_estatistica(cursor, 'falhas')
+            return None
+        cursor.execute("UPDATE cache_pdf SET ultimo_acesso = ? WHERE digest = ?", (datetime.now(), digest))
+        _incrementar_estatistica(cursor, 'acertos')
+        _incrementar_estatistica(cursor, 'tempo_poupado', row[2])
+        return {'sha256': row[0], 'tamanho': row[1]}
+
+def estatisticas_cache_pdf():
+    with transacao() as cursor:
+        cursor.execute("SELECT chave, valor FROM cache_pdf_estatisticas")
+        estatisticas = {'acertos': 0, 'falhas': 0, 'despejos': 0, 'tempo_poupado': 0.0}
+        estatisticas.update(dict(cursor.fetchall()))
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(tamanho), 0) FROM cache_pdf")
+        estatisticas['entradas'], estatisticas['tamanho'] = cursor.fetchone()
+    return estatisticas
+
+def _filtro_rollup(tipo_analise, inicio, fim, prefixo=''):
+    condicoes, params = [], []
+    if tipo_analise:
+        condicoes.append(f"{prefixo}tipo_analise = ?")
+        params.append(tipo_analise)
+    if inicio:
+        condicoes.append(f"{prefixo}dia >= ?")
+        params.append(inicio)
+    if fim:
+        condicoes.append(f"{prefixo}dia <= ?")
+        params.append(fim)
+    return (" WHERE " + " AND ".join(condicoes)) if condicoes else "", params
+
+def obter_analytics(tipo_analise=None, inicio=None, fim=None, limite_criterios=20):
+    filtro, params = _filtro_rollup(tipo_analise, inicio, fim)
+    with transacao(dict_factory) as cursor:
+        cursor.execute(f"SELECT COALESCE(SUM(total), 0) AS total, SUM(soma_indice) AS soma_indice FROM rollup_analises{filtro}", params)
+        geral = cursor.fetchone()
+        total = geral['total']
+        cursor.execute(f"SELECT tipo_analise, SUM(total) AS total, SUM(soma_indice) / SUM(total) AS media_indice FROM rollup_analises{filtro} GROUP BY tipo_analise HAVING SUM(total) > 0", params)
+        por_tipo = cursor.fetchall()
+        cursor.execute(f"SELECT selo, SUM(total) AS total FROM rollup_analises{filtro} GROUP BY selo HAVING SUM(total) > 0 ORDER BY total DESC", params)
+        selos = cursor.fetchall()
+        cursor.execute(f"SELECT secao, faixa, SUM(total) AS total, SUM(soma_score) AS soma FROM rollup_secoes{filtro} GROUP BY secao, faixa HAVING SUM(total) > 0", params)
+        secoes = {}
+        for linha in cursor.fetchall():
+            secao = secoes.setdefault(linha['secao'], {'secao': linha['secao'], 'total': 0, 'soma': 0.0, 'distribuicao': [0] * 10})
+            secao['total'] += linha['total']
+            secao['soma'] += linha['soma']
+            secao['distribuicao'][linha['faixa']] = linha['total']
+        filtro_c, params_c = _filtro_rollup(tipo_analise, inicio, fim, prefixo='r.')
+        cursor.execute(f"""SELECT c.secao, c.criterio, SUM(r.falhas) AS falhas, GROUP_CONCAT(DISTINCT r.tipo_analise) AS tipos
+                           FROM rollup_criterios r JOIN criterios c ON c.id = r.criterio_id
+                           {filtro_c} GROUP BY r.criterio_id HAVING SUM(r.falhas) > 0 ORDER BY falhas DESC LIMIT ?""", params_c + [limite_criterios])
+        criterios = cursor.fetchall()
+    for secao in secoes.values():
+        secao['media'] = secao.pop('soma') / secao['total']
+    # A taxa de falha de um critério conta só as análises dos tipos que o têm (no catálogo atual ou com falhas registadas).
+    totais_tipo = {linha['tipo_analise']: linha['total'] for linha in por_tipo}
+    matrizes = logic.carregar_criterios()
+    for criterio in criterios:
+        tipos = set(criterio.pop('tipos').split(','))
+        tipos.update(tipo for tipo in totais_tipo
+                     if any(item['criterio'] == criterio['criterio'] for item in matrizes.get(tipo, {}).get(criterio['secao'], [])))
+        avaliadas = sum(totais_tipo.get(tipo, 0) for tipo in tipos)
+        criterio['taxa_falha'] = criterio['falhas'] / avaliadas * 100 if avaliadas else 0
+    return {
+        'total_analises': total,
+        'media_indice': geral['soma_indice'] / total if total else 0,
+        'por_tipo': por_tipo,
+        'selos': selos,
+        'secoes': sorted(secoes.values(), key=lambda s: s['media']),
+        'criterios_mais_falhados': criterios,
+    }
@@ -0,0 +1,107 @@
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import db
+import logic
+import metricas
+
+# Número de PDFs renderizados em simultâneo por processo da aplicação.
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', 2))
+# Um job em 'processando' sem sinal de vida há mais do que isto é considerado abandonado.
+JOB_LEASE_SEGUNDOS = int(os.environ.get('PDF_JOB_LEASE', 300))
+INTERVALO_POLLING = 1.0
+# Recuperação de jobs abandonados e sinal de vida dos jobs em curso: bastam algumas vezes por lease.
+INTERVALO_LEASE = max(JOB_LEASE_SEGUNDOS / 10, INTERVALO_POLLING)
+
+_lock = threading.Lock()
+_acordar = threading.Event()
+_estado = {'pid': None, 'executor': None, 'em_curso': {}}
+
+def _renderizar(html_string, site_url, base_url):
+    inicio = time.perf_counter()
+    nome_arquivo, dados_pdf = logic.gerar_relatorio_com_weasyprint(html_string, site_url, base_url=base_url)
+    tempo_render = time.perf_counter() - inicio
+    if not (nome_arquivo and dados_pdf):
+        return None, None, None, tempo_render
+    # O PDF é gravado diretamente pelo processo que o gerou; só o hash volta ao processo principal.
+    sha256, tamanho = db.guardar_ficheiro_pdf(dados_pdf)
+    return nome_arquivo, sha256, tamanho, tempo_render
+
+def _terminar(job_id, future):
+    _estado['em_curso'].pop(job_id, None)
+    try:
+        nome_arquivo, sha256, tamanho, tempo_render = future.result()
+        # O PDF é renderizado noutro processo; só o tempo medido lá volta para as métricas deste.
+        metricas.observar_fase('write_pdf', tempo_render)
+        if nome_arquivo and sha256:
+            db.concluir_job_relatorio(job_id, nome_arquivo, sha256, tamanho, tempo_render)
+        else:
+            db.falhar_job_relatorio(job_id, 'A renderização não produziu nenhum PDF.')
+    except Exception:
+        db.falhar_job_relatorio(job_id, traceback.format_exc(limit=3))
+    _acordar.set()
+
+def _despachar():
+    executor = _estado['executor']
+    ultima_manutencao = 0
+    while True:
+        try:
+            if time.monotonic() - ultima_manutencao >= INTERVALO_LEASE:
+                ultima_manutencao = time.monotonic()
+                db.recuperar_jobs_relatorio(datetime.now() - timedelta(seconds=JOB_LEASE_SEGUNDOS))
+                for job_id in list(_estado['em_curso']):
+                    db.tocar_job_relatorio(job_id)
+            while len(_estado['em_curso']) < PDF_WORKERS:
+                job = db.reivindicar_job_relatorio()
+                if not job:
+                    break
+                future = executor.submit(_renderizar, job['html'], job['site_url'], job['base_url'])
+                _estado['em_curso'][job['id']] = future
+                future.add_done_callback(lambda f, job_id=job['id']: _terminar(job_id, f))
+        except Exception:
+            traceback.print_exc()
+        _acordar.wait(INTERVALO_POLLING)
+        _acordar.clear()
+
+def iniciar():
+    # Depois de um fork (gunicorn) o processo filho não herda a thread nem o pool.
+    with _lock:
+        if _estado['pid'] == os.getpid():
+            return
+        _estado['executor'] = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                                                  initializer=logic.aquecer_weasyprint)
+        _estado['em_curso'] = {}
+        _estado['pid'] = os.getpid()
+        threading.Thread(target=_despachar, name='fila-relatorios', daemon=True).start()
+
+def _verificar_pdf():
+    return os.getpid(), logic.weasyprint_disponivel()
+
+def executor():
+    """O pool de renderização deste processo, partilhado com os relatórios em lote pedidos pela aplicação."""
+    iniciar()
+    return _estado['executor']
+
+def aquecer():
+    """Arranca já todos os processos de renderização (cada um aquece o WeasyPrint ao iniciar) e espera por eles.
+
+    Levanta RuntimeError se algum deles não conseguir renderizar PDFs.
+    """
+    iniciar()
+    # Tarefas em simultâneo obrigam o pool a criar todos os processos.
+    futuros = [_estado['executor'].submit(_verificar_pdf) for _ in range(PDF_WORKERS)]
+    resultados = dict(f.result() for f in futuros)
+    if not all(resultados.values()):
+        raise RuntimeError("O WeasyPrint não consegue renderizar PDFs nos processos de renderização.")
+    return len(resultados)
+
+def enfileirar(analise_id, username, tipo_relatorio, site_url, base_url, html_string, digest=None):
+    iniciar()
+    job_id = db.criar_job_relatorio(analise_id, username, tipo_relatorio, site_url, base_url, html_string, digest)
+    _acordar.set()
+    return job_id
@@ -0,0 +1,72 @@
+import argparse
+import os
+import random
+
+from werkzeug.security import generate_password_hash
+
+import db
+import logic
+
+TIPOS_ANALISE = ("Prefeitura", "Câmara")
+SENHA_PADRAO = "benchmark"
+
+def gerar_respostas(rng, criterios_analise, taxa_falha=0.25, taxa_preenchimento=1.0):
+    """Respostas aleatórias (mas reprodutíveis com o mesmo `rng`) para uma matriz de critérios."""
+    respostas = {}
+    for secao, perguntas in criterios_analise.items():
+        for item in perguntas:
+            for sub in item["subcriterios"]:
+                if rng.random() >= taxa_preenchimento:
+                    continue
+                chave = f"{secao}_{item['criterio']}_{sub}"
+                if rng.random() < taxa_falha:
+                    respostas[chave] = logic.NAO_ATENDE
+                    if rng.random() < 0.5:
+                        respostas[f"{chave}_obs"] = "Informação não localizada no portal."
+                    if rng.random() < 0.2:
+                        respostas[f"{chave}_link"] = "https://exemplo.gov.br/transparencia"
+                else:
+                    respostas[chave] = "Atende"
+    return respostas
+
+def popular(usuarios=10, analises_por_usuario=20, taxa_falha=0.25, semente=42):
+    """Cria utilizadores (bench_0, bench_1, ...) e análises pontuadas na base de dados atual (db.DB_NAME).
+
+    Devolve a lista de (username, analise_id, tipo_analise) criados.
+    """
+    rng = random.Random(semente)
+    db.init_db()
+    matriz = logic.carregar_criterios()
+    # Um único hash para todos: gerar hashes de senha é propositadamente lento.
+    password_hash = generate_password_hash(SENHA_PADRAO)
+    criadas = []
+    for u in range(usuarios):
+        username = f"bench_{u}"
+        db.add_new_user(username, password_hash)
+        for a in range(analises_por_usuario):
+            tipo_analise = TIPOS_ANALISE[a % len(TIPOS_ANALISE)]
+            site_url = f"https://municipio{a}.{tipo_analise.lower()}.gov.br"
+            analise_id, _ = db.carregar_ou_criar_analise(username, site_url, f"Município {a} ({tipo_analise})", tipo_analise)
+            # Algumas análises ficam a meio, como acontece no uso real.
+            preenchimento = 1.0 if rng.random() < 0.7 else rng.uniform(0.1, 0.9)
+            db.salvar_progresso(analise_id, gerar_respostas(rng, matriz[tipo_analise], taxa_falha, preenchimento))
+            criadas.append((username, analise_id, tipo_analise))
+    return criadas
+
+def main():
+    parser = argparse.ArgumentParser(description="Popula uma base de dados com utilizadores e análises sintéticas.")
+    parser.add_argument('--db', default='bench.db', help="Ficheiro SQLite a popular (por omissão bench.db, nunca a base de produção).")
+    parser.add_argument('--usuarios', type=int, default=10)
+    parser.add_argument('--analises-por-usuario', type=int, default=20)
+    parser.add_argument('--taxa-falha', type=float, default=0.25, help="Probabilidade de cada subcritério ficar como 'Não Atende'.")
+    parser.add_argument('--semente', type=int, default=42)
+    args = parser.parse_args()
+
+    db.DB_NAME = os.path.abspath(args.db)
+    # Os critérios são lidos com caminhos relativos à raiz do projeto.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    criadas = popular(args.usuarios, args.analises_por_usuario, args.taxa_falha, args.semente)
+    print(f"{args.usuarios} utilizadores e {len(criadas)} análises criados em '{args.db}' (senha: '{SENHA_PADRAO}').")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,15 @@
+import os
+
+import aquecimento
+
+# Uso: gunicorn -c gunicorn.conf.py app:app
+# Com preload, a aplicação (esquema, critérios, templates) é carregada e aquecida uma vez no mestre.
+preload_app = True
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+def post_fork(server, worker):
+    # Pools de processos e threads não sobrevivem ao fork: cada worker arranca os seus e aquece o WeasyPrint.
+    aquecimento.aquecer_worker()
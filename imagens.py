@@ -0,0 +1,158 @@
+import hashlib
+import os
+import tempfile
+import time
+import traceback
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+import db
+
+# Formatos aceites (detetados pelo conteúdo, não pela extensão) -> extensão do original guardado.
+FORMATOS = {'PNG': '.png', 'JPEG': '.jpg', 'GIF': '.gif'}
+# Derivado para o PDF: cabe numa página A4 a ~150 dpi.
+TAMANHO_IMPRESSAO = (1600, 1600)
+TAMANHO_MINIATURA = (320, 320)
+QUALIDADE_JPEG = 85
+# Recusa imagens descomprimidas com mais pixels do que isto (proteção contra "decompression bombs").
+MAX_PIXELS = 50_000_000
+IMAGEM_WORKERS = int(os.environ.get('IMAGEM_WORKERS', 2))
+
+_executor = ThreadPoolExecutor(max_workers=IMAGEM_WORKERS, thread_name_prefix='imagens')
+
+class ImagemInvalida(ValueError):
+    pass
+
+def caminho_derivado(pasta, nome, tipo):
+    """Caminho do derivado ('impressao' ou 'miniatura') de uma imagem guardada com o nome `nome`."""
+    base, _ = os.path.splitext(nome)
+    return os.path.join(pasta, f"{base}_{tipo}.jpg")
+
+def _abrir(dados):
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', Image.DecompressionBombWarning)
+        try:
+            imagem = Image.open(BytesIO(dados))
+            formato = imagem.format
+            if formato not in FORMATOS:
+                raise ImagemInvalida(f"Formato não suportado: {formato or 'desconhecido'}.")
+            if imagem.width * imagem.height > MAX_PIXELS:
+                raise ImagemInvalida("Imagem demasiado grande.")
+            imagem.verify()
+        except ImagemInvalida:
+            raise
+        except (OSError, SyntaxError, ValueError, Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+            raise ImagemInvalida("O ficheiro não é uma imagem válida.") from e
+    return formato
+
+def _gravar(caminho, dados):
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    fd, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(dados)
+    os.replace(temporario, caminho)
+
+def _gravar_jpeg(imagem, caminho, tamanho):
+    copia = imagem.copy()
+    copia.thumbnail(tamanho, Image.LANCZOS)
+    saida = BytesIO()
+    copia.save(saida, 'JPEG', quality=QUALIDADE_JPEG, optimize=True, progressive=True)
+    _gravar(caminho, saida.getvalue())
+
+def gerar_derivados(pasta, nome):
+    """Gera (se ainda não existirem) a versão para impressão e a miniatura de uma imagem guardada."""
+    impressao = caminho_derivado(pasta, nome, 'impressao')
+    miniatura = caminho_derivado(pasta, nome, 'miniatura')
+    if os.path.exists(impressao) and os.path.exists(miniatura):
+        return
+    try:
+        original = Image.open(os.path.join(pasta, nome))
+    except FileNotFoundError:
+        # Já substituída e removida como órfã antes de chegar a vez desta tarefa.
+        return
+    with original:
+        imagem = ImageOps.exif_transpose(original)
+        if imagem.mode in ('RGBA', 'LA', 'P'):
+            # JPEG não tem transparência: o fundo passa a branco, como fica no papel.
+            imagem = imagem.convert('RGBA')
+            fundo = Image.new('RGB', imagem.size, (255, 255, 255))
+            fundo.paste(imagem, mask=imagem.getchannel('A'))
+            imagem = fundo
+        else:
+            imagem = imagem.convert('RGB')
+        _gravar_jpeg(imagem, impressao, TAMANHO_IMPRESSAO)
+        _gravar_jpeg(imagem, miniatura, TAMANHO_MINIATURA)
+
+def _remover_se_orfa(pasta, nome):
+    def remover():
+        for caminho in (os.path.join(pasta, nome), caminho_derivado(pasta, nome, 'impressao'), caminho_derivado(pasta, nome, 'miniatura')):
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+    if nome:
+        db.remover_imagem_se_orfa(nome, remover)
+
+def recolher_orfas(pasta, idade_minima=3600):
+    """Apaga as imagens (e derivados) que nenhuma análise usa e que não mudaram há `idade_minima` segundos.
+
+    Devolve (ficheiros, bytes) removidos.
+    """
+    limite = time.time() - idade_minima
+    removidos, libertados = 0, 0
+    em_uso = db.imagens_em_uso()
+    bases_em_uso = {os.path.splitext(nome)[0] for nome in em_uso}
+    for raiz, _, ficheiros in os.walk(pasta):
+        for ficheiro in ficheiros:
+            caminho = os.path.join(raiz, ficheiro)
+            nome = os.path.relpath(caminho, pasta).replace(os.sep, '/')
+            base = os.path.splitext(nome)[0]
+            for sufixo in ('_impressao', '_miniatura'):
+                if base.endswith(sufixo):
+                    base = base[:-len(sufixo)]
+            try:
+                if nome in em_uso or base in bases_em_uso or os.path.getmtime(caminho) > limite:
+                    continue
+                tamanho = os.path.getsize(caminho)
+                os.remove(caminho)
+            except FileNotFoundError:
+                continue
+            removidos += 1
+            libertados += tamanho
+    return removidos, libertados
+
+def _em_segundo_plano(funcao, *args):
+    def tarefa():
+        try:
+            funcao(*args)
+        except Exception:
+            traceback.print_exc()
+    return _executor.submit(tarefa)
+
+def guardar_imagem_analise(pasta, analise_id, secao, dados):
+    """Valida e guarda uma imagem de justificativa, deduplicada pelo hash do conteúdo.
+
+    Os derivados são gerados e a imagem substituída é apagada (se mais nenhuma análise a usar)
+    em segundo plano. Levanta ImagemInvalida se o conteúdo não for PNG, JPEG ou GIF.
+    """
+    formato = _abrir(dados)
+    sha256 = hashlib.sha256(dados).hexdigest()
+    nome = f"{sha256[:2]}/{sha256}{FORMATOS[formato]}"
+    caminho = os.path.join(pasta, nome)
+
+    def garantir_ficheiro():
+        if os.path.exists(caminho):
+            # Data renovada: a recolha de órfãs (manutencao.py) não apaga ficheiros recentes.
+            os.utime(caminho)
+        else:
+            _gravar(caminho, dados)
+
+    # O ficheiro é criado (ou renovado) com o lock de escrita da base de dados, tal como a remoção de órfãs.
+    anterior = db.update_image_path(analise_id, secao, nome, garantir_ficheiro)
+    _em_segundo_plano(gerar_derivados, pasta, nome)
+    if anterior and anterior != nome:
+        _em_segundo_plano(_remover_se_orfa, pasta, anterior)
+    return nome
@@ -1,27 +1,223 @@
+import hashlib
 import json
+import logging
 import os
+import threading
+import time
 from datetime import datetime
-from functools import lru_cache
+from typing import NamedTuple
 from urllib.parse import urlparse
-from weasyprint import HTML
+import numpy as np
 
+import metricas
 
+logger = logging.getLogger(__name__)
 
-@lru_cache(maxsize=4)
-def carregar_criterios(caminho_arquivo="data/criterios_analise_site.json"):
+CAMINHO_CRITERIOS = "data/criterios_analise_site.json"
+# De quanto em quanto tempo (s) se verifica se o ficheiro de critérios mudou.
+INTERVALO_VERIFICACAO_CRITERIOS = 2.0
+
+class Catalogo(NamedTuple):
+    versao: str             # hash do conteúdo do ficheiro
+    criterios: dict         # tipo de análise -> secção -> critérios (o JSON)
+    versoes_tipo: dict      # tipo de análise -> hash só dos critérios desse tipo
+    matrizes: dict          # tipo de análise -> MatrizCompilada
+    mapa: dict              # ver mapa_chaves_respostas
+
+_catalogo_lock = threading.Lock()
+_catalogos = {}     # caminho -> (assinatura do ficheiro, instante da última verificação, Catalogo)
+_por_versao = {}    # versão -> Catalogo; voltar a uma versão anterior não obriga a recompilar
+
+def _ler_catalogo(caminho_arquivo, dados):
+    versao = hashlib.sha256(dados).hexdigest()[:16]
+    if versao in _por_versao:
+        return _por_versao[versao]
     try:
-        with open(caminho_arquivo, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        raise FileNotFoundError(f"ERRO: O arquivo de dados '{caminho_arquivo}' não foi encontrado.")
+        criterios = json.loads(dados)
     except json.JSONDecodeError:
         raise ValueError(f"ERRO: O arquivo '{caminho_arquivo}' contém um erro de formatação JSON.")
+    versoes_tipo = {
+        tipo: hashlib.sha256(json.dumps(criterios_tipo, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+        for tipo, criterios_tipo in criterios.items()
+    }
+    mapa = {}
+    for matriz in criterios.values():
+        for secao, perguntas in matriz.items():
+            for item in perguntas:
+                for sub in item["subcriterios"]:
+                    chave_base = f"{secao}_{item['criterio']}_{sub}"
+                    for sufixo, coluna in CAMPOS_RESPOSTA.items():
+                        mapa[chave_base + sufixo] = (secao, item['criterio'], sub, coluna)
+    catalogo = Catalogo(versao, criterios, versoes_tipo, {tipo: compilar_matriz(c) for tipo, c in criterios.items()}, mapa)
+    _por_versao[versao] = catalogo
+    return catalogo
+
+def catalogo(caminho_arquivo=CAMINHO_CRITERIOS):
+    """Catálogo de critérios atual, recarregado quando o ficheiro muda (mtime/tamanho), sem reiniciar a aplicação."""
+    agora = time.monotonic()
+    atual = _catalogos.get(caminho_arquivo)
+    if atual and agora - atual[1] < INTERVALO_VERIFICACAO_CRITERIOS:
+        return atual[2]
+    with _catalogo_lock:
+        atual = _catalogos.get(caminho_arquivo)
+        try:
+            estado = os.stat(caminho_arquivo)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"ERRO: O arquivo de dados '{caminho_arquivo}' não foi encontrado.")
+        assinatura = (estado.st_mtime_ns, estado.st_size)
+        if atual and atual[0] == assinatura:
+            novo = atual[2]
+        else:
+            with open(caminho_arquivo, 'rb') as f:
+                novo = _ler_catalogo(caminho_arquivo, f.read())
+        _catalogos[caminho_arquivo] = (assinatura, agora, novo)
+        return novo
+
+def carregar_criterios(caminho_arquivo=CAMINHO_CRITERIOS):
+    return catalogo(caminho_arquivo).criterios
+
+def versao_criterios(caminho_arquivo=CAMINHO_CRITERIOS):
+    return catalogo(caminho_arquivo).versao
+
+def versao_tipo(tipo_analise, caminho_arquivo=CAMINHO_CRITERIOS):
+    """Versão dos critérios de um tipo de análise; só muda quando os critérios desse tipo mudam."""
+    return catalogo(caminho_arquivo).versoes_tipo.get(tipo_analise)
 
 def criar_pastas_necessarias():
     os.makedirs("relatorios", exist_ok=True)
 
+PESOS = {"ESSENCIAL": 2.0, "OBRIGATÓRIA": 1.5, "RECOMENDADA": 1.0}
+NAO_ATENDE = "Não Atende"
+# Códigos gravados na tabela `respostas` para o estado de cada subcritério.
+STATUS_CODIGOS = {"Atende": 0, NAO_ATENDE: 1}
+STATUS_NOMES = {codigo: nome for nome, codigo in STATUS_CODIGOS.items()}
+# Sufixo da chave de resposta -> coluna da tabela `respostas`.
+CAMPOS_RESPOSTA = {"": "status", "_obs": "observacao", "_link": "link"}
+
+class MatrizCompilada(NamedTuple):
+    secoes: list            # nomes das secções, pela ordem da matriz
+    chaves: list            # chave de resposta ("SECAO_criterio_sub") de cada coluna
+    posicao: dict           # chave -> colunas onde aparece
+    pesos: np.ndarray       # peso de cada critério
+    essencial: np.ndarray   # máscara dos critérios ESSENCIAIS
+    inicio_criterio: np.ndarray  # colunas [inicio_criterio[i], inicio_criterio[i+1]) pertencem ao critério i
+    inicio_secao: np.ndarray     # critérios [inicio_secao[j], inicio_secao[j+1]) pertencem à secção j
+
+def compilar_matriz(criterios_analise):
+    secoes, chaves, posicao = [], [], {}
+    pesos, essencial = [], []
+    inicio_criterio, inicio_secao = [0], [0]
+    for secao, perguntas in criterios_analise.items():
+        secoes.append(secao)
+        for item in perguntas:
+            classificacao = item.get("classificacao", "RECOMENDADA").upper()
+            pesos.append(PESOS.get(classificacao, 1.0))
+            essencial.append(classificacao == "ESSENCIAL")
+            for sub in item["subcriterios"]:
+                chave = f"{secao}_{item['criterio']}_{sub}"
+                posicao.setdefault(chave, []).append(len(chaves))
+                chaves.append(chave)
+            inicio_criterio.append(len(chaves))
+        inicio_secao.append(len(pesos))
+    return MatrizCompilada(
+        secoes=secoes,
+        chaves=chaves,
+        posicao=posicao,
+        pesos=np.array(pesos, dtype=np.float64),
+        essencial=np.array(essencial, dtype=bool),
+        inicio_criterio=np.array(inicio_criterio, dtype=np.intp),
+        inicio_secao=np.array(inicio_secao, dtype=np.intp),
+    )
+
+def matriz_compilada(tipo_analise, caminho_arquivo=CAMINHO_CRITERIOS):
+    return catalogo(caminho_arquivo).matrizes.get(tipo_analise)
+
+def mapa_chaves_respostas(caminho_arquivo=CAMINHO_CRITERIOS):
+    """Chave de resposta usada no formulário -> (secção, critério, subcritério, coluna)."""
+    return catalogo(caminho_arquivo).mapa
+
+def empacotar_falhas(lista_falhas, matriz):
+    status = np.zeros((len(lista_falhas), len(matriz.chaves)), dtype=bool)
+    for linha, falhas in enumerate(lista_falhas):
+        for chave in falhas:
+            if chave in matriz.posicao:
+                status[linha, matriz.posicao[chave]] = True
+    return status
+
+def empacotar_respostas(lista_respostas, matriz):
+    return empacotar_falhas([[chave for chave, valor in respostas.items() if valor == NAO_ATENDE] for respostas in lista_respostas], matriz)
+
+def _somas_por_grupo(valores, inicios):
+    # Soma as colunas de cada grupo contíguo; funciona também com grupos vazios.
+    acumulado = np.zeros((valores.shape[0], valores.shape[1] + 1), dtype=valores.dtype)
+    np.cumsum(valores, axis=1, out=acumulado[:, 1:])
+    return acumulado[:, inicios[1:]] - acumulado[:, inicios[:-1]]
+
+def calcular_selo(indice, percentual_essenciais):
+    selo = "Inexistente"
+    if indice > 0:
+        if percentual_essenciais == 100:
+            if indice >= 95: selo = "💎 Diamante"
+            elif indice >= 85: selo = "🥇 Ouro"
+            elif indice >= 75: selo = "🥈 Prata"
+            else: selo = "Elevado (não elegível para selo)"
+        else:
+            if indice >= 75: selo = "Elevado"
+            elif indice >= 50: selo = "Intermediário"
+            elif indice >= 30: selo = "Básico"
+            else: selo = "Inicial"
+    return selo
+
+def pontuar_status(status, matriz):
+    """Pontua de uma só vez todas as linhas de uma matriz de status (True = Não Atende)."""
+    falhas = _somas_por_grupo(status.astype(np.int32), matriz.inicio_criterio)
+    atende = falhas == 0
+    pontos_criterio = atende * matriz.pesos
+    pontos_secao = _somas_por_grupo(pontos_criterio, matriz.inicio_secao)
+    total_secao = _somas_por_grupo(matriz.pesos[np.newaxis, :], matriz.inicio_secao)[0]
+    total_pontos_possiveis = matriz.pesos.sum()
+    total_essenciais = int(matriz.essencial.sum())
+    pontos_obtidos = pontos_criterio.sum(axis=1)
+    essenciais_atendidos = (atende & matriz.essencial).sum(axis=1)
+
+    if total_pontos_possiveis > 0:
+        indices = (pontos_obtidos / total_pontos_possiveis * 100).tolist()
+    else:
+        indices = [0] * len(status)
+    if total_essenciais > 0:
+        percentuais = (essenciais_atendidos / total_essenciais * 100).tolist()
+    else:
+        percentuais = [100] * len(status)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.where(total_secao > 0, pontos_secao / total_secao * 100, 100.0).tolist()
+
+    resultados = []
+    for indice, percentual_essenciais, scores_linha in zip(indices, percentuais, scores):
+        resultados.append({
+            "indice": indice,
+            "selo": calcular_selo(indice, percentual_essenciais),
+            "percentual_essenciais": percentual_essenciais,
+            "scores_secao": dict(zip(matriz.secoes, scores_linha)),
+        })
+    return resultados
+
+def pontuar_analises(lista_respostas, tipo_analise):
+    matriz = matriz_compilada(tipo_analise)
+    if matriz is None:
+        return [None] * len(lista_respostas)
+    with metricas.fase('pontuacao'):
+        return pontuar_status(empacotar_respostas(lista_respostas, matriz), matriz)
+
+def pontuar_falhas(lista_falhas, tipo_analise):
+    """Como pontuar_analises, mas recebe só as chaves marcadas como "Não Atende" de cada análise."""
+    matriz = matriz_compilada(tipo_analise)
+    if matriz is None:
+        return [None] * len(lista_falhas)
+    with metricas.fase('pontuacao'):
+        return pontuar_status(empacotar_falhas(lista_falhas, matriz), matriz)
+
 def calcular_indice_e_selo(respostas, criterios_analise):
-    pesos = {"ESSENCIAL": 2.0, "OBRIGATÓRIA": 1.5, "RECOMENDADA": 1.0}
+    pesos = PESOS
     total_pontos_possiveis, pontos_obtidos = 0, 0
     total_essenciais, essenciais_atendidos = 0, 0
     for secao, perguntas in criterios_analise.items():
@@ -31,7 +227,7 @@ def calcular_indice_e_selo(respostas, criterios_analise):
             total_pontos_possiveis += peso
             chave_base = f"{secao}_{item['criterio']}"
             status_geral_atende = not any(
-                respostas.get(f"{chave_base}_{sub}") == "Não Atende" for sub in item["subcriterios"]
+                respostas.get(f"{chave_base}_{sub}") == NAO_ATENDE for sub in item["subcriterios"]
             )
             if status_geral_atende:
                 pontos_obtidos += peso
@@ -41,33 +237,37 @@ def calcular_indice_e_selo(respostas, criterios_analise):
                     essenciais_atendidos += 1
     percentual_essenciais = (essenciais_atendidos / total_essenciais * 100) if total_essenciais > 0 else 100
     indice = (pontos_obtidos / total_pontos_possiveis * 100) if total_pontos_possiveis > 0 else 0
-    selo = "Inexistente"
-    if indice > 0:
-        if percentual_essenciais == 100:
-            if indice >= 95: selo = "💎 Diamante"
-            elif indice >= 85: selo = "🥇 Ouro"
-            elif indice >= 75: selo = "🥈 Prata"
-            else: selo = "Elevado (não elegível para selo)"
-        else:
-            if indice >= 75: selo = "Elevado"
-            elif indice >= 50: selo = "Intermediário"
-            elif indice >= 30: selo = "Básico"
-            else: selo = "Inicial"
+    selo = calcular_selo(indice, percentual_essenciais)
     return {"indice": indice, "selo": selo, "percentual_essenciais": percentual_essenciais}
 
 def calcular_pontuacao_secao(respostas, perguntas_secao, nome_secao):
-    pesos = {"ESSENCIAL": 2.0, "OBRIGATÓRIA": 1.5, "RECOMENDADA": 1.0}
+    pesos = PESOS
     total_pontos_possiveis, pontos_obtidos = 0, 0
     for item in perguntas_secao:
         classificacao = item.get("classificacao", "RECOMENDADA").upper()
         peso = pesos.get(classificacao, 1.0)
         total_pontos_possiveis += peso
         chave_base = f"{nome_secao}_{item['criterio']}"
-        if not any(respostas.get(f"{chave_base}_{sub}") == "Não Atende" for sub in item["subcriterios"]):
+        if not any(respostas.get(f"{chave_base}_{sub}") == NAO_ATENDE for sub in item["subcriterios"]):
             pontos_obtidos += peso
     return (pontos_obtidos / total_pontos_possiveis * 100) if total_pontos_possiveis > 0 else 100
 
-def gerar_relatorio_com_weasyprint(html_string, site_url, base_url):
+# Substitui a data de geração no HTML do relatório para que o digest não dependa dela.
+MARCADOR_DATA_GERACAO = "__DATA_GERACAO__"
+
+def digest_relatorio(html_sem_data, caminhos_imagens, tipo_relatorio, base_url):
+    h = hashlib.sha256()
+    for parte in (versao_criterios(), tipo_relatorio, base_url, html_sem_data):
+        h.update(parte.encode('utf-8'))
+        h.update(b'\0')
+    for caminho in sorted(caminhos_imagens):
+        with open(caminho, 'rb') as f:
+            for bloco in iter(lambda: f.read(1 << 16), b''):
+                h.update(bloco)
+        h.update(b'\0')
+    return h.hexdigest()
+
+def nome_arquivo_relatorio(site_url):
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     parsed_url = urlparse(site_url)
     netloc = parsed_url.netloc
@@ -76,9 +276,31 @@ def gerar_relatorio_com_weasyprint(html_string, site_url, base_url):
     if safe_filename_part.endswith(('_', '.')):
         safe_filename_part = safe_filename_part[:-1]
     nome_base = f"Relatorio_{safe_filename_part}_{timestamp}"
-    nome_arquivo_pdf = f"{nome_base}.pdf"
+    return f"{nome_base}.pdf"
+
+def gerar_relatorio_com_weasyprint(html_string, site_url, base_url):
+    nome_arquivo_pdf = nome_arquivo_relatorio(site_url)
 
-  
+    # Importação tardia: o WeasyPrint é pesado e só é preciso para gerar PDFs.
+    from weasyprint import HTML
     pdf_data = HTML(string=html_string, base_url=base_url).write_pdf()
 
-    return nome_arquivo_pdf, pdf_data
\ No newline at end of file
+    return nome_arquivo_pdf, pdf_data
+
+_weasyprint = {'ok': False}
+
+def aquecer_weasyprint():
+    """Importa o WeasyPrint e faz uma renderização mínima, para que fontes e fontconfig já estejam carregados no primeiro relatório."""
+    try:
+        from weasyprint import HTML
+        HTML(string="<p>Aquecimento</p>").write_pdf()
+        _weasyprint['ok'] = True
+        return True
+    except Exception as e:
+        # Usado como initializer dos pools: uma exceção aqui inutilizaria o pool inteiro.
+        logger.warning("WeasyPrint indisponível (%s); os relatórios PDF vão falhar.", e)
+        return False
+
+def weasyprint_disponivel():
+    """No processo de renderização: True se o aquecimento resultou; se não, tenta de novo."""
+    return _weasyprint['ok'] or aquecer_weasyprint()
@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import time
+import traceback
+import zipfile
+from datetime import datetime, timedelta
+
+import db
+import imagens
+
+# Por omissão fica-se com os últimos N relatórios de cada análise e com todos os dos últimos X dias.
+RELATORIOS_MANTER = int(os.environ.get('RELATORIOS_MANTER', 5))
+RELATORIOS_DIAS = int(os.environ.get('RELATORIOS_DIAS', 90))
+ARQUIVO_DIR = os.environ.get('RELATORIOS_ARQUIVO_DIR', 'arquivo')
+# Jobs terminados guardam só metadados, mas acumulam-se a cada clique.
+JOBS_DIAS = 30
+# Ficheiros mais recentes do que isto nunca são apagados: podem ainda estar a ser registados na base de dados.
+IDADE_MINIMA_ORFAOS = 3600
+
+def arquivar_relatorios(manter, dias, pasta_arquivo, simular=False):
+    """Move para um ZIP os relatórios fora da retenção e apaga-os da base de dados."""
+    relatorios = db.relatorios_fora_da_retencao(manter, dias)
+    resultado = {'relatorios': len(relatorios), 'arquivo': None}
+    if simular or not relatorios:
+        return resultado
+    os.makedirs(pasta_arquivo, exist_ok=True)
+    caminho = os.path.join(pasta_arquivo, f"relatorios_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip")
+    temporario = caminho + '.tmp'
+    guardados = set()
+    with zipfile.ZipFile(temporario, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9, strict_timestamps=False) as zf:
+        for relatorio in relatorios:
+            sha256 = relatorio['sha256']
+            relatorio['pdf'] = None
+            if sha256 and os.path.exists(db.caminho_pdf(sha256)):
+                # Cada PDF entra uma só vez; vários relatórios podem apontar para o mesmo conteúdo.
+                relatorio['pdf'] = f"pdfs/{sha256}.pdf"
+                if sha256 not in guardados:
+                    zf.write(db.caminho_pdf(sha256), relatorio['pdf'])
+                    guardados.add(sha256)
+        zf.writestr('manifesto.json', json.dumps(relatorios, ensure_ascii=False, indent=2, default=str))
+    with open(temporario, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(temporario, caminho)
+    # Só se apaga depois de o arquivo estar completo no disco.
+    db.remover_relatorios([r['id'] for r in relatorios])
+    resultado['arquivo'] = caminho
+    resultado['tamanho_arquivo'] = os.path.getsize(caminho)
+    resultado['pdfs'], resultado['bytes_pdfs'] = remover_pdfs_orfaos(IDADE_MINIMA_ORFAOS, candidatos={r['sha256'] for r in relatorios if r['sha256']})
+    return resultado
+
+def remover_pdfs_orfaos(idade_minima, candidatos=None):
+    """Apaga os PDFs a que nenhum relatório nem a cache fazem referência. Devolve (ficheiros, bytes)."""
+    em_uso = db.pdfs_em_uso()
+    if candidatos is None:
+        caminhos = []
+        for raiz, _, ficheiros in os.walk(db.RELATORIOS_DIR):
+            caminhos.extend(os.path.join(raiz, f) for f in ficheiros)
+    else:
+        caminhos = [db.caminho_pdf(sha256) for sha256 in candidatos]
+    limite = time.time() - idade_minima
+    removidos, libertados = 0, 0
+    for caminho in caminhos:
+        sha256 = os.path.basename(caminho).split('.')[0]
+        try:
+            if sha256 in em_uso or os.path.getmtime(caminho) > limite:
+                continue
+            tamanho = os.path.getsize(caminho)
+            os.remove(caminho)
+        except FileNotFoundError:
+            continue
+        removidos += 1
+        libertados += tamanho
+    return removidos, libertados
+
+def executar(args):
+    inicio = time.perf_counter()
+    resumo = {'data': datetime.now().isoformat(timespec='seconds'), 'simulacao': args.simular}
+    resumo['arquivo'] = arquivar_relatorios(args.manter, args.dias, args.arquivo_dir, args.simular)
+    if not args.simular:
+        resumo['jobs_removidos'] = db.purgar_jobs_relatorio(datetime.now() - timedelta(days=JOBS_DIAS))
+        resumo['pdfs_orfaos'] = remover_pdfs_orfaos(IDADE_MINIMA_ORFAOS)
+        resumo['imagens_orfas'] = imagens.recolher_orfas(args.uploads, IDADE_MINIMA_ORFAOS)
+        if not args.sem_vacuum:
+            resumo['base_dados'] = db.compactar_base_dados(vacuum_completo=args.vacuum_completo)
+    resumo['duracao_s'] = round(time.perf_counter() - inicio, 2)
+    return resumo
+
+def main():
+    parser = argparse.ArgumentParser(description="Arquiva relatórios antigos, apaga ficheiros órfãos e compacta a base de dados. "
+                                                 "Pode correr com a aplicação a funcionar (por exemplo num cron diário).")
+    parser.add_argument('--db', default=db.DB_NAME)
+    parser.add_argument('--manter', type=int, default=RELATORIOS_MANTER, help="Relatórios mais recentes a manter por análise.")
+    parser.add_argument('--dias', type=int, default=RELATORIOS_DIAS, help="Relatórios mais recentes do que isto são sempre mantidos.")
+    parser.add_argument('--arquivo-dir', default=ARQUIVO_DIR, help="Pasta dos ZIPs com os relatórios arquivados.")
+    parser.add_argument('--uploads', default='uploads', help="Pasta das imagens de justificativa.")
+    parser.add_argument('--simular', action='store_true', help="Só mostra quantos relatórios seriam arquivados.")
+    parser.add_argument('--sem-vacuum', action='store_true', help="Não compacta a base de dados.")
+    parser.add_argument('--vacuum-completo', action='store_true',
+                        help="VACUUM completo (bloqueia escritas); necessário uma vez para ativar o vacuum incremental numa base antiga.")
+    parser.add_argument('--intervalo', type=float, help="Repete a cada N horas em vez de terminar.")
+    args = parser.parse_args()
+
+    db.DB_NAME = os.path.abspath(args.db)
+    db.init_db()
+    while True:
+        try:
+            print(json.dumps(executar(args), ensure_ascii=False, indent=2))
+        except Exception:
+            if not args.intervalo:
+                raise
+            traceback.print_exc()
+        if not args.intervalo:
+            break
+        # Só o primeiro ciclo faz o VACUUM completo.
+        args.vacuum_completo = False
+        time.sleep(args.intervalo * 3600)
+
+if __name__ == '__main__':
+    main()
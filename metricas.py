@@ -0,0 +1,221 @@
+import hmac
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+# Registo opcional de pedidos lentos (em ms); desligado se não estiver definido.
+LIMITE_LENTO_MS = float(os.environ['METRICAS_LENTO_MS']) if os.environ.get('METRICAS_LENTO_MS') else None
+# Perfilador por amostragem: pedidos acima deste limite (ms) gravam as pilhas amostradas em PERFIL_DIR.
+LIMITE_PERFIL_MS = float(os.environ['METRICAS_PERFIL_MS']) if os.environ.get('METRICAS_PERFIL_MS') else None
+PERFIL_DIR = os.environ.get('METRICAS_PERFIL_DIR', 'perfis')
+# /metrics só responde a administradores com sessão iniciada ou a pedidos com "Authorization: Bearer <token>".
+TOKEN = os.environ.get('METRICAS_TOKEN')
+INTERVALO_AMOSTRAGEM = 0.005
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger('pmq.lento')
+
+_lock = threading.Lock()
+_pedido = threading.local()
+
+class _Histograma:
+    __slots__ = ('contagens', 'soma', 'total')
+
+    def __init__(self):
+        self.contagens = [0] * len(BUCKETS)
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        for i, limite in enumerate(BUCKETS):
+            if valor <= limite:
+                self.contagens[i] += 1
+                break
+        self.soma += valor
+        self.total += 1
+
+_duracao_pedidos = defaultdict(_Histograma)   # (rota, método) -> histograma
+_duracao_fases = defaultdict(_Histograma)     # fase -> histograma
+_pedidos = Counter()                          # (rota, método, status)
+_transacoes_db = Counter()                    # rota
+_conexoes_db = Counter()                      # rota
+
+def _ativo():
+    return getattr(_pedido, 'inicio', None) is not None
+
+def observar_fase(nome, segundos):
+    """Regista a duração de uma fase; se houver um pedido em curso nesta thread, conta também para ele."""
+    with _lock:
+        _duracao_fases[nome].observar(segundos)
+    if _ativo():
+        _pedido.fases[nome] += segundos
+
+@contextmanager
+def fase(nome):
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        observar_fase(nome, time.perf_counter() - inicio)
+
+def contar_conexao():
+    if _ativo():
+        _pedido.conexoes += 1
+
+def contar_transacao():
+    if _ativo():
+        _pedido.transacoes += 1
+
+class _Amostrador:
+    """Regista periodicamente a pilha das threads com pedidos em curso (formato "folded" dos flame graphs)."""
+
+    def __init__(self):
+        self.pilhas = {}
+        self._iniciado = False
+
+    def registar(self, thread_id):
+        with _lock:
+            self.pilhas[thread_id] = Counter()
+            if not self._iniciado:
+                self._iniciado = True
+                threading.Thread(target=self._amostrar, name='metricas-perfil', daemon=True).start()
+
+    def retirar(self, thread_id):
+        with _lock:
+            return self.pilhas.pop(thread_id, Counter())
+
+    def _amostrar(self):
+        while True:
+            time.sleep(INTERVALO_AMOSTRAGEM)
+            frames = sys._current_frames()
+            with _lock:
+                for thread_id, pilhas in self.pilhas.items():
+                    frame = frames.get(thread_id)
+                    partes = []
+                    while frame is not None:
+                        partes.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                        frame = frame.f_back
+                    if partes:
+                        pilhas[';'.join(reversed(partes))] += 1
+
+_amostrador = _Amostrador()
+
+def _gravar_perfil(rota, duracao_ms, pilhas):
+    os.makedirs(PERFIL_DIR, exist_ok=True)
+    caminho = os.path.join(PERFIL_DIR, f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{rota}_{duracao_ms:.0f}ms.folded")
+    with open(caminho, 'w', encoding='utf-8') as f:
+        for pilha, amostras in pilhas.most_common():
+            f.write(f"{pilha} {amostras}\n")
+    return caminho
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _rotulos(**rotulos):
+    # As métricas são de cada processo: sem o pid, as séries de workers diferentes misturavam-se entre scrapes.
+    rotulos = {'pid': os.getpid(), **rotulos}
+    return ','.join(f'{nome}="{_escapar(valor)}"' for nome, valor in rotulos.items())
+
+def _histograma_texto(nome, ajuda, series):
+    linhas = [f"# HELP {nome} {ajuda}", f"# TYPE {nome} histogram"]
+    for rotulos, h in series:
+        acumulado = 0
+        for limite, contagem in zip(BUCKETS, h.contagens):
+            acumulado += contagem
+            linhas.append(f'{nome}_bucket{{{_rotulos(**rotulos, le=limite)}}} {acumulado}')
+        linhas.append(f'{nome}_bucket{{{_rotulos(**rotulos, le="+Inf")}}} {h.total}')
+        linhas.append(f'{nome}_sum{{{_rotulos(**rotulos)}}} {h.soma}')
+        linhas.append(f'{nome}_count{{{_rotulos(**rotulos)}}} {h.total}')
+    return linhas
+
+def _contador_texto(nome, ajuda, series):
+    linhas = [f"# HELP {nome} {ajuda}", f"# TYPE {nome} counter"]
+    linhas.extend(f'{nome}{{{_rotulos(**rotulos)}}} {valor}' for rotulos, valor in series)
+    return linhas
+
+def exportar():
+    """Métricas deste processo no formato de texto do Prometheus, com o rótulo `pid` em todas as séries."""
+    with _lock:
+        linhas = _histograma_texto('pmq_pedido_duracao_segundos', 'Duração dos pedidos HTTP por rota.',
+                                   [({'rota': rota, 'metodo': metodo}, h) for (rota, metodo), h in sorted(_duracao_pedidos.items())])
+        linhas += _contador_texto('pmq_pedidos_total', 'Pedidos HTTP por rota e código de estado.',
+                                  [({'rota': rota, 'metodo': metodo, 'status': status}, n) for (rota, metodo, status), n in sorted(_pedidos.items())])
+        linhas += _contador_texto('pmq_db_transacoes_total', 'Transações de db.py feitas pelos pedidos de cada rota.',
+                                  [({'rota': rota}, n) for rota, n in sorted(_transacoes_db.items())])
+        linhas += _contador_texto('pmq_db_conexoes_total', 'Ligações SQLite abertas durante os pedidos de cada rota.',
+                                  [({'rota': rota}, n) for rota, n in sorted(_conexoes_db.items())])
+        linhas += _histograma_texto('pmq_fase_duracao_segundos', 'Duração de fases internas (respostas, pontuação, templates, PDF).',
+                                    [({'fase': nome}, h) for nome, h in sorted(_duracao_fases.items())])
+    return '\n'.join(linhas) + '\n'
+
+def _autorizado(request, session):
+    if session.get('is_admin'):
+        return True
+    if not TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {TOKEN}'.encode())
+
+def instrumentar(app):
+    from flask import Response, abort, before_render_template, request, session, template_rendered
+
+    @app.before_request
+    def _iniciar_pedido():
+        _pedido.inicio = time.perf_counter()
+        _pedido.fases = defaultdict(float)
+        _pedido.transacoes = 0
+        _pedido.conexoes = 0
+        _pedido.template = []
+        _pedido.status = 500
+        if LIMITE_PERFIL_MS is not None:
+            _amostrador.registar(threading.get_ident())
+
+    @app.teardown_request
+    def _terminar_pedido(_erro):
+        if not _ativo():
+            return
+        duracao = time.perf_counter() - _pedido.inicio
+        _pedido.inicio = None
+        rota = request.endpoint or 'desconhecida'
+        status = getattr(_pedido, 'status', 500)
+        with _lock:
+            _duracao_pedidos[(rota, request.method)].observar(duracao)
+            _pedidos[(rota, request.method, status)] += 1
+            _transacoes_db[rota] += _pedido.transacoes
+            _conexoes_db[rota] += _pedido.conexoes
+        duracao_ms = duracao * 1000
+        if LIMITE_PERFIL_MS is not None:
+            pilhas = _amostrador.retirar(threading.get_ident())
+            if duracao_ms >= LIMITE_PERFIL_MS and pilhas:
+                _gravar_perfil(rota, duracao_ms, pilhas)
+        if LIMITE_LENTO_MS is not None and duracao_ms >= LIMITE_LENTO_MS:
+            fases = ', '.join(f"{nome}={segundos * 1000:.1f}ms" for nome, segundos in sorted(_pedido.fases.items(), key=lambda f: -f[1]))
+            logger.warning("Pedido lento: %s %s %s em %.1fms (db: %d transações, %d ligações; %s)",
+                           request.method, request.path, status, duracao_ms, _pedido.transacoes, _pedido.conexoes, fases or 'sem fases')
+
+    @app.after_request
+    def _guardar_status(resposta):
+        _pedido.status = resposta.status_code
+        return resposta
+
+    def _antes_template(sender, template, context, **extra):
+        if _ativo():
+            _pedido.template.append(time.perf_counter())
+
+    def _depois_template(sender, template, context, **extra):
+        if _ativo() and _pedido.template:
+            observar_fase('template', time.perf_counter() - _pedido.template.pop())
+
+    before_render_template.connect(_antes_template, app, weak=False)
+    template_rendered.connect(_depois_template, app, weak=False)
+
+    @app.route('/metrics')
+    def metrics():
+        if not _autorizado(request, session):
+            abort(403)
+        return Response(exportar(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,399 @@
+import argparse
+import asyncio
+import errno
+import ipaddress
+import json
+import os
+import re
+import socket
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse
+
+import aiohttp
+from aiohttp.resolver import ThreadedResolver
+
+import db
+import logic
+
+# Desligável (PRE_VERIFICACAO=0), p. ex. em servidores sem acesso à internet.
+ATIVA = os.environ.get('PRE_VERIFICACAO', '1') != '0'
+TIMEOUT_SEGUNDOS = float(os.environ.get('PRE_VERIFICACAO_TIMEOUT', 10))
+LIGACOES_POR_HOST = int(os.environ.get('PRE_VERIFICACAO_POR_HOST', 2))
+LIGACOES_TOTAL = 50
+MAX_PAGINAS_PORTAL = 3
+MAX_BYTES_PAGINA = 2 * 1024 * 1024
+MAX_REDIRECIONAMENTOS = 5
+# Os endereços vêm dos utilizadores: por omissão só se visitam máquinas na internet pública.
+REDES_PRIVADAS = os.environ.get('PRE_VERIFICACAO_REDES_PRIVADAS', '0') == '1'
+# As páginas obtidas são reutilizadas durante este tempo (municípios que partilham o mesmo portal, repetições).
+# Falhas não ficam em cache: a próxima verificação tenta de novo.
+CACHE_SEGUNDOS = 600
+CACHE_ENTRADAS = 1000
+# Uma verificação em 'pendente' há mais do que isto é considerada perdida e pode ser repetida.
+EXPIRACAO_PENDENTE = timedelta(minutes=5)
+USER_AGENT = 'PMQ-pre-verificacao/1.0'
+SUBCRITERIO = 'Disponibilidade'
+
+class _Analisador(HTMLParser):
+    """Recolhe o que as regras usam: ligações (endereço e texto), campos de pesquisa, trilha de navegação e texto visível."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []
+        self.textos = []
+        self.pesquisa = False
+        self.trilha = False
+        self._link = None
+        self._ignorar = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {nome: (valor or '') for nome, valor in attrs}
+        if attrs.get('role') == 'search':
+            self.pesquisa = True
+        if any('breadcrumb' in valor.lower() for valor in attrs.values()):
+            self.trilha = True
+        if tag in ('script', 'style'):
+            self._ignorar += 1
+        elif tag == 'a':
+            self._link = [attrs.get('href', ''), [attrs.get('title', ''), attrs.get('aria-label', '')]]
+        elif tag == 'img' and self._link is not None:
+            self._link[1].append(attrs.get('alt', ''))
+        elif tag == 'input' and (attrs.get('type') == 'search' or attrs.get('name', '').lower() in ('q', 's', 'busca', 'pesquisa', 'search', 'termo')):
+            self.pesquisa = True
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style'):
+            self._ignorar = max(self._ignorar - 1, 0)
+        elif tag == 'a' and self._link is not None:
+            href, textos = self._link
+            self.links.append((href, ' '.join(' '.join(textos).split())))
+            self._link = None
+
+    def handle_data(self, data):
+        if self._ignorar:
+            return
+        self.textos.append(data)
+        if self._link is not None:
+            self._link[1].append(data)
+
+def _pagina(url, status=None, erro=None):
+    return {'url': url, 'status': status, 'erro': erro, 'links': [], 'texto': '', 'pesquisa': False, 'trilha': False}
+
+def _ok(pagina):
+    return pagina is not None and pagina['status'] is not None and pagina['status'] < 400
+
+def _resumir(texto, limite=80):
+    return texto if len(texto) <= limite else texto[:limite - 1] + '…'
+
+# --- Regras: cada uma recebe o resultado da visita e devolve (valor, evidência, link) ou None. ---
+
+def _regra_link(expressao, so_capa=False, negativa=False):
+    padrao = re.compile(expressao, re.I)
+
+    def detetar(resultado):
+        paginas = [resultado['capa']] if so_capa else resultado['paginas']
+        for pagina in filter(_ok, paginas):
+            for url, texto in pagina['links']:
+                if padrao.search(texto) or padrao.search(url):
+                    return "Atende", f'Ligação "{_resumir(texto or url)}" em {pagina["url"]}', url
+        # Só a página inicial é vista por inteiro: fora dela, não encontrar não prova que não existe.
+        if negativa and _ok(resultado['capa']):
+            return logic.NAO_ATENDE, f"Nenhuma ligação correspondente na página inicial ({resultado['capa']['url']}).", resultado['capa']['url']
+        return None
+    return detetar
+
+def _regra_texto(expressao):
+    padrao = re.compile(expressao, re.I)
+
+    def detetar(resultado):
+        for pagina in filter(_ok, resultado['paginas']):
+            encontrado = padrao.search(pagina['texto'])
+            if encontrado:
+                return "Atende", f'Texto "{_resumir(encontrado.group(0))}" em {pagina["url"]}', pagina['url']
+        return None
+    return detetar
+
+def _regra_atributo(atributo, descricao):
+    def detetar(resultado):
+        for pagina in filter(_ok, resultado['paginas']):
+            if pagina[atributo]:
+                return "Atende", f"{descricao} em {pagina['url']}", pagina['url']
+        return None
+    return detetar
+
+def _regra_site(resultado):
+    capa = resultado['capa']
+    if _ok(capa):
+        return "Atende", f"O site respondeu (HTTP {capa['status']}).", capa['url']
+    motivo = f"HTTP {capa['status']}" if capa['status'] else capa['erro']
+    return logic.NAO_ATENDE, f"O site não respondeu ({motivo}).", capa['url']
+
+def _regra_portal(resultado):
+    for pagina in resultado['portal']:
+        if _ok(pagina):
+            return "Atende", f"Portal da transparência acessível (HTTP {pagina['status']}).", pagina['url']
+    return None
+
+# (expressão que identifica o critério, regra). Só se aplicam ao subcritério "Disponibilidade".
+REGRAS = [
+    (r'possui sítio oficial', _regra_site),
+    (r'possui portal da transpar', _regra_portal),
+    (r'portal (da )?transpar\w* está visível na capa', _regra_link(r'transpar', so_capa=True, negativa=True)),
+    (r'ferramenta de pesquisa', _regra_atributo('pesquisa', "Campo de pesquisa")),
+    (r'redes sociais', _regra_link(r'facebook\.com|instagram\.com|twitter\.com|//(www\.)?x\.com|youtube\.com|tiktok\.com')),
+    (r'botão do radar', _regra_link(r'radar')),
+    (r'perguntas e respostas frequentes', _regra_link(r'perguntas frequentes|\bfaq\b')),
+    (r'existe o sic no site', _regra_link(r'\bsic\b|serviço de informação ao cidadão')),
+    (r'forma eletrônica \(e-sic\)', _regra_link(r'e-?sic')),
+    (r'símbolo de acessibilidade', _regra_texto(r'acessibilidade')),
+    (r'“caminho” de páginas', _regra_atributo('trilha', "Trilha de navegação (breadcrumb)")),
+    (r'alto contraste', _regra_texto(r'alto contraste|\bcontraste\b')),
+    (r'redimensionamento de texto', _regra_texto(r'\bA\+|aumentar (a )?(fonte|letra)|tamanho d[ao] (fonte|texto)')),
+    (r'mapa do site', _regra_link(r'mapa do site|mapa-do-site|sitemap')),
+    (r'canal eletrônico de acesso/interação com a ouvidoria', _regra_link(r'ouvidoria')),
+    (r'carta de serviços', _regra_link(r'carta de servi')),
+    (r'política de privacidade', _regra_link(r'privacidade')),
+    (r'acesso automatizado', _regra_link(r'dados abertos|dados-abertos|/api\b')),
+]
+
+# (tipo de análise, versão dos critérios) -> [(chave da resposta, regra)]
+_regras_por_tipo = {}
+
+def regras_para(tipo_analise):
+    chave = (tipo_analise, logic.versao_tipo(tipo_analise))
+    if chave not in _regras_por_tipo:
+        regras = []
+        for secao, perguntas in (logic.carregar_criterios().get(tipo_analise) or {}).items():
+            for item in perguntas:
+                if SUBCRITERIO not in item['subcriterios']:
+                    continue
+                for expressao, regra in REGRAS:
+                    if re.search(expressao, item['criterio'], re.I):
+                        regras.append((f"{secao}_{item['criterio']}_{SUBCRITERIO}", regra))
+                        break
+        _regras_por_tipo[chave] = regras
+    return _regras_por_tipo[chave]
+
+def endereco_publico(ip):
+    """False para loopback, redes privadas, link-local (p. ex. metadados da cloud), multicast e reservados."""
+    if getattr(ip, 'ipv4_mapped', None):
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+def _qualquer_endereco(ip):
+    return True
+
+class _Resolvedor(ThreadedResolver):
+    """Descarta os endereços não permitidos depois da resolução DNS, em cada ligação (também após redirecionamentos)."""
+
+    def __init__(self, permitir):
+        super().__init__()
+        self._permitir = permitir
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        enderecos = [e for e in await super().resolve(host, port, family) if self._permitir(ipaddress.ip_address(e['host']))]
+        if not enderecos:
+            raise OSError(errno.EACCES, f"Endereço não permitido: {host}")
+        return enderecos
+
+def normalizar_url(site_url):
+    site_url = site_url.strip()
+    return site_url if urlparse(site_url).scheme in ('http', 'https') else f"https://{site_url}"
+
+class Verificador:
+    """Visita sites com uma sessão HTTP partilhada (ligações reutilizadas e limitadas por host) e guarda as páginas em cache."""
+
+    def __init__(self, por_host=LIGACOES_POR_HOST, timeout=TIMEOUT_SEGUNDOS, permitir=None):
+        self.por_host = por_host
+        self.timeout = timeout
+        # Predicado sobre o endereço IP de destino.
+        self.permitir = permitir or (_qualquer_endereco if REDES_PRIVADAS else endereco_publico)
+        self._sessao = None
+        # url -> (expira, tarefa); pedidos simultâneos à mesma página partilham a mesma tarefa.
+        self._cache = OrderedDict()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.fechar()
+
+    async def fechar(self):
+        if self._sessao is not None:
+            await self._sessao.close()
+            self._sessao = None
+
+    def _obter_sessao(self):
+        # A sessão tem de ser criada dentro do event loop que a vai usar.
+        if self._sessao is None:
+            self._sessao = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=LIGACOES_TOTAL, limit_per_host=self.por_host, ttl_dns_cache=300,
+                                               resolver=_Resolvedor(self.permitir)),
+                timeout=aiohttp.ClientTimeout(total=self.timeout, sock_connect=min(self.timeout, 5)),
+                headers={'User-Agent': USER_AGENT, 'Accept': 'text/html,application/xhtml+xml'})
+        return self._sessao
+
+    def _host_permitido(self, url):
+        try:
+            ip = ipaddress.ip_address(urlparse(url).hostname or '')
+        except ValueError:
+            # Um nome: os endereços para que resolve são filtrados pelo _Resolvedor.
+            return True
+        return self.permitir(ip)
+
+    async def _buscar(self, url):
+        inicial = url
+        try:
+            # Os redirecionamentos são seguidos aqui para que cada destino seja verificado antes do pedido.
+            for _ in range(MAX_REDIRECIONAMENTOS + 1):
+                if not self._host_permitido(url):
+                    return _pagina(inicial, erro=f"Endereço não permitido: {urlparse(url).hostname}")
+                async with self._obter_sessao().get(url, allow_redirects=False) as resposta:
+                    destino = resposta.headers.get('Location')
+                    if resposta.status in (301, 302, 303, 307, 308) and destino:
+                        url = urljoin(str(resposta.url), destino)
+                        continue
+                    pagina = _pagina(str(resposta.url), resposta.status)
+                    tipo = resposta.headers.get('Content-Type', '')
+                    if tipo and 'html' not in tipo:
+                        return pagina
+                    corpo = await resposta.content.read(MAX_BYTES_PAGINA)
+                    analisador = _Analisador()
+                    analisador.feed(corpo.decode(resposta.charset or 'utf-8', errors='replace'))
+                    analisador.close()
+                    break
+            else:
+                return _pagina(inicial, erro="Demasiados redirecionamentos")
+        except (aiohttp.ClientError, asyncio.TimeoutError, LookupError, ValueError) as e:
+            return _pagina(inicial, erro=str(e) or type(e).__name__)
+        links = []
+        for href, texto in analisador.links:
+            endereco = urljoin(pagina['url'], href.strip())
+            if urlparse(endereco).scheme in ('http', 'https'):
+                links.append((endereco.split('#')[0], texto))
+        pagina.update(links=links, texto=' '.join(' '.join(analisador.textos).split()),
+                      pesquisa=analisador.pesquisa, trilha=analisador.trilha)
+        return pagina
+
+    async def obter(self, url):
+        agora = time.monotonic()
+        entrada = self._cache.get(url)
+        if entrada and entrada[0] > agora:
+            self._cache.move_to_end(url)
+            return await entrada[1]
+        tarefa = asyncio.ensure_future(self._buscar(url))
+        self._cache[url] = (agora + CACHE_SEGUNDOS, tarefa)
+        while len(self._cache) > CACHE_ENTRADAS:
+            self._cache.popitem(last=False)
+        pagina = await tarefa
+        # Os pedidos simultâneos partilham a tarefa, mas uma falha não é reutilizada depois.
+        if not _ok(pagina) and self._cache.get(url, (None, None))[1] is tarefa:
+            del self._cache[url]
+        return pagina
+
+    async def verificar(self, site_url, tipo_analise):
+        """Visita a página inicial e as páginas do portal da transparência ligadas a partir dela e sugere respostas."""
+        capa = await self.obter(normalizar_url(site_url))
+        portal = []
+        if _ok(capa):
+            enderecos = []
+            for url, texto in capa['links']:
+                if re.search(r'transpar', f"{url} {texto}", re.I) and url != capa['url'] and url not in enderecos:
+                    enderecos.append(url)
+            portal = await asyncio.gather(*(self.obter(url) for url in enderecos[:MAX_PAGINAS_PORTAL]))
+        resultado = {'capa': capa, 'portal': portal, 'paginas': [capa, *portal]}
+        sugestoes = {}
+        for chave, regra in regras_para(tipo_analise):
+            sugestao = regra(resultado)
+            if sugestao:
+                valor, evidencia, link = sugestao
+                sugestoes[chave] = {'valor': valor, 'evidencia': evidencia, 'link': link}
+        return {
+            'site_url': site_url,
+            'paginas': [{'url': p['url'], 'status': p['status'], 'erro': p['erro']} for p in resultado['paginas']],
+            'erro': None if _ok(capa) else (capa['erro'] or f"HTTP {capa['status']}"),
+            'sugestoes': sugestoes,
+        }
+
+    async def verificar_lote(self, itens, concorrencia=10):
+        """Verifica vários (site_url, tipo_analise) em simultâneo; devolve os resultados pela mesma ordem."""
+        limite = asyncio.Semaphore(concorrencia)
+
+        async def verificar_um(site_url, tipo_analise):
+            async with limite:
+                return await self.verificar(site_url, tipo_analise)
+        return await asyncio.gather(*(verificar_um(site_url, tipo_analise) for site_url, tipo_analise in itens))
+
+# --- Execução em segundo plano na aplicação: um event loop por processo, numa thread própria. ---
+
+_lock = threading.Lock()
+_estado = {'pid': None, 'loop': None, 'verificador': None}
+
+def _iniciar():
+    # Depois de um fork (gunicorn) o processo filho não herda a thread do event loop.
+    with _lock:
+        if _estado['pid'] != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='pre-verificacao', daemon=True).start()
+            _estado.update(pid=os.getpid(), loop=loop, verificador=Verificador())
+    return _estado['loop'], _estado['verificador']
+
+async def _verificar_e_guardar(verificador, analise_id, site_url, tipo_analise):
+    # As gravações são curtas e feitas na própria thread do event loop, com a ligação SQLite dela.
+    try:
+        resultado = await verificador.verificar(site_url, tipo_analise)
+        db.guardar_verificacao_site(analise_id, resultado['sugestoes'], resultado['paginas'], resultado['erro'])
+    except Exception:
+        traceback.print_exc()
+        db.guardar_verificacao_site(analise_id, {}, [], traceback.format_exc(limit=2))
+
+def agendar(analise_id, site_url, tipo_analise, repetir=False):
+    """Inicia a pré-verificação de uma análise sem bloquear o pedido. Devolve False se não foi iniciada."""
+    if not ATIVA or not db.iniciar_verificacao_site(analise_id, repetir, datetime.now() - EXPIRACAO_PENDENTE):
+        return False
+    loop, verificador = _iniciar()
+    asyncio.run_coroutine_threadsafe(_verificar_e_guardar(verificador, analise_id, site_url, tipo_analise), loop)
+    return True
+
+async def _verificar_analises(analises, concorrencia, por_host):
+    async with Verificador(por_host=por_host) as verificador:
+        resultados = await verificador.verificar_lote([(site_url, tipo) for _, site_url, tipo in analises], concorrencia)
+    for (analise_id, _, _), resultado in zip(analises, resultados):
+        db.guardar_verificacao_site(analise_id, resultado['sugestoes'], resultado['paginas'], resultado['erro'])
+    return resultados
+
+def main():
+    parser = argparse.ArgumentParser(description="Pré-verifica os sites das análises e grava respostas sugeridas para os analistas confirmarem.")
+    parser.add_argument('--db', default=db.DB_NAME)
+    parser.add_argument('--usuario', help="Só as análises deste utilizador.")
+    parser.add_argument('--todas', action='store_true', help="Inclui as análises já verificadas.")
+    parser.add_argument('--url', help="Verifica só este endereço e mostra o resultado, sem gravar.")
+    parser.add_argument('--tipo', default='Prefeitura', help="Tipo de análise usado com --url.")
+    parser.add_argument('--concorrencia', type=int, default=20, help="Sites verificados em simultâneo.")
+    parser.add_argument('--por-host', type=int, default=LIGACOES_POR_HOST, help="Ligações simultâneas a um mesmo servidor.")
+    args = parser.parse_args()
+
+    db.DB_NAME = os.path.abspath(args.db)
+    # Os critérios são lidos com caminhos relativos à raiz do projeto.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    inicio = time.perf_counter()
+    if args.url:
+        async def verificar_url():
+            async with Verificador(por_host=args.por_host) as verificador:
+                return await verificador.verificar(args.url, args.tipo)
+        print(json.dumps(asyncio.run(verificar_url()), ensure_ascii=False, indent=2))
+        return
+    db.init_db()
+    analises = db.analises_por_verificar(args.usuario, args.todas)
+    resultados = asyncio.run(_verificar_analises(analises, args.concorrencia, args.por_host))
+    sem_resposta = sum(1 for resultado in resultados if resultado['erro'])
+    sugestoes = sum(len(resultado['sugestoes']) for resultado in resultados)
+    print(f"{len(analises)} análises verificadas em {time.perf_counter() - inicio:.1f}s: {sugestoes} sugestões, {sem_resposta} sites sem resposta.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+
+from flask import render_template
+
+import db
+import fila_relatorios
+import imagens
+import logic
+import metricas
+
+# Por omissão, um processo de renderização por núcleo (só na linha de comandos; a aplicação usa o pool da fila_relatorios).
+LOTE_WORKERS = int(os.environ.get('PDF_LOTE_WORKERS', os.cpu_count() or 1))
+# Lotes pedidos pela aplicação em simultâneo, por processo; os seguintes são recusados até um terminar.
+LOTES_EM_SIMULTANEO = int(os.environ.get('PDF_LOTES_SIMULTANEOS', 1))
+
+_lotes = threading.BoundedSemaphore(LOTES_EM_SIMULTANEO)
+
+def reservar_lote():
+    """True se houver vaga para mais um lote neste processo; quem a obtém tem de chamar libertar_lote()."""
+    return _lotes.acquire(blocking=False)
+
+def libertar_lote():
+    _lotes.release()
+
+def montar_relatorio(analise, tipo_relatorio, pasta_uploads):
+    """Devolve o HTML do relatório, ainda com o marcador de data, e as imagens que ele inclui."""
+    criterios_para_analise = logic.carregar_criterios().get(analise['tipo_analise'])
+
+    matriz_a_usar = criterios_para_analise
+    if tipo_relatorio == "Apenas Pontos a Melhorar":
+        perguntas_filtradas = {}
+        for secao, perguntas in criterios_para_analise.items():
+            itens_nao_conformes = [item for item in perguntas if any(analise['respostas'].get(f"{secao}_{item['criterio']}_{sub}") == logic.NAO_ATENDE for sub in item["subcriterios"])]
+            if itens_nao_conformes:
+                perguntas_filtradas[secao] = itens_nao_conformes
+        matriz_a_usar = perguntas_filtradas
+
+    resultados = logic.pontuar_analises([analise['respostas']], analise['tipo_analise'])[0]
+
+    image_paths = {}
+    caminhos_imagens = []
+    for secao in ('RECEITA', 'DESPESA'):
+        image_paths[secao] = None
+        nome = analise.get(f'{secao.lower()}_img_path')
+        if nome:
+            # Usa a versão reduzida para impressão; o original só enquanto ela ainda não foi gerada.
+            path = Path(imagens.caminho_derivado(pasta_uploads, nome, 'impressao')).resolve()
+            if not path.exists():
+                path = Path(pasta_uploads, nome).resolve()
+            if path.exists():
+                image_paths[secao] = path.as_uri()
+                caminhos_imagens.append(path)
+
+    html_sem_data = render_template('relatorio_template.html',
+        site_nome=analise.get('site_nome', analise['site_url']),
+        site_url=analise['site_url'],
+        respostas=analise['respostas'],
+        resultados=resultados,
+        nome_usuario=analise['username'],
+        data_geracao=logic.MARCADOR_DATA_GERACAO,
+        matriz_a_usar=matriz_a_usar,
+        scores_secao=resultados['scores_secao'],
+        image_paths=image_paths,
+        versao_criterios=logic.versao_tipo(analise['tipo_analise'])
+    )
+    return html_sem_data, caminhos_imagens
+
+class _SaidaZip:
+    # Sem seek(), o ZipFile escreve cada entrada com data descriptor; os bytes ficam aqui até serem enviados.
+    def __init__(self):
+        self._partes = []
+
+    def write(self, dados):
+        self._partes.append(bytes(dados))
+        return len(dados)
+
+    def flush(self):
+        pass
+
+    def retirar(self):
+        dados = b''.join(self._partes)
+        self._partes = []
+        return dados
+
+def _adicionar_pdf(arquivo, nome, sha256):
+    # PDFs já vêm comprimidos; são copiados do disco para o ZIP em blocos.
+    with open(db.caminho_pdf(sha256), 'rb') as origem, arquivo.open(nome, 'w', force_zip64=True) as destino:
+        shutil.copyfileobj(origem, destino, 1024 * 1024)
+
+def gerar_zip(ids, tipo_relatorio, base_url, pasta_uploads, username=None, workers=LOTE_WORKERS, executor=None):
+    """Gera os relatórios das análises indicadas e devolve o ZIP aos bocados, à medida que ficam prontos.
+
+    Cada PDF entra no arquivo assim que termina; no fim é acrescentado um manifesto.json com o
+    resultado de cada análise. Com username, só são incluídas análises desse utilizador.
+    Sem `executor`, cria um pool próprio com `workers` processos; com ele, `workers` limita só os relatórios em voo.
+    """
+    saida = _SaidaZip()
+    manifesto = []
+    pendentes = deque(ids)
+    em_curso = {}
+    proprio = executor is None
+    if proprio:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=logic.aquecer_weasyprint)
+    try:
+        with zipfile.ZipFile(saida, 'w', zipfile.ZIP_STORED) as arquivo:
+            while pendentes or em_curso:
+                # No máximo dois relatórios por worker em voo, para não montar o HTML de todo o lote de uma vez.
+                while pendentes and len(em_curso) < workers * 2:
+                    analise_id = pendentes.popleft()
+                    item = {'analise_id': analise_id}
+                    try:
+                        analise = db.obter_analise_por_id(analise_id, username)
+                        if not analise:
+                            raise LookupError('Análise não encontrada.')
+                        item['site_url'] = analise['site_url']
+                        html_sem_data, caminhos_imagens = montar_relatorio(analise, tipo_relatorio, pasta_uploads)
+                        digest = logic.digest_relatorio(html_sem_data, caminhos_imagens, tipo_relatorio, base_url)
+                        em_cache = db.obter_pdf_em_cache(digest)
+                        if em_cache:
+                            item['arquivo'] = f"{analise_id}_{logic.nome_arquivo_relatorio(analise['site_url'])}"
+                            _adicionar_pdf(arquivo, item['arquivo'], em_cache['sha256'])
+                            db.salvar_relatorio_db(analise_id, item['arquivo'], sha256=em_cache['sha256'], tamanho=em_cache['tamanho'])
+                            manifesto.append({**item, 'estado': 'ok', 'origem': 'cache'})
+                            yield saida.retirar()
+                            continue
+                        html_string = html_sem_data.replace(logic.MARCADOR_DATA_GERACAO, datetime.now().strftime('%d/%m/%Y %H:%M:%S'))
+                        future = executor.submit(fila_relatorios._renderizar, html_string, analise['site_url'], base_url)
+                        em_curso[future] = (item, digest)
+                    except Exception as e:
+                        manifesto.append({**item, 'estado': 'erro', 'mensagem': str(e) or type(e).__name__})
+
+                if not em_curso:
+                    continue
+                feitos, _ = wait(em_curso, return_when=FIRST_COMPLETED)
+                for future in feitos:
+                    item, digest = em_curso.pop(future)
+                    try:
+                        nome_arquivo, sha256, tamanho, tempo_render = future.result()
+                        metricas.observar_fase('write_pdf', tempo_render)
+                        if not sha256:
+                            raise RuntimeError('A renderização não produziu nenhum PDF.')
+                        item['arquivo'] = f"{item['analise_id']}_{nome_arquivo}"
+                        _adicionar_pdf(arquivo, item['arquivo'], sha256)
+                        db.registar_relatorio_renderizado(item['analise_id'], item['arquivo'], sha256, tamanho, digest, tempo_render)
+                        manifesto.append({**item, 'estado': 'ok', 'origem': 'renderizado'})
+                    except Exception as e:
+                        manifesto.append({**item, 'estado': 'erro', 'mensagem': str(e) or type(e).__name__})
+                    yield saida.retirar()
+
+            manifesto.sort(key=lambda entrada: entrada['analise_id'])
+            arquivo.writestr('manifesto.json', json.dumps(manifesto, ensure_ascii=False, indent=2))
+        yield saida.retirar()
+    finally:
+        # Se o cliente desistir a meio, os relatórios ainda não iniciados são abandonados.
+        if proprio:
+            executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            for future in em_curso:
+                future.cancel()
+
+def main():
+    parser = argparse.ArgumentParser(description="Gera os relatórios de várias análises num único ficheiro ZIP.")
+    parser.add_argument('ids', nargs='*', type=int, help="IDs das análises (por omissão, todas as que passam nos filtros).")
+    parser.add_argument('--usuario', help="Apenas análises deste utilizador.")
+    parser.add_argument('--tipo-analise', choices=['Prefeitura', 'Câmara'])
+    parser.add_argument('--inicio', help="Modificadas a partir desta data (AAAA-MM-DD).")
+    parser.add_argument('--fim', help="Modificadas até esta data (AAAA-MM-DD).")
+    parser.add_argument('--tipo-relatorio', default='Relatório Completo', choices=['Relatório Completo', 'Apenas Pontos a Melhorar'])
+    parser.add_argument('--saida', default='relatorios.zip', help="Ficheiro ZIP a criar.")
+    parser.add_argument('--workers', type=int, default=LOTE_WORKERS)
+    parser.add_argument('--base-url', default='http://localhost:5000/', help="URL da aplicação, usado para o logótipo e outros recursos estáticos.")
+    args = parser.parse_args()
+
+    # Importado aqui para o worker (spawn) não carregar a aplicação Flask.
+    from app import app
+    ids = args.ids or db.listar_ids_analises(username=args.usuario, tipo_analise=args.tipo_analise, inicio=args.inicio, fim=args.fim)
+    if not ids:
+        print("Nenhuma análise corresponde aos filtros indicados.")
+        return
+    with app.app_context(), open(args.saida, 'wb') as destino:
+        for bloco in gerar_zip(ids, args.tipo_relatorio, args.base_url, app.config['UPLOAD_FOLDER'], args.usuario, args.workers):
+            destino.write(bloco)
+    print(f"{len(ids)} análises processadas; resultado em '{args.saida}' (ver manifesto.json para erros).")
+
+if __name__ == '__main__':
+    main()
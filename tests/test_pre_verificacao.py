@@ -0,0 +1,170 @@
+"""Testes da pré-verificação contra um servidor HTTP local (aiohttp), sem acesso à internet.
+
+Correr a partir da raiz do projeto: python -m pytest tests  (ou python -m unittest discover tests)
+"""
+import asyncio
+import ipaddress
+import os
+import sys
+import time
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+import logic  # noqa: E402
+import pre_verificacao  # noqa: E402
+
+CAPA = """<html><body>
+<nav class="breadcrumb"><a href="/">Início</a></nav>
+<form role="search"><input type="search" name="q"></form>
+<a href="/transparencia">Portal da Transparência</a>
+<a href="https://www.facebook.com/prefeitura">Facebook</a>
+<a href="/ouvidoria">Ouvidoria</a>
+<a href="/mapa-do-site">Mapa do site</a>
+<p>Alto contraste · A+ · Acessibilidade</p>
+</body></html>"""
+
+def _so_loopback(ip):
+    return ip == ipaddress.ip_address('127.0.0.1')
+
+def _sugestao(resultado, trecho):
+    for chave, sugestao in resultado['sugestoes'].items():
+        if trecho in chave:
+            return sugestao['valor']
+    return None
+
+def setUpModule():
+    # Os critérios são lidos com caminhos relativos à raiz do projeto.
+    os.chdir(RAIZ)
+
+class PreVerificacaoTestes(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.pedidos = {}
+        self.em_curso = 0
+        self.max_em_curso = 0
+        app = web.Application()
+        app.router.add_get('/', self._capa)
+        app.router.add_get('/transparencia', self._simples)
+        app.router.add_get('/lento', self._lento)
+        app.router.add_get('/erro', self._erro)
+        app.router.add_get('/pagina/{n}', self._concorrente)
+        app.router.add_get('/redireciona', self._redireciona)
+        self.servidor = TestServer(app, host='127.0.0.1')
+        await self.servidor.start_server()
+
+    async def asyncTearDown(self):
+        await self.servidor.close()
+
+    def _contar(self, request):
+        self.pedidos[request.path] = self.pedidos.get(request.path, 0) + 1
+
+    async def _capa(self, request):
+        self._contar(request)
+        return web.Response(text=CAPA, content_type='text/html')
+
+    async def _simples(self, request):
+        self._contar(request)
+        return web.Response(text='<html><body>Receitas e despesas</body></html>', content_type='text/html')
+
+    async def _lento(self, request):
+        self._contar(request)
+        await asyncio.sleep(2)
+        return web.Response(text='tarde demais', content_type='text/html')
+
+    async def _erro(self, request):
+        self._contar(request)
+        return web.Response(status=500, text='falha', content_type='text/html')
+
+    async def _concorrente(self, request):
+        self._contar(request)
+        self.em_curso += 1
+        self.max_em_curso = max(self.max_em_curso, self.em_curso)
+        await asyncio.sleep(0.1)
+        self.em_curso -= 1
+        return web.Response(text='<html></html>', content_type='text/html')
+
+    async def _redireciona(self, request):
+        self._contar(request)
+        raise web.HTTPFound(request.query['para'])
+
+    def url(self, caminho):
+        return str(self.servidor.make_url(caminho))
+
+    async def test_sugestoes_a_partir_da_capa_e_do_portal(self):
+        async with pre_verificacao.Verificador(permitir=_so_loopback) as verificador:
+            resultado = await verificador.verificar(self.url('/'), 'Prefeitura')
+        self.assertIsNone(resultado['erro'])
+        self.assertEqual([p['status'] for p in resultado['paginas']], [200, 200])
+        self.assertEqual(_sugestao(resultado, 'Possui sítio oficial'), 'Atende')
+        self.assertEqual(_sugestao(resultado, 'Possui portal da transparência'), 'Atende')
+        self.assertEqual(_sugestao(resultado, 'visível na capa'), 'Atende')
+        self.assertEqual(_sugestao(resultado, 'ferramenta de pesquisa'), 'Atende')
+        self.assertEqual(_sugestao(resultado, 'redes sociais'), 'Atende')
+        self.assertEqual(_sugestao(resultado, 'alto contraste'), 'Atende')
+        self.assertEqual(_sugestao(resultado, '“caminho” de páginas'), 'Atende')
+        self.assertEqual(_sugestao(resultado, 'ouvidoria'), 'Atende')
+        # Nada indica um SIC: sem evidência, não há sugestão.
+        self.assertIsNone(_sugestao(resultado, 'Existe o SIC'))
+
+    async def test_site_que_nao_responde(self):
+        url = self.url('/')
+        await self.servidor.close()
+        async with pre_verificacao.Verificador(permitir=_so_loopback) as verificador:
+            resultado = await verificador.verificar(url, 'Prefeitura')
+        self.assertIsNotNone(resultado['erro'])
+        self.assertEqual(_sugestao(resultado, 'Possui sítio oficial'), logic.NAO_ATENDE)
+
+    async def test_timeout(self):
+        inicio = time.perf_counter()
+        async with pre_verificacao.Verificador(timeout=0.3, permitir=_so_loopback) as verificador:
+            pagina = await verificador.obter(self.url('/lento'))
+        self.assertLess(time.perf_counter() - inicio, 1.5)
+        self.assertIsNone(pagina['status'])
+        self.assertTrue(pagina['erro'])
+
+    async def test_limite_de_ligacoes_por_host(self):
+        async with pre_verificacao.Verificador(por_host=2, permitir=_so_loopback) as verificador:
+            paginas = await asyncio.gather(*(verificador.obter(self.url(f'/pagina/{n}')) for n in range(8)))
+        self.assertTrue(all(p['status'] == 200 for p in paginas))
+        self.assertEqual(self.max_em_curso, 2)
+
+    async def test_cache_reutiliza_paginas_mas_nao_falhas(self):
+        async with pre_verificacao.Verificador(permitir=_so_loopback) as verificador:
+            await asyncio.gather(verificador.obter(self.url('/transparencia')), verificador.obter(self.url('/transparencia')))
+            await verificador.obter(self.url('/transparencia'))
+            await verificador.obter(self.url('/erro'))
+            await verificador.obter(self.url('/erro'))
+        self.assertEqual(self.pedidos['/transparencia'], 1)
+        self.assertEqual(self.pedidos['/erro'], 2)
+
+    async def test_enderecos_internos_bloqueados_por_omissao(self):
+        async with pre_verificacao.Verificador() as verificador:
+            por_ip = await verificador.obter(self.url('/'))
+            por_nome = await verificador.obter(f"http://localhost:{self.servidor.port}/")
+        self.assertIn('não permitido', por_ip['erro'])
+        self.assertIn('não permitido', por_nome['erro'])
+        self.assertNotIn('/', self.pedidos)
+
+    async def test_redirecionamento_para_endereco_interno(self):
+        destino = f"http://127.0.0.2:{self.servidor.port}/"
+        async with pre_verificacao.Verificador(permitir=_so_loopback) as verificador:
+            pagina = await verificador.obter(self.url('/redireciona') + f'?para={destino}')
+            permitido = await verificador.obter(self.url('/redireciona') + '?para=/transparencia')
+        self.assertIn('não permitido', pagina['erro'])
+        self.assertEqual(permitido['status'], 200)
+        self.assertTrue(permitido['url'].endswith('/transparencia'))
+
+    def test_endereco_publico(self):
+        for endereco in ('127.0.0.1', '10.1.2.3', '192.168.0.1', '169.254.169.254', '100.64.0.1', '0.0.0.0',
+                         '224.0.0.1', '::1', 'fe80::1', 'fd00::1', '::ffff:127.0.0.1'):
+            self.assertFalse(pre_verificacao.endereco_publico(ipaddress.ip_address(endereco)), endereco)
+        for endereco in ('8.8.8.8', '200.152.38.1', '2001:4860:4860::8888'):
+            self.assertTrue(pre_verificacao.endereco_publico(ipaddress.ip_address(endereco)), endereco)
+
+if __name__ == '__main__':
+    unittest.main()